@@ -90,6 +90,11 @@ def train(args):
             train_dataset_group.is_latent_cacheable()
         ), "when caching latents, either color_aug or random_crop cannot be used / latentをキャッシュするときはcolor_augとrandom_cropは使えません"
 
+    if args.image_ram_cache_size > 0 and not cache_latents:
+        train_dataset_group.enable_image_cache(args.image_ram_cache_size)
+    if args.gpu_augmentation:
+        train_dataset_group.set_gpu_augmentation(True)
+
     # acceleratorを準備する
     print("prepare accelerator")
     accelerator = train_util.prepare_accelerator(args)
@@ -150,7 +155,16 @@ def train(args):
         vae.requires_grad_(False)
         vae.eval()
         with torch.no_grad():
-            train_dataset_group.cache_latents(vae, args.vae_batch_size, args.cache_latents_to_disk, accelerator.is_main_process)
+            train_dataset_group.cache_latents(
+                vae,
+                args.vae_batch_size,
+                args.cache_latents_to_disk,
+                accelerator.is_main_process,
+                latents_cache_dir=args.latents_cache_dir,
+                num_workers=args.cache_latents_workers,
+                storage_dtype=args.cache_storage_dtype,
+                compress=args.cache_compress,
+            )
         vae.to("cpu")
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
@@ -297,7 +311,7 @@ def train(args):
                         latents = batch["latents"].to(accelerator.device)  # .to(dtype=weight_dtype)
                     else:
                         # latentに変換
-                        latents = vae.encode(batch["images"].to(dtype=weight_dtype)).latent_dist.sample()
+                        latents = vae.encode(train_util.augment_batch_images(batch).to(dtype=weight_dtype)).latent_dist.sample()
                     latents = latents * 0.18215
                 b_size = latents.shape[0]
 
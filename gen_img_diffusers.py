@@ -92,7 +92,7 @@ from PIL.PngImagePlugin import PngInfo
 
 import library.model_util as model_util
 import library.train_util as train_util
-from networks.lora import LoRANetwork
+from networks.lora import LoRANetwork, fuse_networks
 import tools.original_control_net as original_control_net
 from tools.original_control_net import ControlNetInfo
 from library.original_unet import UNet2DConditionModel
@@ -2133,6 +2133,7 @@ class BatchDataExt(NamedTuple):
     strength: float
     network_muls: Tuple[float]
     num_sub_prompts: int
+    loras: Optional[Tuple[Tuple[str, float]]] = None  # LoRAs of the job in server mode, applied with LoRARegistry
 
 
 class BatchData(NamedTuple):
@@ -2413,8 +2414,17 @@ def main(args):
             else:
                 network.merge_to(text_encoder, unet, weights_sd, dtype, device)
 
+        # 複数のLoRAを対象モジュールごとに1つにまとめる / fuse LoRAs of the networks for each target module
+        fused_lora_modules = []
+        if args.network_fuse:
+            if network_pre_calc:
+                print("network_fuse is ignored with network_pre_calc / network_pre_calcが指定されているためnetwork_fuseは無視されます")
+            else:
+                fused_lora_modules = fuse_networks([n for n in networks if isinstance(n, LoRANetwork)])
+
     else:
         networks = []
+        fused_lora_modules = []
 
     # upscalerの指定があれば取得する
     upscaler = None
@@ -2609,7 +2619,7 @@ def main(args):
     else:
         prompt_list = []
 
-    if args.interactive:
+    if args.interactive or args.server:
         args.n_iter = 1
 
     # img2imgの前処理、画像の読み込みなど
@@ -2703,6 +2713,10 @@ def main(args):
         regional_network = True
         print("use mask as region")
 
+        # fused modules do not support regional LoRA
+        for fused in fused_lora_modules:
+            fused.remove()
+
         size = None
         for i, network in enumerate(networks):
             if i < 3:
@@ -2745,8 +2759,26 @@ def main(args):
     if args.H is None:
         args.H = 512
 
+    # サーバーモード：プロンプトをHTTPで受け付ける / server mode: accept prompts over HTTP
+    server = None
+    lora_registry = None
+    if args.server:
+        from library.gen_img_server import GenerationServer
+
+        if args.network_pre_calc:
+            print("LoRAs of the jobs are not available with network_pre_calc / network_pre_calcが指定されているためジョブのLoRAは使えません")
+        else:
+            from networks.lora_registry import LoRARegistry
+
+            lora_registry = LoRARegistry(text_encoder, unet, device, dtype, args.server_lora_cache_mb)
+
+        server = GenerationServer(args.server_host, args.server_port)
+        server.lora_registry = lora_registry
+
     # 画像生成のループ
     os.makedirs(args.outdir, exist_ok=True)
+    gen_stats = {"images": 0, "batches": 0}  # throughput report / スループットの表示用
+    gen_start_time = time.perf_counter()
     max_embeddings_multiples = 1 if args.max_embeddings_multiples is None else args.max_embeddings_multiples
 
     for gen_iter in range(args.n_iter):
@@ -2785,6 +2817,7 @@ def main(args):
                         strength_1st,
                         ext.network_muls,
                         ext.num_sub_prompts,
+                        ext.loras,
                     )
                     batch_1st.append(BatchData(is_1st_latent, base, ext_1st))
 
@@ -2839,7 +2872,7 @@ def main(args):
             (
                 return_latents,
                 (step_first, _, _, _, init_image, mask_image, _, guide_image),
-                (width, height, steps, scale, negative_scale, strength, network_muls, num_sub_prompts),
+                (width, height, steps, scale, negative_scale, strength, network_muls, num_sub_prompts, loras),
             ) = batch[0]
             noise_shape = (LATENT_CHANNELS, height // DOWNSAMPLING_FACTOR, width // DOWNSAMPLING_FACTOR)
 
@@ -2945,6 +2978,13 @@ def main(args):
                         n.pre_calculation()
                     print("pre-calculation... done")
 
+            if lora_registry is not None:
+                # サーバーモード：ジョブのLoRAを適用する / apply LoRAs of the jobs in server mode
+                with server.lora_lock:  # get_stats of the server reads the registry from the HTTP thread
+                    swap_time = lora_registry.set_loras(loras or {})
+                if swap_time > 0.001:
+                    print(f"LoRAs are changed in {swap_time * 1000:.1f}ms: {loras}")
+
             images = pipe(
                 prompts,
                 negative_prompts,
@@ -2995,11 +3035,13 @@ def main(args):
                     else:
                         fln = os.path.splitext(os.path.basename(init_images.filename))[0] + ".png"
                 elif args.sequential_file_name:
-                    fln = f"im_{highres_prefix}{step_first + i + 1:06d}.png"
+                    fln = f"im_{highres_prefix}{batch[i].base.step + 1:06d}.png"
                 else:
                     fln = f"im_{ts_str}_{highres_prefix}{i:03d}_{seed}.png"
 
                 image.save(os.path.join(args.outdir, fln), pnginfo=metadata)
+                if server is not None and not highres_1st:
+                    server.complete(batch[i].base.step, os.path.join(args.outdir, fln))
 
             if not args.no_preview and not highres_1st and args.interactive:
                 try:
@@ -3014,12 +3056,53 @@ def main(args):
 
             return images
 
+        def flush_batch(batch: List[BatchData], highres_fix):
+            gen_stats["batches"] += 1
+            gen_stats["images"] += len(batch)
+            if server is None:
+                return process_batch(batch, highres_fix)
+
+            # サーバーモードではエラーをジョブに返して続行する / in server mode, report the error to the jobs and continue
+            try:
+                images = process_batch(batch, highres_fix)
+                server.batch_processed(len(batch))
+                return images
+            except Exception as e:
+                print(f"failed to generate images / 画像の生成に失敗しました: {e}")
+                server.fail([bd.base.step for bd in batch], str(e))
+                return [None]
+
+        # 同じBatchDataExtのプロンプトをまとめてバッチにする / group prompts with the same BatchDataExt into batches
+        # prompts are read in windows of batch_grouping_window prompts (all prompts if 0). a group is processed when it is
+        # full, and the rest of the groups at the end of the window, in the order of their first prompts. the seeds and the
+        # noises are decided for each prompt, so the images are same as without grouping
+        grouped_batches = None
+        if args.batch_grouping_window is not None and len(prompt_list) > 0 and server is None:
+            if guide_images is None and (args.clip_image_guidance_scale > 0 or args.vgg16_guidance_scale > 0):
+                print("batch grouping is disabled for guidance with previous image / 直前の画像によるガイドのためバッチのグループ化は無効です")
+            else:
+                grouped_batches = {}
+        window_size = len(prompt_list) if not args.batch_grouping_window else args.batch_grouping_window
+
+        def flush_grouped_batches():
+            for grouped_batch in grouped_batches.values():
+                flush_batch(grouped_batch, highres_fix)
+            grouped_batches.clear()
+
         # 画像生成のプロンプトが一周するまでのループ
         prompt_index = 0
         global_step = 0
         batch_data = []
-        while args.interactive or prompt_index < len(prompt_list):
-            if len(prompt_list) == 0:
+        while args.interactive or prompt_index < len(prompt_list) or server is not None:
+            job = None
+            if server is not None:
+                # wait for a job if there is no batch, or process the batch if no prompt is waiting
+                job, raw_prompt = server.get_prompt(block=len(batch_data) == 0)
+                if raw_prompt is None:
+                    flush_batch(batch_data, highres_fix)
+                    batch_data.clear()
+                    continue
+            elif len(prompt_list) == 0:
                 # interactive
                 valid = False
                 while not valid:
@@ -3209,28 +3292,59 @@ def main(args):
                         strength,
                         tuple(network_muls) if network_muls else None,
                         num_sub_prompts,
+                        job.loras if job is not None else None,
                     ),
                 )
+                if grouped_batches is not None:
+                    grouped_batch = grouped_batches.setdefault(b1.ext, [])
+                    grouped_batch.append(b1)
+                    if len(grouped_batch) == args.batch_size:
+                        flush_batch(grouped_batch, highres_fix)
+                        del grouped_batches[b1.ext]
+
+                    global_step += 1
+                    continue
+
                 if len(batch_data) > 0 and batch_data[-1].ext != b1.ext:  # バッチ分割必要？
-                    process_batch(batch_data, highres_fix)
+                    flush_batch(batch_data, highres_fix)
                     batch_data.clear()
 
+                if job is not None:
+                    server.add_image(job, global_step)
                 batch_data.append(b1)
                 if len(batch_data) == args.batch_size:
-                    prev_image = process_batch(batch_data, highres_fix)[0]
+                    prev_image = flush_batch(batch_data, highres_fix)[0]
                     batch_data.clear()
 
                 global_step += 1
 
             prompt_index += 1
+            if grouped_batches is not None and prompt_index % window_size == 0:
+                flush_grouped_batches()
 
+        if grouped_batches is not None:
+            flush_grouped_batches()
         if len(batch_data) > 0:
-            process_batch(batch_data, highres_fix)
+            flush_batch(batch_data, highres_fix)
             batch_data.clear()
 
+    elapsed = time.perf_counter() - gen_start_time
+    if gen_stats["images"] > 0:
+        print(
+            f"generated {gen_stats['images']} images in {gen_stats['batches']} batches"
+            + f" (mean batch size {gen_stats['images'] / gen_stats['batches']:.2f}) in {elapsed:.1f}s,"
+            + f" {gen_stats['images'] / elapsed:.2f} images/s / {gen_stats['images']}枚の画像を生成しました"
+        )
     print("done!")
 
 
+def non_negative_int(value: str) -> int:
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be 0 or greater / 0以上である必要があります: {value}")
+    return number
+
+
 def setup_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
 
@@ -3248,12 +3362,32 @@ def setup_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--no_preview", action="store_true", help="do not show generated image in interactive mode / 対話モードで画像を表示しない"
     )
+    parser.add_argument(
+        "--server",
+        action="store_true",
+        help="server mode, keep the models loaded and accept prompts over HTTP (POST /generate) / サーバーモード、モデルを読み込んだままHTTPでプロンプトを受け付ける",
+    )
+    parser.add_argument("--server_host", type=str, default="127.0.0.1", help="host for server mode / サーバーモードのホスト")
+    parser.add_argument("--server_port", type=int, default=8860, help="port for server mode / サーバーモードのポート")
+    parser.add_argument(
+        "--server_lora_cache_mb",
+        type=float,
+        default=1024,
+        help="memory budget (MB) of LoRAs of the jobs kept on the device in server mode / サーバーモードでデバイスに保持するジョブのLoRAのメモリ上限（MB）",
+    )
     parser.add_argument(
         "--image_path", type=str, default=None, help="image to inpaint or to generate from / img2imgまたはinpaintを行う元画像"
     )
     parser.add_argument("--mask_path", type=str, default=None, help="mask in inpainting / inpaint時のマスク")
     parser.add_argument("--strength", type=float, default=None, help="img2img strength / img2img時のstrength")
     parser.add_argument("--images_per_prompt", type=int, default=1, help="number of images per prompt / プロンプトあたりの出力枚数")
+    parser.add_argument(
+        "--batch_grouping_window",
+        type=non_negative_int,
+        default=None,
+        help="group prompts with same size, steps, scale etc. into full batches within this number of prompts (0 for all prompts)"
+        + " / この数のプロンプトの中で、サイズやステップ数などが同じプロンプトをまとめてバッチにする（0で全プロンプト）",
+    )
     parser.add_argument("--outdir", type=str, default="outputs", help="dir to write results to / 生成画像の出力先")
     parser.add_argument("--sequential_file_name", action="store_true", help="sequential output file name / 生成画像のファイル名を連番にする")
     parser.add_argument(
@@ -3364,6 +3498,12 @@ def setup_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--network_pre_calc", action="store_true", help="pre-calculate network for generation / ネットワークのあらかじめ計算して生成する"
     )
+    parser.add_argument(
+        "--network_fuse",
+        action="store_true",
+        help="fuse multiple LoRAs (without merge) into one down/up for each module for faster generation, multipliers can be changed"
+        + " / 複数のLoRAをモジュールごとに1つのdown/upにまとめて高速に生成する、倍率は変更可能",
+    )
     parser.add_argument(
         "--textual_inversion_embeddings",
         type=str,
@@ -0,0 +1,122 @@
+# 学習中のモデルの保存をバックグラウンドで行う / save checkpoints in background during training
+#
+# the weights are copied to (pinned) CPU memory on the training thread, which takes a fraction of a second, and the
+# conversion, hashing, writing, uploading and removal of old checkpoints run in a writer thread while training continues.
+# the jobs run in order, so an old checkpoint is removed only after the new one is written. if the writer is behind by
+# max_pending saves, the next save waits for it (back-pressure), so at most max_pending + 1 snapshots are in memory.
+
+import atexit
+import os
+import queue
+import threading
+from typing import Callable, Dict, Optional
+
+import torch
+
+
+def snapshot_state_dict(state_dict: Dict[str, torch.Tensor], dtype: Optional[torch.dtype] = None) -> Dict[str, torch.Tensor]:
+    r"""
+    returns a copy of the state dict in CPU memory. floating point tensors are converted to dtype (on their device, to
+    reduce the transfer). the memory is pinned if CUDA is available, so the copies from GPU are asynchronous
+    """
+    pin_memory = torch.cuda.is_available()
+    snapshot = {}
+    for key, value in state_dict.items():
+        value = value.detach()
+        if dtype is not None and value.is_floating_point():
+            value = value.to(dtype)
+        cpu_value = torch.empty(value.size(), dtype=value.dtype, device="cpu", pin_memory=pin_memory)
+        cpu_value.copy_(value, non_blocking=pin_memory)
+        snapshot[key] = cpu_value
+
+    if pin_memory:
+        torch.cuda.synchronize()  # wait for the copies before training updates the weights
+    return snapshot
+
+
+class StateDictSnapshot:
+    r"""
+    copy of the state dict of a module. can be passed to the save functions instead of the module, they call only state_dict()
+    """
+
+    def __init__(self, module: torch.nn.Module, dtype: Optional[torch.dtype] = None) -> None:
+        self.snapshot = snapshot_state_dict(module.state_dict(), dtype)
+
+    def state_dict(self) -> Dict[str, torch.Tensor]:
+        return self.snapshot
+
+
+def save_state_dict(file: str, state_dict: Dict[str, torch.Tensor], metadata: Optional[Dict[str, str]]) -> None:
+    # same as save_weights of the networks / networkのsave_weightsと同じ形式で保存する
+    if metadata is not None and len(metadata) == 0:
+        metadata = None
+
+    if os.path.splitext(file)[1] == ".safetensors":
+        from library import safetensors_utils
+
+        safetensors_utils.save_file(state_dict, file, metadata, add_hashes=True)
+    else:
+        torch.save(state_dict, file)
+
+
+def has_builtin_save_weights(network: torch.nn.Module) -> bool:
+    r"""
+    returns True if save_weights of the network is the one of lora, dylora or lora_fa, which writes the same file as
+    save_state_dict. other network modules (LyCORIS etc.) may have their own save_weights
+    """
+    from networks import dylora, lora, lora_fa
+
+    builtin_save_weights = [lora.LoRANetwork.save_weights, dylora.DyLoRANetwork.save_weights, lora_fa.LoRANetwork.save_weights]
+    return getattr(type(network), "save_weights", None) in builtin_save_weights
+
+
+class CheckpointWriter:
+    def __init__(self, max_pending: int = 1) -> None:
+        self.jobs = queue.Queue(maxsize=max(max_pending, 1))
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)  # do not lose the checkpoints in the queue when the script ends
+
+    def run(self) -> None:
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                func, args, kwargs = job
+                func(*args, **kwargs)
+            except BaseException as e:
+                self.error = e
+                print("===========================================")
+                print(f"failed to save checkpoint in background / チェックポイントのバックグラウンドでの保存に失敗しました : {e}")
+                print("===========================================")
+            finally:
+                self.jobs.task_done()
+
+    def check_error(self) -> None:
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("failed to save checkpoint in background / チェックポイントの保存に失敗しました") from error
+
+    def submit(self, func: Callable, *args, **kwargs) -> None:
+        r"""
+        runs func(*args, **kwargs) in the writer thread. blocks if max_pending jobs are waiting
+        """
+        self.check_error()
+        self.jobs.put((func, args, kwargs))
+
+    def flush(self) -> None:
+        r"""
+        waits until all submitted jobs are finished
+        """
+        if self.thread.is_alive():
+            self.jobs.join()
+        self.check_error()
+
+    def close(self) -> None:
+        if not self.thread.is_alive():
+            return
+        self.flush()
+        self.jobs.put(None)
+        self.thread.join()
@@ -63,6 +63,7 @@ class BaseSubsetParams:
   caption_tag_dropout_rate: float = 0.0
   token_warmup_min: int = 1
   token_warmup_step: float = 0
+  cache_info: bool = False
 
 @dataclass
 class DreamBoothSubsetParams(BaseSubsetParams):
@@ -163,6 +164,7 @@ class ConfigSanitizer:
     "token_warmup_step": Any(float,int),
     "caption_prefix": str,
     "caption_suffix": str,
+    "cache_info": bool,
   }
   # DO means DropOut
   DO_SUBSET_ASCENDABLE_SCHEMA = {
@@ -471,6 +473,7 @@ def generate_dataset_group_by_blueprint(dataset_group_blueprint: DatasetGroupBlu
           random_crop: {subset.random_crop}
           token_warmup_min: {subset.token_warmup_min},
           token_warmup_step: {subset.token_warmup_step},
+          cache_info: {subset.cache_info}
       """), "  ")
 
       if is_dreambooth:
@@ -0,0 +1,176 @@
+# gen_img_diffusers / sdxl_gen_img のサーバーモード：モデルを読み込んだまま、HTTPでプロンプトを受け付けて画像を生成する
+# server mode of gen_img_diffusers and sdxl_gen_img: the models and the pipeline are kept loaded, and prompt jobs are
+# accepted over HTTP. a job is a list of prompts with the same options as --from_file (--w, --h, --s, --d, --n, ...)
+# and optionally LoRAs to apply (path -> multiplier, with networks.lora_registry). the generation loop takes the prompts
+# of the jobs in order, and prompts from different jobs with the same BatchDataExt are processed in one batch. a batch is
+# processed when it is full or no prompt is waiting.
+#
+#   POST /generate  {"prompts": ["a cat --w 512 --h 768 --d 1", ...], "loras": {"path/to/lora.safetensors": 0.8}}
+#                   -> {"images": ["/outdir/im_....png", ...]} when all images of the job are saved
+#   GET  /stats     -> number of jobs, images, batches, mean batch size, and LoRA registry stats
+
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+
+class GenerationJob:
+    def __init__(self, prompts: List[str], loras: Optional[Dict[str, float]] = None) -> None:
+        self.prompts = prompts
+        self.loras = tuple(sorted(loras.items())) if loras else None  # hashable, a part of BatchDataExt
+        self.images: List[str] = []
+        self.error: Optional[str] = None
+        self.pending = 0  # number of images not saved yet
+        self.submitted = False  # all prompts are added to the batches
+        self.done = threading.Event()
+        self.created_at = time.perf_counter()
+
+
+class GenerationServer:
+    def __init__(self, host: str, port: int) -> None:
+        self.jobs: "queue.Queue[GenerationJob]" = queue.Queue()
+        self.current_job: Optional[GenerationJob] = None
+        self.prompt_index = 0
+        self.step_to_job: Dict[int, GenerationJob] = {}
+        self.lock = threading.Lock()
+        self.stats = {"jobs": 0, "images": 0, "batches": 0, "failed_jobs": 0}
+        self.lora_registry = None
+        self.lora_lock = threading.Lock()  # the generation loop changes the registry with this lock
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def send_json(self, code, data):
+                body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path != "/stats":
+                    self.send_json(404, {"error": "not found"})
+                    return
+                self.send_json(200, server.get_stats())
+
+            def do_POST(self):
+                if self.path != "/generate":
+                    self.send_json(404, {"error": "not found"})
+                    return
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+                    prompts = request["prompts"]
+                    prompts = [prompts] if isinstance(prompts, str) else prompts
+                    prompts = [p for p in prompts if len(p.strip().split(" --")[0].strip()) > 0]
+                    loras = {str(k): float(v) for k, v in request.get("loras", {}).items()}
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    self.send_json(400, {"error": f"invalid request: {e}"})
+                    return
+                if any(not path.endswith(".safetensors") for path in loras.keys()):
+                    self.send_json(400, {"error": "only .safetensors LoRAs are supported"})
+                    return
+                if len(prompts) == 0:
+                    self.send_json(400, {"error": "no prompt"})
+                    return
+
+                job = server.submit(prompts, loras)
+                job.done.wait()
+                if job.error is not None:
+                    self.send_json(500, {"error": job.error, "images": job.images})
+                else:
+                    self.send_json(200, {"images": job.images, "time": time.perf_counter() - job.created_at})
+
+            def log_message(self, format, *args):
+                pass  # the generation loop prints the prompts
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        print(f"generation server is running on http://{host}:{port}/ / 生成サーバーを起動しました")
+
+    def submit(self, prompts: List[str], loras: Optional[Dict[str, float]] = None) -> GenerationJob:
+        job = GenerationJob(prompts, loras)
+        with self.lock:
+            self.stats["jobs"] += 1
+        self.jobs.put(job)
+        return job
+
+    def get_prompt(self, block: bool) -> Tuple[Optional[GenerationJob], Optional[str]]:
+        r"""
+        returns the next prompt and its job. if no prompt is waiting, returns (None, None) without block, or waits for a job
+        """
+        while True:
+            if self.current_job is not None and self.prompt_index < len(self.current_job.prompts):
+                prompt = self.current_job.prompts[self.prompt_index]
+                self.prompt_index += 1
+                return self.current_job, prompt
+
+            if self.current_job is not None:
+                self.job_submitted(self.current_job)
+                self.current_job = None
+
+            try:
+                self.current_job = self.jobs.get(block=block)
+                self.prompt_index = 0
+            except queue.Empty:
+                return None, None
+
+    def add_image(self, job: GenerationJob, step: int) -> None:
+        # 生成する画像とジョブを対応付ける / step (global_step of BatchDataBase) of an image of the job
+        with self.lock:
+            job.pending += 1
+            self.step_to_job[step] = job
+
+    def job_submitted(self, job: GenerationJob) -> None:
+        with self.lock:
+            job.submitted = True
+            if job.pending == 0:
+                job.done.set()
+
+    def complete(self, step: int, file_name: str) -> None:
+        with self.lock:
+            job = self.step_to_job.pop(step, None)
+            if job is None:
+                return
+            job.images.append(file_name)
+            job.pending -= 1
+            self.stats["images"] += 1
+            if job.pending == 0 and job.submitted:
+                job.done.set()
+
+    def fail(self, steps: List[int], error: str) -> None:
+        with self.lock:
+            for step in steps:
+                job = self.step_to_job.pop(step, None)
+                if job is None:
+                    continue
+                if job.error is None:
+                    self.stats["failed_jobs"] += 1
+                job.error = error
+                job.pending -= 1
+                if job.pending == 0 and job.submitted:
+                    job.done.set()
+
+    def batch_processed(self, batch_size: int) -> None:
+        with self.lock:
+            self.stats["batches"] += 1
+            self.stats["batched_images"] = self.stats.get("batched_images", 0) + batch_size
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            stats = dict(self.stats)
+        stats["mean_batch_size"] = stats.pop("batched_images", 0) / stats["batches"] if stats["batches"] > 0 else 0.0
+        stats["waiting_jobs"] = self.jobs.qsize()
+        if self.lora_registry is not None:
+            with self.lora_lock:
+                stats["lora_registry"] = self.lora_registry.get_stats()
+        return stats
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -1,9 +1,13 @@
-from typing import Union, BinaryIO
+from typing import NamedTuple, Optional, Union, BinaryIO
 from huggingface_hub import HfApi
 from pathlib import Path
 import argparse
+import atexit
+import collections
 import os
-from library.utils import fire_in_thread
+import shutil
+import threading
+import time
 
 
 def exists_repo(repo_id: str, repo_type: str, revision: str = "main", token: str = None):
@@ -17,6 +21,194 @@ def exists_repo(repo_id: str, repo_type: str, revision: str = "main", token: str
         return False
 
 
+def create_repo_if_not_exists(api: HfApi, repo_id: str, repo_type: str, private: bool, token: str = None):
+    if not exists_repo(repo_id=repo_id, repo_type=repo_type, token=token):
+        try:
+            api.create_repo(repo_id=repo_id, repo_type=repo_type, private=private)
+        except Exception as e:  # とりあえずRepositoryNotFoundErrorは確認したが他にあると困るので
+            print("===========================================")
+            print(f"failed to create HuggingFace repo / HuggingFaceのリポジトリの作成に失敗しました : {e}")
+            print("===========================================")
+
+
+class UploadJob(NamedTuple):
+    repo_id: str
+    repo_type: str
+    src: Union[str, Path]
+    path_in_repo: Optional[str]
+    is_folder: bool
+
+
+def get_upload_size(src: Union[str, Path]) -> int:
+    if os.path.isdir(src):
+        return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(src) for f in files)
+    return os.path.getsize(src)
+
+
+class UploadScheduler:
+    r"""
+    uploads files and folders in worker threads, in the order of submission.
+    - at most max_pending uploads wait in the queue, submit blocks if the queue is full
+    - a waiting upload to the same path in the repo is replaced by the newer one, and an upload is skipped if the file
+      has been removed before it starts (e.g. an old checkpoint removed by --save_last_n_steps)
+    - failed uploads are retried with exponential backoff. the data of large files is sent in chunks by huggingface_hub,
+      and LFS objects which reached the hub in a failed attempt are not sent again
+    `api` is HfApi or an object with the same upload_file/upload_folder methods (e.g. LocalHubApi)
+    """
+
+    def __init__(self, api, num_workers: int = 1, max_pending: int = 4, max_retries: int = 3, retry_interval: float = 10.0):
+        self.api = api
+        self.max_pending = max(max_pending, 1)
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+
+        self.pending = collections.OrderedDict()  # (repo_id, repo_type, path_in_repo) -> UploadJob
+        self.num_active = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.stats = {"uploaded": 0, "failed": 0, "superseded": 0, "bytes": 0, "seconds": 0.0}
+
+        self.workers = [threading.Thread(target=self.run, daemon=True) for _ in range(max(num_workers, 1))]
+        for worker in self.workers:
+            worker.start()
+        atexit.register(self.close)  # finish the uploads in the queue when the script ends
+
+    def submit(self, job: UploadJob):
+        key = (job.repo_id, job.repo_type, job.path_in_repo if job.path_in_repo is not None else str(job.src))
+        with self.condition:
+            if key in self.pending:
+                print(f"upload of {self.pending[key].src} is superseded by {job.src} / 新しいファイルでアップロードを置き換えます")
+                del self.pending[key]
+                self.stats["superseded"] += 1
+            while len(self.pending) >= self.max_pending:
+                self.condition.wait()
+            self.pending[key] = job
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0 and not self.closed:
+                    self.condition.wait()
+                if len(self.pending) == 0:
+                    return
+                _, job = self.pending.popitem(last=False)
+                self.num_active += 1
+                self.condition.notify_all()
+
+            try:
+                self.upload(job)
+            finally:
+                with self.condition:
+                    self.num_active -= 1
+                    self.condition.notify_all()
+
+    def upload(self, job: UploadJob):
+        if not os.path.exists(job.src):
+            print(f"skip upload of removed file / 削除されたファイルのアップロードをスキップします: {job.src}")
+            with self.condition:
+                self.stats["superseded"] += 1
+            return
+
+        size = get_upload_size(job.src)
+        for attempt in range(self.max_retries + 1):
+            start_time = time.perf_counter()
+            try:
+                if job.is_folder:
+                    self.api.upload_folder(
+                        repo_id=job.repo_id, repo_type=job.repo_type, folder_path=job.src, path_in_repo=job.path_in_repo
+                    )
+                else:
+                    self.api.upload_file(
+                        repo_id=job.repo_id, repo_type=job.repo_type, path_or_fileobj=job.src, path_in_repo=job.path_in_repo
+                    )
+            except Exception as e:  # RuntimeErrorを確認済みだが他にあると困るので
+                if attempt < self.max_retries:
+                    interval = self.retry_interval * (2**attempt)
+                    print(f"failed to upload {job.src}, retry in {interval:.0f} s / アップロードに失敗しました、再試行します : {e}")
+                    time.sleep(interval)
+                    continue
+
+                print("===========================================")
+                print(f"failed to upload to HuggingFace / HuggingFaceへのアップロードに失敗しました : {job.src} : {e}")
+                print("===========================================")
+                with self.condition:
+                    self.stats["failed"] += 1
+                return
+
+            elapsed = time.perf_counter() - start_time
+            with self.condition:
+                self.stats["uploaded"] += 1
+                self.stats["bytes"] += size
+                self.stats["seconds"] += elapsed
+            print(f"uploaded {job.src}: {size / 1024**2:.1f} MB in {elapsed:.1f} s ({size / 1024**2 / max(elapsed, 1e-6):.1f} MB/s)")
+            return
+
+    def flush(self):
+        r"""
+        waits until all submitted uploads are finished
+        """
+        with self.condition:
+            while len(self.pending) > 0 or self.num_active > 0:
+                self.condition.wait()
+
+    def get_stats(self) -> dict:
+        r"""
+        returns the numbers of uploaded, failed and superseded uploads, total bytes, seconds and throughput (MB/s)
+        """
+        with self.condition:
+            stats = dict(self.stats)
+        stats["mb_per_sec"] = stats["bytes"] / 1024**2 / stats["seconds"] if stats["seconds"] > 0 else 0.0
+        return stats
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+
+class LocalHubApi:
+    r"""
+    stand-in for HfApi which copies the files to a local directory: {root}/{repo_type}/{repo_id}/{path_in_repo}.
+    for testing and dry runs of the uploads without the hub
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def get_path(self, repo_id, repo_type, path_in_repo):
+        return os.path.join(self.root, repo_type or "model", repo_id, (path_in_repo or "").lstrip("/"))
+
+    def upload_file(self, repo_id, repo_type, path_or_fileobj, path_in_repo):
+        dst = self.get_path(repo_id, repo_type, path_in_repo)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copyfile(path_or_fileobj, dst)
+
+    def upload_folder(self, repo_id, repo_type, folder_path, path_in_repo):
+        shutil.copytree(folder_path, self.get_path(repo_id, repo_type, path_in_repo), dirs_exist_ok=True)
+
+
+_upload_scheduler: Optional[UploadScheduler] = None
+
+
+def get_upload_scheduler(args: argparse.Namespace) -> UploadScheduler:
+    # --async_upload のアップロードを行うscheduler（プロセスで一つ）
+    global _upload_scheduler
+    if _upload_scheduler is None:
+        _upload_scheduler = UploadScheduler(
+            HfApi(token=args.huggingface_token),
+            num_workers=args.async_upload_workers,
+            max_pending=args.async_upload_max_pending,
+            max_retries=args.huggingface_upload_retries,
+        )
+    return _upload_scheduler
+
+
 def upload(
     args: argparse.Namespace,
     src: Union[str, Path, bytes, BinaryIO],
@@ -29,41 +221,41 @@ def upload(
     path_in_repo = args.huggingface_path_in_repo + dest_suffix if args.huggingface_path_in_repo is not None else None
     private = args.huggingface_repo_visibility is None or args.huggingface_repo_visibility != "public"
     api = HfApi(token=token)
-    if not exists_repo(repo_id=repo_id, repo_type=repo_type, token=token):
-        try:
-            api.create_repo(repo_id=repo_id, repo_type=repo_type, private=private)
-        except Exception as e:  # とりあえずRepositoryNotFoundErrorは確認したが他にあると困るので
-            print("===========================================")
-            print(f"failed to create HuggingFace repo / HuggingFaceのリポジトリの作成に失敗しました : {e}")
-            print("===========================================")
+    create_repo_if_not_exists(api, repo_id, repo_type, private, token)
 
     is_folder = (type(src) == str and os.path.isdir(src)) or (isinstance(src, Path) and src.is_dir())
 
-    def uploader():
-        try:
-            if is_folder:
-                api.upload_folder(
-                    repo_id=repo_id,
-                    repo_type=repo_type,
-                    folder_path=src,
-                    path_in_repo=path_in_repo,
-                )
-            else:
-                api.upload_file(
-                    repo_id=repo_id,
-                    repo_type=repo_type,
-                    path_or_fileobj=src,
-                    path_in_repo=path_in_repo,
-                )
-        except Exception as e:  # RuntimeErrorを確認済みだが他にあると困るので
-            print("===========================================")
-            print(f"failed to upload to HuggingFace / HuggingFaceへのアップロードに失敗しました : {e}")
-            print("===========================================")
+    if args.async_upload and isinstance(src, (str, Path)):
+        scheduler = get_upload_scheduler(args)
+        scheduler.submit(UploadJob(repo_id, repo_type, src, path_in_repo, is_folder))
+        if force_sync_upload:
+            scheduler.flush()  # wait for this and all previous uploads
+            stats = scheduler.get_stats()
+            print(
+                f"uploads: {stats['uploaded']} uploaded, {stats['failed']} failed, {stats['superseded']} superseded, "
+                + f"{stats['bytes'] / 1024**3:.2f} GB in {stats['seconds']:.0f} s ({stats['mb_per_sec']:.1f} MB/s)"
+            )
+        return
 
-    if args.async_upload and not force_sync_upload:
-        fire_in_thread(uploader)
-    else:
-        uploader()
+    try:
+        if is_folder:
+            api.upload_folder(
+                repo_id=repo_id,
+                repo_type=repo_type,
+                folder_path=src,
+                path_in_repo=path_in_repo,
+            )
+        else:
+            api.upload_file(
+                repo_id=repo_id,
+                repo_type=repo_type,
+                path_or_fileobj=src,
+                path_in_repo=path_in_repo,
+            )
+    except Exception as e:  # RuntimeErrorを確認済みだが他にあると困るので
+        print("===========================================")
+        print(f"failed to upload to HuggingFace / HuggingFaceへのアップロードに失敗しました : {e}")
+        print("===========================================")
 
 
 def list_dir(
@@ -0,0 +1,177 @@
+# decoded image cache in shared memory / デコード済み画像のRAMキャッシュ
+#
+# latentをキャッシュできない場合（color_aug、random_cropなど）、同じ画像が毎回デコードされるので、デコード（とリサイズ）済みの
+# uint8画像をRAMに保持する。DataLoaderのworker間で共有できるよう、データとインデックスは共有メモリに置く。
+#
+# layout:
+#   data shared memory  : image bytes, allocated first-fit, evicted least recently used first
+#   index shared memory : header (clock, hits, misses) + fixed number of entries (ENTRY_DTYPE)
+#
+# The cache is created in the main process before DataLoader workers start. Workers attach to the same shared memory
+# by name when the cache is pickled (spawn), or inherit it (fork). All access is guarded by a multiprocessing lock.
+
+import atexit
+import hashlib
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+ENTRY_DTYPE = np.dtype(
+    [
+        ("key", np.uint64),  # 0 means empty
+        ("offset", np.int64),
+        ("nbytes", np.int64),
+        ("height", np.int32),
+        ("width", np.int32),
+        ("channels", np.int32),
+        ("original_width", np.int32),
+        ("original_height", np.int32),
+        ("last_used", np.int64),
+    ]
+)
+HEADER_DTYPE = np.dtype([("clock", np.int64), ("hits", np.int64), ("misses", np.int64)])
+DEFAULT_MAX_ENTRIES = 65536
+
+
+def get_image_cache_key(key: str) -> int:
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") | 1  # never 0
+
+
+class SharedImageCache:
+    def __init__(self, max_bytes: int, max_entries: int = DEFAULT_MAX_ENTRIES) -> None:
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.lock = multiprocessing.Lock()
+
+        self.data_shm = shared_memory.SharedMemory(create=True, size=max_bytes)
+        self.index_shm = shared_memory.SharedMemory(
+            create=True, size=HEADER_DTYPE.itemsize + ENTRY_DTYPE.itemsize * max_entries
+        )
+        self.data_shm_name = self.data_shm.name
+        self.index_shm_name = self.index_shm.name
+        self.owner_pid = os.getpid()
+
+        self.attach()
+        self.header[0] = 0
+        self.entries[:] = 0
+        atexit.register(self.close)
+
+    def attach(self):
+        self.data = np.ndarray((self.max_bytes,), dtype=np.uint8, buffer=self.data_shm.buf)
+        self.header = np.ndarray((1,), dtype=HEADER_DTYPE, buffer=self.index_shm.buf)
+        self.entries = np.ndarray(
+            (self.max_entries,), dtype=ENTRY_DTYPE, buffer=self.index_shm.buf, offset=HEADER_DTYPE.itemsize
+        )
+
+    def __getstate__(self):
+        # 共有メモリは名前だけを渡して、worker側で開き直す
+        state = self.__dict__.copy()
+        for name in ["data_shm", "index_shm", "data", "header", "entries"]:
+            state[name] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data_shm = shared_memory.SharedMemory(name=self.data_shm_name)
+        self.index_shm = shared_memory.SharedMemory(name=self.index_shm_name)
+        self.attach()
+
+    def close(self):
+        if self.data_shm is None:
+            return
+        self.data = self.header = self.entries = None  # release views before closing
+        self.data_shm.close()
+        self.index_shm.close()
+        if os.getpid() == self.owner_pid:
+            self.data_shm.unlink()
+            self.index_shm.unlink()
+        self.data_shm = self.index_shm = None
+
+    def tick(self) -> int:
+        self.header["clock"] += 1
+        return int(self.header["clock"][0])
+
+    def find(self, key: int) -> Optional[int]:
+        (indices,) = np.nonzero(self.entries["key"] == key)
+        return int(indices[0]) if len(indices) > 0 else None
+
+    def get(self, key: str) -> Optional[Tuple[np.ndarray, Tuple[int, int]]]:
+        r"""
+        returns (image, original size (width, height)) or None if not cached. the image is a copy of the cached one
+        """
+        key = get_image_cache_key(key)
+        with self.lock:
+            index = self.find(key)
+            if index is None:
+                self.header["misses"] += 1
+                return None
+
+            entry = self.entries[index]
+            entry["last_used"] = self.tick()
+            self.header["hits"] += 1
+
+            offset, nbytes = int(entry["offset"]), int(entry["nbytes"])
+            shape = (int(entry["height"]), int(entry["width"]), int(entry["channels"]))
+            image = self.data[offset : offset + nbytes].reshape(shape).copy()  # copy under lock: may be evicted later
+            original_size = (int(entry["original_width"]), int(entry["original_height"]))
+        return image, original_size
+
+    def allocate(self, nbytes: int) -> Optional[Tuple[int, int]]:
+        # 空きエントリと、連続した空き領域を探す。なければLRUで追い出す。戻り値は (entry index, offset)
+        while True:
+            used = np.nonzero(self.entries["key"] != 0)[0]
+            if len(used) < self.max_entries:
+                offsets = self.entries["offset"][used]
+                order = np.argsort(offsets)
+                starts = np.concatenate([offsets[order], [self.max_bytes]])
+                ends = np.concatenate([[0], offsets[order] + self.entries["nbytes"][used][order]])
+                fits = np.nonzero(starts - ends >= nbytes)[0]
+                if len(fits) > 0:
+                    free_index = int(np.nonzero(self.entries["key"] == 0)[0][0])
+                    return free_index, int(ends[fits[0]])
+
+            if len(used) == 0:
+                return None
+            lru_index = used[np.argmin(self.entries["last_used"][used])]
+            self.entries[lru_index] = 0
+
+    def put(self, key: str, image: np.ndarray, original_size: Tuple[int, int]) -> bool:
+        if image.dtype != np.uint8 or image.ndim != 3 or image.nbytes > self.max_bytes:
+            return False
+
+        key = get_image_cache_key(key)
+        image = np.ascontiguousarray(image)
+        with self.lock:
+            if self.find(key) is not None:  # cached by another worker
+                return True
+
+            allocated = self.allocate(image.nbytes)
+            if allocated is None:
+                return False
+            index, offset = allocated
+
+            self.data[offset : offset + image.nbytes] = image.reshape(-1)
+            entry = self.entries[index]
+            entry["offset"] = offset
+            entry["nbytes"] = image.nbytes
+            entry["height"], entry["width"], entry["channels"] = image.shape
+            entry["original_width"], entry["original_height"] = original_size
+            entry["last_used"] = self.tick()
+            entry["key"] = key  # set key last
+        return True
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            used = self.entries["key"] != 0
+            return {
+                "images": int(used.sum()),
+                "bytes": int(self.entries["nbytes"][used].sum()),
+                "max_bytes": self.max_bytes,
+                "hits": int(self.header["hits"][0]),
+                "misses": int(self.header["misses"][0]),
+            }
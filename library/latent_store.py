@@ -0,0 +1,248 @@
+# sharded, memory-mapped latents cache / 画像ごとの.npzの代わりに、大きなshardファイルにlatentsをまとめてキャッシュする
+#
+# layout of cache directory:
+#   shard-{writer:02d}-{n:05d}.bin : raw latents, appended one after another (aligned)
+#   index-{writer:02d}.jsonl       : one json line per cached image, appended after the data is written
+#
+# The index is keyed by image key (absolute path) and bucket resolution. Later lines override earlier ones, so
+# re-caching an image only appends. Each writer (process) has its own shard and index files, so multiple processes
+# can cache into the same directory without locking.
+
+import glob
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+
+SHARD_FILE_NAME = "shard-{:02d}-{:05d}.bin"
+INDEX_FILE_NAME = "index-{:02d}.jsonl"
+DEFAULT_MAX_SHARD_SIZE = 1024**3  # 1GiB
+ALIGNMENT = 64
+
+
+# .npzのキャッシュ (train_util) と共通の変換 / conversions shared with the .npz caches of train_util
+def tensor_to_storage_array(tensor: torch.Tensor, storage_dtype: Optional[str] = None) -> np.ndarray:
+    # numpyにはbfloat16がないので、bfloat16はビット列をint16として保存する
+    tensor = tensor.detach().cpu()
+    if storage_dtype is None or storage_dtype == "float32":
+        return tensor.float().numpy()
+    if storage_dtype == "float16":
+        return tensor.half().numpy()
+    if storage_dtype == "bfloat16":
+        return tensor.bfloat16().view(torch.int16).numpy()
+    raise ValueError(f"unknown storage dtype / 不明な保存形式です: {storage_dtype}")
+
+
+def storage_array_to_tensor(array: np.ndarray, storage_dtype: Optional[str] = None) -> torch.Tensor:
+    # 保存形式にかかわらずfloat32のtensorを返す / always returns float32 tensor
+    tensor = torch.from_numpy(np.asarray(array))
+    if storage_dtype == "bfloat16":
+        tensor = tensor.view(torch.bfloat16)
+    return tensor.float()
+
+
+class ShardedLatentStore:
+    def __init__(self, cache_dir: str, writer_id: int = 0, max_shard_size: int = DEFAULT_MAX_SHARD_SIZE) -> None:
+        self.cache_dir = cache_dir
+        self.writer_id = writer_id
+        self.max_shard_size = max_shard_size
+
+        self.index: Dict[Tuple[str, Tuple[int, int]], dict] = None  # loaded lazily
+        self.mmaps: Dict[str, np.memmap] = {}
+
+        # writer state
+        self.shard_file = None
+        self.shard_name: str = None
+        self.index_file = None
+
+    def __getstate__(self):
+        # DataLoaderのworkerへ渡すときは、開いているファイルやmemmapは渡さない
+        state = self.__dict__.copy()
+        state["mmaps"] = {}
+        state["shard_file"] = None
+        state["shard_name"] = None
+        state["index_file"] = None
+        return state
+
+    # region index
+
+    def load_index(self):
+        index = {}
+        for index_path in sorted(glob.glob(os.path.join(glob.escape(self.cache_dir), "index-*.jsonl"))):
+            with open(index_path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 書き込み途中で中断された最後の行は無視する / ignore truncated last line
+                        print(f"ignore broken line in latents cache index: {index_path}")
+                        continue
+                    index[(entry["key"], tuple(entry["reso"]))] = entry
+        self.index = index
+
+    def get_entry(self, key: str, reso: Tuple[int, int]) -> Optional[dict]:
+        if self.index is None:
+            self.load_index()
+        entry = self.index.get((key, tuple(reso)))
+        if entry is None:
+            # 他のプロセスが書き込んだかもしれないので読み直す
+            self.load_index()
+            entry = self.index.get((key, tuple(reso)))
+        return entry
+
+    def is_cached(self, key: str, reso: Tuple[int, int], flip_aug: bool) -> bool:
+        if self.index is None:
+            self.load_index()
+        entry = self.index.get((key, tuple(reso)))
+        if entry is None:
+            return False
+        if flip_aug and entry["flipped_offset"] is None:
+            return False
+        return True
+
+    def __len__(self):
+        if self.index is None:
+            self.load_index()
+        return len(self.index)
+
+    # endregion
+
+    # region write
+
+    def open_next_shard(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        n = 0
+        while True:
+            shard_name = SHARD_FILE_NAME.format(self.writer_id, n)
+            shard_path = os.path.join(self.cache_dir, shard_name)
+            if not os.path.exists(shard_path) or os.path.getsize(shard_path) < self.max_shard_size:
+                break
+            n += 1
+
+        self.shard_name = shard_name
+        self.shard_file = open(shard_path, "ab")
+
+    def write_array(self, array: np.ndarray) -> int:
+        if self.shard_file is None or self.shard_file.tell() >= self.max_shard_size:
+            self.open_next_shard()
+
+        offset = self.shard_file.tell()
+        padding = (-offset) % ALIGNMENT
+        if padding > 0:
+            self.shard_file.write(b"\0" * padding)
+            offset += padding
+
+        self.shard_file.write(np.ascontiguousarray(array).tobytes())
+        return offset
+
+    def put(
+        self,
+        key: str,
+        reso: Tuple[int, int],
+        latents: torch.Tensor,
+        original_size: Tuple[int, int],
+        crop_ltrb: Tuple[int, int, int, int],
+        flipped_latents: Optional[torch.Tensor] = None,
+        storage_dtype: Optional[str] = None,
+    ):
+        dtype_name = storage_dtype or "float32"
+        latents = tensor_to_storage_array(latents, dtype_name)
+        offset = self.write_array(latents)
+        shard_name = self.shard_name  # flipped latents is written to the same shard
+        flipped_offset = None
+        if flipped_latents is not None:
+            flipped_offset = self.write_array(tensor_to_storage_array(flipped_latents, dtype_name))
+            if self.shard_name != shard_name:
+                # shardをまたいだ場合は両方とも新しいshardに書き直す / rewrite both to the new shard
+                offset = self.write_array(latents)
+                shard_name = self.shard_name
+        self.shard_file.flush()  # indexより先にデータを書き込む
+
+        entry = {
+            "key": key,
+            "reso": [int(reso[0]), int(reso[1])],
+            "shard": shard_name,
+            "dtype": dtype_name,
+            "shape": list(latents.shape),
+            "offset": offset,
+            "flipped_offset": flipped_offset,
+            "original_size": [int(x) for x in original_size],
+            "crop_ltrb": [int(x) for x in crop_ltrb],
+        }
+
+        if self.index_file is None:
+            self.index_file = open(os.path.join(self.cache_dir, INDEX_FILE_NAME.format(self.writer_id)), "at", encoding="utf-8")
+        self.index_file.write(json.dumps(entry) + "\n")
+        self.index_file.flush()
+
+        if self.index is None:
+            self.load_index()
+        self.index[(key, tuple(entry["reso"]))] = entry
+
+    def close(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+            self.shard_file = None
+        if self.index_file is not None:
+            self.index_file.close()
+            self.index_file = None
+
+    # endregion
+
+    # region read
+
+    def get_mmap(self, shard_name: str, end: int) -> np.memmap:
+        mm = self.mmaps.get(shard_name)
+        if mm is None or len(mm) < end:
+            # 書き込みでshardが伸びた場合はmapし直す / remap if the shard has grown since it was mapped
+            # mode="c" (copy-on-write) makes the array writable for torch.from_numpy without touching the file
+            mm = np.memmap(os.path.join(self.cache_dir, shard_name), dtype=np.uint8, mode="c")
+            self.mmaps[shard_name] = mm
+        return mm
+
+    def read_array(self, entry: dict, offset: int) -> torch.Tensor:
+        dtype_name = entry["dtype"]
+        dtype = np.dtype(np.int16 if dtype_name == "bfloat16" else dtype_name)
+        shape = entry["shape"]
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        mm = self.get_mmap(entry["shard"], offset + nbytes)
+        array = mm[offset : offset + nbytes].view(dtype).reshape(shape)
+        return storage_array_to_tensor(array, dtype_name)  # zero-copy for float32
+
+    # 戻り値は load_latents_from_disk と同じ: latents, (original width, original height), crop_ltrb, flipped latents
+    def get(
+        self, key: str, reso: Tuple[int, int]
+    ) -> Tuple[torch.Tensor, List[int], List[int], Optional[torch.Tensor]]:
+        entry = self.get_entry(key, reso)
+        if entry is None:
+            raise ValueError(f"latents are not cached in {self.cache_dir}: {key} {reso}")
+
+        latents = self.read_array(entry, entry["offset"])
+        flipped_latents = None
+        if entry["flipped_offset"] is not None:
+            flipped_latents = self.read_array(entry, entry["flipped_offset"])
+        return latents, entry["original_size"], entry["crop_ltrb"], flipped_latents
+
+    # endregion
+
+
+# 同じディレクトリに対して複数のdatasetが書き込む場合も、同じインスタンスを使う
+_stores: Dict[Tuple[str, int], ShardedLatentStore] = {}
+
+
+def get_latent_store(cache_dir: str, writer_id: int = 0) -> ShardedLatentStore:
+    key = (os.path.abspath(cache_dir), writer_id)
+    store = _stores.get(key)
+    if store is None:
+        store = ShardedLatentStore(cache_dir, writer_id)
+        _stores[key] = store
+    return store
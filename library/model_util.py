@@ -1,14 +1,19 @@
 # v1: split from train_db_fixed.py.
 # v2: support safetensors
 
+import functools
 import math
 import os
+from typing import Callable, Dict, Iterable, List, Optional
 import torch
 import diffusers
+from accelerate import init_empty_weights
+from accelerate.utils.modeling import set_module_tensor_to_device
 from transformers import CLIPTextModel, CLIPTokenizer, CLIPTextConfig, logging
 from diffusers import AutoencoderKL, DDIMScheduler, StableDiffusionPipeline  # , UNet2DConditionModel
-from safetensors.torch import load_file, save_file
+from safetensors.torch import load_file
 from library.original_unet import UNet2DConditionModel
+from library.safetensors_utils import LazyStateDict, save_file  # save_file writes tensor by tensor
 
 # DiffUsers版StableDiffusionのモデルパラメータ
 NUM_TRAIN_TIMESTEPS = 1000
@@ -557,6 +562,56 @@ def create_vae_diffusers_config():
     return config
 
 
+def create_text_encoder_config(v2):
+    if v2:
+        return CLIPTextConfig(
+            vocab_size=49408,
+            hidden_size=1024,
+            intermediate_size=4096,
+            num_hidden_layers=23,
+            num_attention_heads=16,
+            max_position_embeddings=77,
+            hidden_act="gelu",
+            layer_norm_eps=1e-05,
+            dropout=0.0,
+            attention_dropout=0.0,
+            initializer_range=0.02,
+            initializer_factor=1.0,
+            pad_token_id=1,
+            bos_token_id=0,
+            eos_token_id=2,
+            model_type="clip_text_model",
+            projection_dim=512,
+            torch_dtype="float32",
+            transformers_version="4.25.0.dev0",
+        )
+
+    # logging.set_verbosity_error()  # don't show annoying warning
+    # text_model = CLIPTextModel.from_pretrained("openai/clip-vit-large-patch14").to(device)
+    # logging.set_verbosity_warning()
+    # print(f"config: {text_model.config}")
+    return CLIPTextConfig(
+        vocab_size=49408,
+        hidden_size=768,
+        intermediate_size=3072,
+        num_hidden_layers=12,
+        num_attention_heads=12,
+        max_position_embeddings=77,
+        hidden_act="quick_gelu",
+        layer_norm_eps=1e-05,
+        dropout=0.0,
+        attention_dropout=0.0,
+        initializer_range=0.02,
+        initializer_factor=1.0,
+        pad_token_id=1,
+        bos_token_id=0,
+        eos_token_id=2,
+        model_type="clip_text_model",
+        projection_dim=768,
+        torch_dtype="float32",
+    )
+
+
 def convert_ldm_clip_checkpoint_v1(checkpoint):
     keys = list(checkpoint.keys())
     text_model_dict = {}
@@ -655,6 +710,59 @@ def convert_ldm_clip_checkpoint_v2(checkpoint, max_length):
 # convert_diffusers_to_original_stable_diffusion をコピーして修正している（ASL 2.0）
 
 
+class KeyConversionMap:
+    r"""
+    memoized, bidirectional key mapping of one architecture between Diffusers (source) and StableDiffusion (target) keys.
+    each key is converted by convert_key (or convert_key_back for the inverse) only once, and then looked up from dicts.
+    both directions share the cache, so the inverse of converted keys is available without convert_key_back
+    """
+
+    def __init__(self, convert_key: Callable[[str], str], convert_key_back: Optional[Callable[[str], str]] = None):
+        self.convert_key = convert_key
+        self.convert_key_back = convert_key_back
+        self.forward: Dict[str, str] = {}
+        self.backward: Dict[str, str] = {}
+
+    def to_target(self, key: str) -> str:
+        new_key = self.forward.get(key)
+        if new_key is None:
+            new_key = self.convert_key(key)
+            self.forward[key] = new_key
+            self.backward.setdefault(new_key, key)
+        return new_key
+
+    def to_source(self, key: str) -> str:
+        old_key = self.backward.get(key)
+        if old_key is None:
+            assert self.convert_key_back is not None, f"unknown key / 変換前のキーが不明です: {key}"
+            old_key = self.convert_key_back(key)
+            self.backward[key] = old_key
+            self.forward.setdefault(old_key, key)
+        return old_key
+
+    def convert(self, state_dict) -> dict:
+        return {self.to_target(k): v for k, v in state_dict.items()}
+
+    def convert_back(self, state_dict) -> dict:
+        return {self.to_source(k): v for k, v in state_dict.items()}
+
+    def check_round_trip(self, keys: Iterable[str]) -> List[str]:
+        r"""
+        returns the keys which are not restored by converting them forth and back, i.e. keys converted to the same key as
+        another key, or inconsistent with convert_key_back. empty if the conversion of the keys is lossless
+        """
+        failed = []
+        for key in keys:
+            new_key = self.to_target(key)
+            if self.convert_key_back is not None:
+                restored_key = self.convert_key_back(new_key)  # not cached, to check the function itself
+            else:
+                restored_key = self.to_source(new_key)
+            if restored_key != key:
+                failed.append(key)
+        return failed
+
+
 def conv_transformer_to_linear(checkpoint):
     keys = list(checkpoint.keys())
     tf_keys = ["proj_in.weight", "proj_out.weight"]
@@ -664,7 +772,7 @@ def conv_transformer_to_linear(checkpoint):
                 checkpoint[key] = checkpoint[key][:, :, 0, 0]
 
 
-def convert_unet_state_dict_to_sd(v2, unet_state_dict):
+def unet_conversion_maps():
     unet_conversion_map = [
         # (stable-diffusion, HF Diffusers)
         ("time_embed.0.weight", "time_embedding.linear_1.weight"),
@@ -737,22 +845,32 @@ def convert_unet_state_dict_to_sd(v2, unet_state_dict):
         sd_mid_res_prefix = f"middle_block.{2*j}."
         unet_conversion_map_layer.append((sd_mid_res_prefix, hf_mid_res_prefix))
 
+    return unet_conversion_map, unet_conversion_map_resnet, unet_conversion_map_layer
+
+
+@functools.lru_cache(maxsize=None)
+def get_unet_key_conversion_map() -> KeyConversionMap:
+    # SD1 and SD2 U-Nets have the same keys
+    unet_conversion_map, unet_conversion_map_resnet, unet_conversion_map_layer = unet_conversion_maps()
+    hf_to_sd = {hf_name: sd_name for sd_name, hf_name in unet_conversion_map}
+
     # buyer beware: this is a *brittle* function,
     # and correct output requires that all of these pieces interact in
     # the exact order in which I have arranged them.
-    mapping = {k: k for k in unet_state_dict.keys()}
-    for sd_name, hf_name in unet_conversion_map:
-        mapping[hf_name] = sd_name
-    for k, v in mapping.items():
-        if "resnets" in k:
+    def convert_key(key):
+        new_key = hf_to_sd.get(key, key)
+        if "resnets" in key:
             for sd_part, hf_part in unet_conversion_map_resnet:
-                v = v.replace(hf_part, sd_part)
-            mapping[k] = v
-    for k, v in mapping.items():
+                new_key = new_key.replace(hf_part, sd_part)
         for sd_part, hf_part in unet_conversion_map_layer:
-            v = v.replace(hf_part, sd_part)
-        mapping[k] = v
-    new_state_dict = {v: unet_state_dict[k] for k, v in mapping.items()}
+            new_key = new_key.replace(hf_part, sd_part)
+        return new_key
+
+    return KeyConversionMap(convert_key)
+
+
+def convert_unet_state_dict_to_sd(v2, unet_state_dict):
+    new_state_dict = get_unet_key_conversion_map().convert(unet_state_dict)
 
     if v2:
         conv_transformer_to_linear(new_state_dict)
@@ -821,42 +939,39 @@ def controlnet_conversion_map():
     return unet_conversion_map, unet_conversion_map_resnet, unet_conversion_map_layer
 
 
-def convert_controlnet_state_dict_to_sd(controlnet_state_dict):
+@functools.lru_cache(maxsize=None)
+def get_controlnet_key_conversion_map() -> KeyConversionMap:
     unet_conversion_map, unet_conversion_map_resnet, unet_conversion_map_layer = controlnet_conversion_map()
+    diffusers_to_sd = {diffusers_name: sd_name for sd_name, diffusers_name in unet_conversion_map}
+    sd_to_diffusers = {sd_name: diffusers_name for sd_name, diffusers_name in unet_conversion_map}
 
-    mapping = {k: k for k in controlnet_state_dict.keys()}
-    for sd_name, diffusers_name in unet_conversion_map:
-        mapping[diffusers_name] = sd_name
-    for k, v in mapping.items():
-        if "resnets" in k:
+    def convert_key(key):
+        new_key = diffusers_to_sd.get(key, key)
+        if "resnets" in key:
             for sd_part, diffusers_part in unet_conversion_map_resnet:
-                v = v.replace(diffusers_part, sd_part)
-            mapping[k] = v
-    for k, v in mapping.items():
+                new_key = new_key.replace(diffusers_part, sd_part)
         for sd_part, diffusers_part in unet_conversion_map_layer:
-            v = v.replace(diffusers_part, sd_part)
-        mapping[k] = v
-    new_state_dict = {v: controlnet_state_dict[k] for k, v in mapping.items()}
-    return new_state_dict
-
+            new_key = new_key.replace(diffusers_part, sd_part)
+        return new_key
 
-def convert_controlnet_state_dict_to_diffusers(controlnet_state_dict):
-    unet_conversion_map, unet_conversion_map_resnet, unet_conversion_map_layer = controlnet_conversion_map()
-
-    mapping = {k: k for k in controlnet_state_dict.keys()}
-    for sd_name, diffusers_name in unet_conversion_map:
-        mapping[sd_name] = diffusers_name
-    for k, v in mapping.items():
+    def convert_key_back(key):
+        new_key = sd_to_diffusers.get(key, key)
         for sd_part, diffusers_part in unet_conversion_map_layer:
-            v = v.replace(sd_part, diffusers_part)
-        mapping[k] = v
-    for k, v in mapping.items():
-        if "resnets" in v:
+            new_key = new_key.replace(sd_part, diffusers_part)
+        if "resnets" in new_key:
             for sd_part, diffusers_part in unet_conversion_map_resnet:
-                v = v.replace(sd_part, diffusers_part)
-            mapping[k] = v
-    new_state_dict = {v: controlnet_state_dict[k] for k, v in mapping.items()}
-    return new_state_dict
+                new_key = new_key.replace(sd_part, diffusers_part)
+        return new_key
+
+    return KeyConversionMap(convert_key, convert_key_back)
+
+
+def convert_controlnet_state_dict_to_sd(controlnet_state_dict):
+    return get_controlnet_key_conversion_map().convert(controlnet_state_dict)
+
+
+def convert_controlnet_state_dict_to_diffusers(controlnet_state_dict):
+    return get_controlnet_key_conversion_map().convert_back(controlnet_state_dict)
 
 
 # ================#
@@ -869,7 +984,7 @@ def reshape_weight_for_sd(w):
     return w.reshape(*w.shape, 1, 1)
 
 
-def convert_vae_state_dict(vae_state_dict):
+def vae_conversion_maps():
     vae_conversion_map = [
         # (stable-diffusion, HF Diffusers)
         ("nin_shortcut", "conv_shortcut"),
@@ -925,17 +1040,27 @@ def convert_vae_state_dict(vae_state_dict):
             ("proj_out.", "to_out.0."),
         ]
 
-    mapping = {k: k for k in vae_state_dict.keys()}
-    for k, v in mapping.items():
+    return vae_conversion_map, vae_conversion_map_attn
+
+
+@functools.lru_cache(maxsize=None)
+def get_vae_key_conversion_map() -> KeyConversionMap:
+    vae_conversion_map, vae_conversion_map_attn = vae_conversion_maps()
+
+    def convert_key(key):
+        new_key = key
         for sd_part, hf_part in vae_conversion_map:
-            v = v.replace(hf_part, sd_part)
-        mapping[k] = v
-    for k, v in mapping.items():
-        if "attentions" in k:
+            new_key = new_key.replace(hf_part, sd_part)
+        if "attentions" in key:
             for sd_part, hf_part in vae_conversion_map_attn:
-                v = v.replace(hf_part, sd_part)
-            mapping[k] = v
-    new_state_dict = {v: vae_state_dict[k] for k, v in mapping.items()}
+                new_key = new_key.replace(hf_part, sd_part)
+        return new_key
+
+    return KeyConversionMap(convert_key)
+
+
+def convert_vae_state_dict(vae_state_dict):
+    new_state_dict = get_vae_key_conversion_map().convert(vae_state_dict)
     weights_to_convert = ["q", "k", "v", "proj_out"]
     for k, v in new_state_dict.items():
         for weight_name in weights_to_convert:
@@ -965,7 +1090,9 @@ def load_checkpoint_with_text_encoder_conversion(ckpt_path, device="cpu"):
 
     if is_safetensors(ckpt_path):
         checkpoint = None
-        state_dict = load_file(ckpt_path)  # , device) # may causes error
+        # tensors are loaded from the file on access, so the whole checkpoint is not kept in memory
+        # テンソルはアクセス時に読み込むので、checkpoint全体をメモリに保持しない
+        state_dict = LazyStateDict(ckpt_path)  # , device) # may causes error
     else:
         checkpoint = torch.load(ckpt_path, map_location=device)
         if "state_dict" in checkpoint:
@@ -982,12 +1109,38 @@ def load_checkpoint_with_text_encoder_conversion(ckpt_path, device="cpu"):
                 key_reps.append((key, new_key))
 
     for key, new_key in key_reps:
-        state_dict[new_key] = state_dict[key]
-        del state_dict[key]
+        if isinstance(state_dict, LazyStateDict):
+            state_dict.rename(key, new_key)
+        else:
+            state_dict[new_key] = state_dict[key]
+            del state_dict[key]
 
     return checkpoint, state_dict
 
 
+# load state_dict without allocating new tensors
+def load_state_dict_on_device(model, state_dict, device, dtype=None):
+    # dtype will use the dtype of the model (fp32) as default, same as model.load_state_dict()
+    missing_keys = list(model.state_dict().keys() - state_dict.keys())
+    unexpected_keys = list(state_dict.keys() - model.state_dict().keys())
+
+    # similar to model.load_state_dict()
+    if not missing_keys and not unexpected_keys:
+        for k in list(state_dict.keys()):
+            # converted tensors may be views (e.g. conv to linear), make them contiguous as load_state_dict does
+            set_module_tensor_to_device(model, k, device, value=state_dict.pop(k).contiguous(), dtype=dtype)
+        return "<All keys matched successfully>"
+
+    # error_msgs
+    error_msgs: List[str] = []
+    if missing_keys:
+        error_msgs.insert(0, "Missing key(s) in state_dict: {}. ".format(", ".join('"{}"'.format(k) for k in missing_keys)))
+    if unexpected_keys:
+        error_msgs.insert(0, "Unexpected key(s) in state_dict: {}. ".format(", ".join('"{}"'.format(k) for k in unexpected_keys)))
+
+    raise RuntimeError("Error(s) in loading state_dict for {}:\n\t{}".format(model.__class__.__name__, "\n\t".join(error_msgs)))
+
+
 # TODO dtype指定の動作が怪しいので確認する text_encoderを指定形式で作れるか未確認
 def load_models_from_stable_diffusion_checkpoint(v2, ckpt_path, device="cpu", dtype=None, unet_use_linear_projection_in_v2=True):
     _, state_dict = load_checkpoint_with_text_encoder_conversion(ckpt_path, device)
@@ -996,73 +1149,32 @@ def load_models_from_stable_diffusion_checkpoint(v2, ckpt_path, device="cpu", dt
     unet_config = create_unet_diffusers_config(v2, unet_use_linear_projection_in_v2)
     converted_unet_checkpoint = convert_ldm_unet_checkpoint(v2, state_dict, unet_config)
 
-    unet = UNet2DConditionModel(**unet_config).to(device)
-    info = unet.load_state_dict(converted_unet_checkpoint)
+    # モデルはmeta deviceに作り（乱数での初期化をしない）、変換後のテンソルをそのままパラメータとして設定する
+    # build the models on the meta device without random init, and set the converted tensors as the parameters directly
+    with init_empty_weights():
+        unet = UNet2DConditionModel(**unet_config)
+    info = load_state_dict_on_device(unet, converted_unet_checkpoint, device)
     print("loading u-net:", info)
 
     # Convert the VAE model.
     vae_config = create_vae_diffusers_config()
     converted_vae_checkpoint = convert_ldm_vae_checkpoint(state_dict, vae_config)
 
-    vae = AutoencoderKL(**vae_config).to(device)
-    info = vae.load_state_dict(converted_vae_checkpoint)
+    with init_empty_weights():
+        vae = AutoencoderKL(**vae_config)
+    info = load_state_dict_on_device(vae, converted_vae_checkpoint, device)
     print("loading vae:", info)
 
     # convert text_model
     if v2:
         converted_text_encoder_checkpoint = convert_ldm_clip_checkpoint_v2(state_dict, 77)
-        cfg = CLIPTextConfig(
-            vocab_size=49408,
-            hidden_size=1024,
-            intermediate_size=4096,
-            num_hidden_layers=23,
-            num_attention_heads=16,
-            max_position_embeddings=77,
-            hidden_act="gelu",
-            layer_norm_eps=1e-05,
-            dropout=0.0,
-            attention_dropout=0.0,
-            initializer_range=0.02,
-            initializer_factor=1.0,
-            pad_token_id=1,
-            bos_token_id=0,
-            eos_token_id=2,
-            model_type="clip_text_model",
-            projection_dim=512,
-            torch_dtype="float32",
-            transformers_version="4.25.0.dev0",
-        )
-        text_model = CLIPTextModel._from_config(cfg)
-        info = text_model.load_state_dict(converted_text_encoder_checkpoint)
     else:
         converted_text_encoder_checkpoint = convert_ldm_clip_checkpoint_v1(state_dict)
 
-        # logging.set_verbosity_error()  # don't show annoying warning
-        # text_model = CLIPTextModel.from_pretrained("openai/clip-vit-large-patch14").to(device)
-        # logging.set_verbosity_warning()
-        # print(f"config: {text_model.config}")
-        cfg = CLIPTextConfig(
-            vocab_size=49408,
-            hidden_size=768,
-            intermediate_size=3072,
-            num_hidden_layers=12,
-            num_attention_heads=12,
-            max_position_embeddings=77,
-            hidden_act="quick_gelu",
-            layer_norm_eps=1e-05,
-            dropout=0.0,
-            attention_dropout=0.0,
-            initializer_range=0.02,
-            initializer_factor=1.0,
-            pad_token_id=1,
-            bos_token_id=0,
-            eos_token_id=2,
-            model_type="clip_text_model",
-            projection_dim=768,
-            torch_dtype="float32",
-        )
+    cfg = create_text_encoder_config(v2)
+    with init_empty_weights():
         text_model = CLIPTextModel._from_config(cfg)
-        info = text_model.load_state_dict(converted_text_encoder_checkpoint)
+    info = load_state_dict_on_device(text_model, converted_text_encoder_checkpoint, "cpu")
     print("loading text encoder:", info)
 
     return text_model, vae, unet
@@ -1197,6 +1309,10 @@ def save_stable_diffusion_checkpoint(
         vae_dict = convert_vae_state_dict(vae.state_dict())
         update_sd("first_stage_model.", vae_dict)
 
+    # load the weights not updated by the models (e.g. VAE if not given) from the file
+    if isinstance(state_dict, LazyStateDict):
+        state_dict = dict(state_dict.items())
+
     # Put together new checkpoint
     key_count = len(state_dict.keys())
     new_ckpt = {"state_dict": state_dict}
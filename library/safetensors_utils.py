@@ -0,0 +1,230 @@
+# safetensorsのファイルを全体をメモリに置かずに読み書きするためのユーティリティ
+# utilities to read and write safetensors files without having the whole file in memory
+#
+# load_file reads all tensors at once, and the merge/resize tools then convert every tensor to the merge dtype, so the
+# peak memory is (file size) x (number of files) + converted copies. LazyStateDict reads and converts a tensor only when
+# it is accessed, and does not keep it, so a tool which processes the state dict module by module keeps only the
+# tensors of the current module (and its own outputs) in memory.
+#
+# safetensors.torch.save/save_file copy every tensor to bytes before writing, and the model hashes for metadata were
+# calculated by serializing the whole model once more. save_file in this module writes tensor by tensor and calculates
+# the hashes while writing. The layout is the same as safetensors (0.3.x): 8 bytes header length, JSON header padded
+# with spaces to 8 bytes, then the tensors sorted by dtype alignment (descending) and name.
+
+from collections.abc import MutableMapping
+import hashlib
+import json
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import torch
+from safetensors import safe_open
+
+
+class _FileTensor(NamedTuple):
+    key: str  # key in the file
+
+
+class LazyStateDict(MutableMapping):
+    r"""
+    dict-like view of a safetensors file. tensors are read from the file (and converted to dtype) on every access and are
+    not cached. values set by the caller are kept in memory and override the file, and deleted keys are hidden.
+    `keys()`, `in` and `get_shape` do not read tensors.
+    """
+
+    def __init__(self, file_name: str, dtype: Optional[torch.dtype] = None, device: str = "cpu") -> None:
+        self.file_name = file_name
+        self.dtype = dtype
+        self.file = safe_open(file_name, framework="pt", device=device)
+        self.entries = {key: _FileTensor(key) for key in self.file.keys()}
+
+    def __getitem__(self, key: str):
+        value = self.entries[key]
+        if isinstance(value, _FileTensor):
+            value = self.file.get_tensor(value.key)
+            if self.dtype is not None:
+                value = value.to(self.dtype)
+        return value
+
+    def __setitem__(self, key: str, value) -> None:
+        self.entries[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        del self.entries[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self.entries
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.entries)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def rename(self, key: str, new_key: str) -> None:
+        # テンソルを読み込まずにキーを変更する / change the key without reading the tensor
+        self.entries[new_key] = self.entries.pop(key)
+
+    def get_shape(self, key: str) -> List[int]:
+        value = self.entries[key]
+        if isinstance(value, _FileTensor):
+            return list(self.file.get_slice(value.key).get_shape())
+        return list(value.size())
+
+    def metadata(self) -> Optional[dict]:
+        return self.file.metadata()
+
+
+# region writer
+
+SAFETENSORS_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+
+# order of dtypes in the data section (descending alignment) / データ部でのdtypeの並び順
+SAFETENSORS_DTYPE_ORDER = ["U64", "I64", "F64", "F32", "U32", "I32", "BF16", "F16", "U16", "I16", "I8", "U8", "BOOL"]
+
+# range of the file for the legacy hash of sd-webui-additional-networks
+LEGACY_HASH_OFFSET = 0x100000
+LEGACY_HASH_SIZE = 0x10000
+
+METADATA_KEY_MODEL_HASH = "sshs_model_hash"
+METADATA_KEY_LEGACY_HASH = "sshs_legacy_hash"
+METADATA_KEY_SAI_HASH = "modelspec.hash_sha256"
+METADATA_KEY_SAI_SPEC = "modelspec.sai_model_spec"
+
+
+def build_header(tensors: Dict[str, torch.Tensor], metadata: Optional[Dict[str, str]]) -> Tuple[bytes, List[str]]:
+    r"""
+    returns the header (including the 8 bytes length) and the order of the keys in the data section
+    """
+    keys = sorted(tensors.keys(), key=lambda k: (SAFETENSORS_DTYPE_ORDER.index(SAFETENSORS_DTYPES[tensors[k].dtype]), k))
+
+    header = {}
+    if metadata is not None:
+        header["__metadata__"] = metadata
+    offset = 0
+    for key in keys:
+        tensor = tensors[key]
+        nbytes = tensor.numel() * tensor.element_size()
+        header[key] = {
+            "dtype": SAFETENSORS_DTYPES[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + nbytes],
+        }
+        offset += nbytes
+
+    header_bytes = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * ((8 - len(header_bytes) % 8) % 8)
+    return len(header_bytes).to_bytes(8, "little") + header_bytes, keys
+
+
+def get_tensor_bytes(tensor: torch.Tensor):
+    # little endian bytes of the tensor without copying if the tensor is contiguous and on cpu. returns a numpy array
+    tensor = tensor.detach()
+    if tensor.device.type != "cpu":
+        tensor = tensor.to("cpu")
+    return tensor.contiguous().reshape(-1).view(torch.uint8).numpy()
+
+
+class SafetensorsHasher:
+    r"""
+    calculates the hashes from the data section of a safetensors file.
+    model hash: sha256 of the data section, same as addnet_hash_safetensors and modelspec.hash_sha256 (with "0x" prefix)
+    legacy hash: sha256 of [0x100000, 0x110000) of the file, written with `hash_header` (the header with ss_* metadata)
+    """
+
+    def __init__(self, hash_header: bytes) -> None:
+        self.sha256 = hashlib.sha256()
+        self.legacy_bytes = bytearray(hash_header[LEGACY_HASH_OFFSET : LEGACY_HASH_OFFSET + LEGACY_HASH_SIZE])
+        self.legacy_start = LEGACY_HASH_OFFSET - len(hash_header)  # in the data section, may be negative
+        self.offset = 0
+
+    def update(self, data) -> None:
+        self.sha256.update(data)
+
+        start = max(self.legacy_start - self.offset, 0)
+        end = min(self.legacy_start + LEGACY_HASH_SIZE - self.offset, len(data))
+        if start < end:
+            self.legacy_bytes += data[start:end].tobytes()
+        self.offset += len(data)
+
+    def get_hashes(self) -> Tuple[str, str, str]:
+        r"""
+        returns (model hash, legacy hash, sai hash)
+        """
+        model_hash = self.sha256.hexdigest()
+        legacy_hash = hashlib.sha256(self.legacy_bytes).hexdigest()[0:8]
+        return model_hash, legacy_hash, f"0x{model_hash}"
+
+
+def get_hash_metadata(metadata: Optional[Dict[str, str]]) -> Dict[str, str]:
+    # user metadata can be changed after training, so only ss_* metadata is used for the hashes
+    return {k: v for k, v in (metadata or {}).items() if k.startswith("ss_")}
+
+
+def calculate_hashes(tensors: Dict[str, torch.Tensor], metadata: Optional[Dict[str, str]]) -> Tuple[str, str, str]:
+    r"""
+    returns (model hash, legacy hash, sai hash) without writing a file
+    """
+    hash_header, keys = build_header(tensors, get_hash_metadata(metadata))
+    hasher = SafetensorsHasher(hash_header)
+    for key in keys:
+        hasher.update(get_tensor_bytes(tensors[key]))
+    return hasher.get_hashes()
+
+
+def save_file(
+    tensors: Dict[str, torch.Tensor], file_name: str, metadata: Optional[Dict[str, str]] = None, add_hashes: bool = False
+) -> Optional[Tuple[str, str, str]]:
+    r"""
+    writes tensors to a safetensors file one by one. compatible with safetensors.torch.save_file
+    if add_hashes is True, sshs_model_hash, sshs_legacy_hash (and modelspec.hash_sha256 if metadata has sai modelspec) are
+    calculated while writing and set to metadata (in place) and the file. returns (model hash, legacy hash, sai hash) then
+    """
+    if add_hashes:
+        # the hashes have fixed lengths, so write the header with placeholders first and overwrite it after the data
+        metadata = metadata if metadata is not None else {}
+        hasher = SafetensorsHasher(build_header(tensors, get_hash_metadata(metadata))[0])
+        metadata[METADATA_KEY_MODEL_HASH] = "0" * 64
+        metadata[METADATA_KEY_LEGACY_HASH] = "0" * 8
+        if METADATA_KEY_SAI_SPEC in metadata:
+            metadata[METADATA_KEY_SAI_HASH] = "0x" + "0" * 64
+    else:
+        hasher = None
+
+    header, keys = build_header(tensors, metadata)
+    with open(file_name, "wb") as f:
+        f.write(header)
+        for key in keys:
+            data = get_tensor_bytes(tensors[key])
+            f.write(data)
+            if hasher is not None:
+                hasher.update(data)
+
+        if hasher is None:
+            return None
+
+        model_hash, legacy_hash, sai_hash = hasher.get_hashes()
+        metadata[METADATA_KEY_MODEL_HASH] = model_hash
+        metadata[METADATA_KEY_LEGACY_HASH] = legacy_hash
+        if METADATA_KEY_SAI_HASH in metadata:
+            metadata[METADATA_KEY_SAI_HASH] = sai_hash
+
+        final_header, _ = build_header(tensors, metadata)
+        assert len(final_header) == len(header), "header length changed / ヘッダの長さが変わりました"
+        f.seek(0)
+        f.write(final_header)
+
+    return model_hash, legacy_hash, sai_hash
+
+
+# endregion
@@ -1,11 +1,12 @@
 # based on https://github.com/Stability-AI/ModelSpec
 import datetime
-import hashlib
 from io import BytesIO
 import os
 from typing import List, Optional, Tuple, Union
 import safetensors
 
+from library import safetensors_utils
+
 r"""
 # Metadata Example
 metadata = {
@@ -77,14 +78,8 @@ def load_bytes_in_safetensors(tensors):
 
 
 def precalculate_safetensors_hashes(state_dict):
-    # calculate each tensor one by one to reduce memory usage
-    hash_sha256 = hashlib.sha256()
-    for tensor in state_dict.values():
-        single_tensor_sd = {"tensor": tensor}
-        bytes_for_tensor = load_bytes_in_safetensors(single_tensor_sd)
-        hash_sha256.update(bytes_for_tensor)
-
-    return f"0x{hash_sha256.hexdigest()}"
+    # calculate each tensor one by one to reduce memory usage, in the order of the tensors in the file
+    return safetensors_utils.calculate_hashes(state_dict, None)[2]
 
 
 def update_hash_sha256(metadata: dict, state_dict: dict):
@@ -115,10 +110,8 @@ def build_metadata(
     metadata = {}
     metadata.update(BASE_METADATA)
 
-    # TODO メモリを消費せずかつ正しいハッシュ計算の方法がわかったら実装する
-    # if state_dict is not None:
-    # hash = precalculate_safetensors_hashes(state_dict)
-    # metadata["modelspec.hash_sha256"] = hash
+    # modelspec.hash_sha256 is calculated while writing the file by safetensors_utils.save_file(..., add_hashes=True)
+    # ハッシュはファイル書き込み時に計算する
 
     if sdxl:
         arch = ARCH_SD_XL_V1_BASE
@@ -0,0 +1,222 @@
+# 学習中のサンプル画像生成を別プロセスで行う / generate sample images in a separate process during training
+#
+# sample_images_common builds the pipeline, moves the VAE to the GPU and generates the images on the training process, so
+# the training stops until all prompts are done. with --sample_in_background, a worker process loads the base models once
+# and keeps the pipeline on --sample_device (another GPU, or the same GPU if there is enough VRAM). the training process
+# only copies the trained weights (the network, or the U-Net and Text Encoder(s) for fine tuning) to shared memory and
+# continues. the images are written to {output_dir}/sample with a manifest (manifest.jsonl, one line per image). if the
+# worker is behind by max_pending jobs, the next sampling waits for it (back-pressure).
+
+import atexit
+import importlib
+import json
+import os
+import queue
+import traceback
+from typing import Dict, Optional
+
+import torch
+import torch.multiprocessing as mp
+
+
+MANIFEST_FILE_NAME = "manifest.jsonl"
+
+
+def copy_state_dict(state_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    r"""
+    returns a copy of the state dict in shared CPU memory, so it is sent to the worker without another copy
+    """
+    copied = {}
+    for key, value in state_dict.items():
+        value = value.detach()
+        cpu_value = torch.empty(value.size(), dtype=value.dtype, device="cpu").share_memory_()
+        cpu_value.copy_(value)
+        copied[key] = cpu_value
+    return copied
+
+
+def load_models(args, is_sdxl: bool, weight_dtype):
+    # 学習スクリプトと同じ方法でベースモデルを読み込む / load the base models in the same way as the training scripts
+    from library import train_util
+
+    if is_sdxl:
+        from library import sdxl_model_util, sdxl_train_util
+
+        model_dtype = sdxl_train_util.match_mixed_precision(args, weight_dtype)
+        _, text_encoder1, text_encoder2, vae, unet, _, _ = sdxl_train_util._load_target_model(
+            args.pretrained_model_name_or_path,
+            args.vae,
+            sdxl_model_util.MODEL_VERSION_SDXL_BASE_V1_0,
+            weight_dtype,
+            "cpu",
+            model_dtype,
+        )
+        tokenizer = sdxl_train_util.load_tokenizers(args)
+        text_encoder = [text_encoder1, text_encoder2]
+    else:
+        text_encoder, vae, unet, _ = train_util._load_target_model(args, weight_dtype, "cpu")
+        tokenizer = train_util.load_tokenizer(args)
+
+    if getattr(args, "network_module", None) is not None and getattr(args, "base_weights", None) is not None:
+        # base_weights が指定されている場合は、学習時と同じく重みをマージする
+        network_module = importlib.import_module(args.network_module)
+        for i, weight_path in enumerate(args.base_weights):
+            if args.base_weights_multiplier is None or len(args.base_weights_multiplier) <= i:
+                multiplier = 1.0
+            else:
+                multiplier = args.base_weights_multiplier[i]
+
+            module, weights_sd = network_module.create_network_from_weights(
+                multiplier, weight_path, vae, text_encoder, unet, for_inference=True
+            )
+            module.merge_to(text_encoder, unet, weights_sd, weight_dtype, "cpu")
+
+    return tokenizer, text_encoder, vae, unet
+
+
+class SampleGenerator:
+    r"""
+    keeps the models and the pipeline on the device, and generates the sample images with the trained weights of each job
+    """
+
+    def __init__(self, args, pipe_class, is_sdxl: bool, device: str) -> None:
+        from library import train_util
+
+        self.args = args
+        self.device = torch.device(device)
+        self.weight_dtype, _ = train_util.prepare_dtype(args)
+
+        print(f"loading models for sample images on {self.device} / サンプル画像生成用のモデルを読み込みます")
+        self.tokenizer, self.text_encoder, self.vae, self.unet = load_models(args, is_sdxl, self.weight_dtype)
+        self.text_encoders = self.text_encoder if isinstance(self.text_encoder, list) else [self.text_encoder]
+        self.network = None
+
+        for text_encoder in self.text_encoders:
+            text_encoder.to(self.device, dtype=self.weight_dtype).requires_grad_(False).eval()
+        self.unet.to(self.device, dtype=self.weight_dtype).requires_grad_(False).eval()
+        self.vae.to(self.device).requires_grad_(False).eval()  # VAE is kept in float, same as no_half_vae
+
+        self.pipeline = pipe_class(
+            text_encoder=self.text_encoder,
+            vae=self.vae,
+            unet=self.unet,
+            tokenizer=self.tokenizer,
+            scheduler=train_util.get_sample_scheduler(args),
+            safety_checker=None,
+            feature_extractor=None,
+            requires_safety_checker=False,
+            clip_skip=args.clip_skip,
+        )
+        self.pipeline.to(self.device)
+
+    def load_weights(self, state_dicts: Dict[str, Dict[str, torch.Tensor]]) -> None:
+        if "network" in state_dicts:
+            weights_sd = state_dicts["network"]
+            if self.network is None:
+                # create the network from the first weights and apply it to the models once
+                network_module = importlib.import_module(self.args.network_module)
+                self.network, _ = network_module.create_network_from_weights(
+                    1.0, None, self.vae, self.text_encoder, self.unet, weights_sd=weights_sd
+                )
+                apply_text_encoder = any(key.startswith("lora_te") for key in weights_sd.keys())
+                apply_unet = any(key.startswith("lora_unet") for key in weights_sd.keys())
+                self.network.apply_to(self.text_encoder, self.unet, apply_text_encoder, apply_unet)
+                self.network.requires_grad_(False).eval()
+            self.network.load_state_dict(weights_sd)
+            self.network.to(self.device, dtype=self.weight_dtype)
+            return
+
+        # fine tuning: the weights of the models are replaced
+        for i, text_encoder in enumerate(self.text_encoders):
+            if f"text_encoder{i}" in state_dicts:
+                text_encoder.load_state_dict(state_dicts[f"text_encoder{i}"])
+        self.unet.load_state_dict(state_dicts["unet"])
+
+    def generate(self, epoch: Optional[int], steps: int, state_dicts: Dict[str, Dict[str, torch.Tensor]]) -> None:
+        from library import train_util
+
+        args = self.args
+        if not os.path.isfile(args.sample_prompts):
+            print(f"No prompt file / プロンプトファイルがありません: {args.sample_prompts}")
+            return
+
+        print(f"\ngenerating sample images at step in background / サンプル画像生成 ステップ: {steps}")
+        self.load_weights(state_dicts)
+        prompts = train_util.load_sample_prompts(args)
+
+        def autocast():
+            return torch.autocast(self.device.type, dtype=self.weight_dtype, enabled=self.weight_dtype != torch.float32)
+
+        records = train_util.generate_sample_images(self.pipeline, args, epoch, steps, prompts, autocast)
+
+        with open(os.path.join(args.output_dir, "sample", MANIFEST_FILE_NAME), "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def run_worker(args, pipe_class, is_sdxl: bool, device: str, jobs, done) -> None:
+    generator = SampleGenerator(args, pipe_class, is_sdxl, device)
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+
+        epoch, steps, state_dicts = job
+        try:
+            generator.generate(epoch, steps, state_dicts)
+        except Exception as e:
+            traceback.print_exc()
+            print(f"failed to generate sample images in background / サンプル画像の生成に失敗しました : {e}")
+        del state_dicts, job  # release the shared memory
+        done.put(steps)
+
+
+class SampleWorker:
+    def __init__(self, args, pipe_class, is_sdxl: bool, device: str) -> None:
+        sample_device = args.sample_device if args.sample_device is not None else device
+        context = mp.get_context("spawn")  # CUDA and fork do not work together
+        self.jobs = context.Queue(maxsize=max(args.sample_max_pending, 1))
+        self.done = context.Queue()
+        self.pending = 0
+        self.process = context.Process(
+            target=run_worker, args=(args, pipe_class, is_sdxl, sample_device, self.jobs, self.done), daemon=True
+        )
+        self.process.start()
+        atexit.register(self.close)  # wait for the samples in the queue when the script ends
+
+    def collect(self, block: bool) -> None:
+        while self.pending > 0:
+            try:
+                self.done.get(block=block, timeout=1 if block else None)
+                self.pending -= 1
+            except queue.Empty:
+                if not block:
+                    return
+                if not self.process.is_alive():
+                    print("sample image worker is stopped / サンプル画像生成のプロセスが終了しています")
+                    self.pending = 0
+                    return
+
+    def submit(self, epoch: Optional[int], steps: int, state_dicts: Dict[str, Dict[str, torch.Tensor]]) -> None:
+        r"""
+        sends the job to the worker. blocks if max_pending jobs are waiting
+        """
+        self.collect(block=False)
+        if not self.process.is_alive():
+            print("sample image worker is stopped, sampling is skipped / サンプル画像生成のプロセスが終了しているため、生成しません")
+            return
+        self.jobs.put((epoch, steps, state_dicts))
+        self.pending += 1
+
+    def flush(self) -> None:
+        r"""
+        waits until all submitted jobs are finished
+        """
+        self.collect(block=True)
+
+    def close(self) -> None:
+        if not self.process.is_alive():
+            return
+        self.flush()
+        self.jobs.put(None)
+        self.process.join()
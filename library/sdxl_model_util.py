@@ -1,12 +1,13 @@
+import functools
+
 import torch
 from accelerate import init_empty_weights
-from accelerate.utils.modeling import set_module_tensor_to_device
-from safetensors.torch import load_file, save_file
+from safetensors.torch import load_file
 from transformers import CLIPTextModel, CLIPTextConfig, CLIPTextModelWithProjection, CLIPTokenizer
-from typing import List
 from diffusers import AutoencoderKL, EulerDiscreteScheduler, UNet2DConditionModel
 from library import model_util
 from library import sdxl_original_unet
+from library.safetensors_utils import save_file  # save_file writes tensor by tensor
 
 
 VAE_SCALE_FACTOR = 0.13025
@@ -138,24 +139,7 @@ def convert_sdxl_text_encoder_2_checkpoint(checkpoint, max_length):
 
 # load state_dict without allocating new tensors
 def _load_state_dict_on_device(model, state_dict, device, dtype=None):
-    # dtype will use fp32 as default
-    missing_keys = list(model.state_dict().keys() - state_dict.keys())
-    unexpected_keys = list(state_dict.keys() - model.state_dict().keys())
-
-    # similar to model.load_state_dict()
-    if not missing_keys and not unexpected_keys:
-        for k in list(state_dict.keys()):
-            set_module_tensor_to_device(model, k, device, value=state_dict.pop(k), dtype=dtype)
-        return "<All keys matched successfully>"
-
-    # error_msgs
-    error_msgs: List[str] = []
-    if missing_keys:
-        error_msgs.insert(0, "Missing key(s) in state_dict: {}. ".format(", ".join('"{}"'.format(k) for k in missing_keys)))
-    if unexpected_keys:
-        error_msgs.insert(0, "Unexpected key(s) in state_dict: {}. ".format(", ".join('"{}"'.format(k) for k in unexpected_keys)))
-
-    raise RuntimeError("Error(s) in loading state_dict for {}:\n\t{}".format(model.__class__.__name__, "\n\t".join(error_msgs)))
+    return model_util.load_state_dict_on_device(model, state_dict, device, dtype)
 
 
 def load_models_from_sdxl_checkpoint(model_version, ckpt_path, map_location, dtype=None):
@@ -365,36 +349,39 @@ def make_unet_conversion_map():
     return unet_conversion_map
 
 
-def convert_diffusers_unet_state_dict_to_sdxl(du_sd):
+def convert_unet_key(src_key, conversion_map):
+    # さすがに全部回すのは時間がかかるので右から要素を削りつつprefixを探す
+    src_key_fragments = src_key.split(".")[:-1]  # remove weight/bias
+    while len(src_key_fragments) > 0:
+        src_key_prefix = ".".join(src_key_fragments) + "."
+        if src_key_prefix in conversion_map:
+            converted_prefix = conversion_map[src_key_prefix]
+            return converted_prefix + src_key[len(src_key_prefix) :]
+        src_key_fragments.pop(-1)
+    raise AssertionError(f"key {src_key} not found in conversion map")
+
+
+@functools.lru_cache(maxsize=None)
+def get_unet_key_conversion_map() -> model_util.KeyConversionMap:
     unet_conversion_map = make_unet_conversion_map()
+    hf_to_sd = {hf: sd for sd, hf in unet_conversion_map}
+    sd_to_hf = {sd: hf for sd, hf in unet_conversion_map}
+    return model_util.KeyConversionMap(
+        functools.partial(convert_unet_key, conversion_map=hf_to_sd),
+        functools.partial(convert_unet_key, conversion_map=sd_to_hf),
+    )
+
 
-    conversion_map = {hf: sd for sd, hf in unet_conversion_map}
-    return convert_unet_state_dict(du_sd, conversion_map)
+def convert_diffusers_unet_state_dict_to_sdxl(du_sd):
+    return get_unet_key_conversion_map().convert(du_sd)
 
 
 def convert_unet_state_dict(src_sd, conversion_map):
-    converted_sd = {}
-    for src_key, value in src_sd.items():
-        # さすがに全部回すのは時間がかかるので右から要素を削りつつprefixを探す
-        src_key_fragments = src_key.split(".")[:-1]  # remove weight/bias
-        while len(src_key_fragments) > 0:
-            src_key_prefix = ".".join(src_key_fragments) + "."
-            if src_key_prefix in conversion_map:
-                converted_prefix = conversion_map[src_key_prefix]
-                converted_key = converted_prefix + src_key[len(src_key_prefix) :]
-                converted_sd[converted_key] = value
-                break
-            src_key_fragments.pop(-1)
-        assert len(src_key_fragments) > 0, f"key {src_key} not found in conversion map"
-
-    return converted_sd
+    return {convert_unet_key(src_key, conversion_map): value for src_key, value in src_sd.items()}
 
 
 def convert_sdxl_unet_state_dict_to_diffusers(sd):
-    unet_conversion_map = make_unet_conversion_map()
-
-    conversion_dict = {sd: hf for sd, hf in unet_conversion_map}
-    return convert_unet_state_dict(sd, conversion_dict)
+    return get_unet_key_conversion_map().convert_back(sd)
 
 
 def convert_text_encoder_2_state_dict_to_sdxl(checkpoint, logit_scale):
@@ -7,7 +7,7 @@ import torch
 from accelerate import init_empty_weights
 from tqdm import tqdm
 from transformers import CLIPTokenizer
-from library import model_util, sdxl_model_util, train_util, sdxl_original_unet
+from library import checkpoint_writer, model_util, sdxl_model_util, train_util, sdxl_original_unet
 from library.sdxl_lpw_stable_diffusion import SdxlStableDiffusionLongPromptWeightingPipeline
 
 TOKENIZER1_PATH = "openai/clip-vit-large-patch14"
@@ -278,7 +278,16 @@ def save_sd_model_on_epoch_end_or_stepwise(
     logit_scale,
     ckpt_info,
 ):
-    def sd_saver(ckpt_file, epoch_no, global_step):
+    def sd_saver(
+        ckpt_file,
+        epoch_no,
+        global_step,
+        text_encoder1=text_encoder1,
+        text_encoder2=text_encoder2,
+        unet=unet,
+        vae=vae,
+        logit_scale=logit_scale,
+    ):
         sai_metadata = train_util.get_sai_model_spec(None, args, True, False, False, is_stable_diffusion_ckpt=True)
         sdxl_model_util.save_stable_diffusion_checkpoint(
             ckpt_file,
@@ -294,6 +303,16 @@ def save_sd_model_on_epoch_end_or_stepwise(
             save_dtype,
         )
 
+    def sd_snapshot():
+        # バックグラウンドで保存するため、重みをコピーする / copy the weights to save them in background
+        return {
+            "text_encoder1": checkpoint_writer.StateDictSnapshot(text_encoder1, save_dtype),
+            "text_encoder2": checkpoint_writer.StateDictSnapshot(text_encoder2, save_dtype),
+            "unet": checkpoint_writer.StateDictSnapshot(unet, save_dtype),
+            "vae": checkpoint_writer.StateDictSnapshot(vae, save_dtype),
+            "logit_scale": logit_scale.detach().clone().cpu() if logit_scale is not None else None,
+        }
+
     def diffusers_saver(out_dir):
         sdxl_model_util.save_diffusers_checkpoint(
             out_dir,
@@ -317,6 +336,7 @@ def save_sd_model_on_epoch_end_or_stepwise(
         global_step,
         sd_saver,
         diffusers_saver,
+        sd_snapshot,
     )
 
 
@@ -0,0 +1,145 @@
+# low-rank factorization shared by resize_lora, svd_merge_lora and extract_lora_from_models
+# LoRAの抽出・マージ・リサイズでは上位rank個の特異値・特異ベクトルしか使わないので、必要な分だけを計算する
+#
+# method:
+#   exact      : torch.linalg.svd (reduced). slow for large matrices on CPU
+#   randomized : randomized range finder with power iterations (Halko, Martinsson and Tropp, 2011)
+#   auto       : randomized if the rank of the matrix is known to be small (rank_bound, e.g. merged LoRA weights), else exact.
+#                in that case the range of the matrix is captured completely, so the result is exact up to rounding errors
+
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import multiprocessing
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+import torch
+from tqdm import tqdm
+
+
+SVD_METHODS = ["auto", "exact", "randomized"]
+DEFAULT_OVERSAMPLE = 10
+DEFAULT_NITER = 2
+
+
+def exact_svd(mat: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    return torch.linalg.svd(mat, full_matrices=False)
+
+
+def randomized_svd(
+    mat: torch.Tensor, num_components: int, niter: int = DEFAULT_NITER, seed: Optional[int] = 0
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    r"""
+    returns U (m, l), S (l), Vh (l, n) approximating the top l = num_components singular triplets of mat (m, n)
+    """
+    m, n = mat.shape
+    generator = torch.Generator(device=mat.device)
+    if seed is not None:
+        generator.manual_seed(seed)
+
+    # range finder: Q spans the range of mat @ omega, refined by power iterations with re-orthonormalization
+    omega = torch.randn(n, num_components, generator=generator, device=mat.device, dtype=mat.dtype)
+    q, _ = torch.linalg.qr(mat @ omega)
+    for _ in range(niter):
+        q, _ = torch.linalg.qr(mat.T @ q)
+        q, _ = torch.linalg.qr(mat @ q)
+
+    # SVD of the small matrix B = Q^T A
+    b = q.T @ mat
+    u_b, s, vh = torch.linalg.svd(b, full_matrices=False)
+    u = q @ u_b
+    return u, s, vh
+
+
+def truncated_svd(
+    mat: torch.Tensor,
+    rank: Optional[int],
+    method: str = "auto",
+    rank_bound: Optional[int] = None,
+    oversample: int = DEFAULT_OVERSAMPLE,
+    niter: int = DEFAULT_NITER,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, float]:
+    r"""
+    returns U (m, k), S (k), Vh (k, n) and the relative Frobenius error ||A - U diag(S) Vh|| / ||A|| of the result
+    k is rank, or all computed components if rank is None (all singular values for exact, rank_bound + oversample for randomized)
+    rank_bound: upper bound of the rank of mat if known (e.g. sum of the ranks of merged LoRAs)
+
+    the error is computed a posteriori from the singular values: U diag(S) Vh is an orthogonal projection of A, so
+    ||A - U diag(S) Vh||^2 = ||A||^2 - ||S||^2. this is an exact value (not an estimate) for the returned factors
+    """
+    assert method in SVD_METHODS, f"unknown svd method / 不明なSVDの方法です: {method}"
+    org_dtype = mat.dtype
+    if mat.dtype not in [torch.float32, torch.float64]:
+        mat = mat.float()  # SVD/QR do not support half precision
+
+    m, n = mat.shape
+    full_rank = min(m, n)
+    target_rank = rank if rank is not None else rank_bound
+
+    if method == "auto":
+        use_randomized = rank_bound is not None and rank_bound + oversample < full_rank
+        num_components = None if rank_bound is None else rank_bound + oversample
+    elif method == "randomized":
+        use_randomized = target_rank is not None and target_rank + oversample < full_rank
+        num_components = None if target_rank is None else target_rank + oversample
+    else:
+        use_randomized = False
+
+    if use_randomized:
+        U, S, Vh = randomized_svd(mat, num_components, niter)
+    else:
+        U, S, Vh = exact_svd(mat)
+
+    if rank is not None:
+        U = U[:, :rank]
+        S = S[:rank]
+        Vh = Vh[:rank, :]
+
+    mat_norm_sq = float(torch.sum(mat.pow(2)))
+    residual_sq = max(mat_norm_sq - float(torch.sum(S.pow(2))), 0.0)
+    error = (residual_sq / mat_norm_sq) ** 0.5 if mat_norm_sq > 0 else 0.0
+
+    return U.to(org_dtype), S.to(org_dtype), Vh.to(org_dtype), error
+
+
+# region worker pool
+
+# モジュールごとのSVDは独立しているので、複数のプロセスで並列に計算する
+# each worker uses a single thread, so the results are the same for any number of workers (>= 1)
+
+
+def init_svd_worker():
+    torch.set_num_threads(1)
+
+
+def map_modules(func: Callable, args_iter: Iterable[tuple], num_workers: int = 0, total: Optional[int] = None) -> Iterator:
+    r"""
+    yields func(*args) for each args in args_iter, in order
+    if num_workers > 0, func runs in spawned worker processes. func must be a top-level function and args must be picklable
+    (move tensors to cpu). at most num_workers * 2 tasks are in flight to bound memory usage
+    """
+    if num_workers <= 0:
+        for args in tqdm(args_iter, total=total):
+            yield func(*args)
+        return
+
+    max_pending = num_workers * 2
+    context = multiprocessing.get_context("spawn")  # CUDA and fork do not work together
+    with ProcessPoolExecutor(num_workers, mp_context=context, initializer=init_svd_worker) as executor, tqdm(
+        total=total
+    ) as pbar:
+        args_iter = iter(args_iter)
+        futures = collections.deque()
+        for args in itertools.islice(args_iter, max_pending):
+            futures.append(executor.submit(func, *args))
+
+        while len(futures) > 0:
+            result = futures.popleft().result()
+            args = next(args_iter, None)
+            if args is not None:
+                futures.append(executor.submit(func, *args))
+            pbar.update(1)
+            yield result
+
+
+# endregion
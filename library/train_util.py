@@ -3,7 +3,10 @@
 import argparse
 import ast
 import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import importlib
+import itertools
 import json
 import pathlib
 import re
@@ -26,7 +29,7 @@ import os
 import random
 import hashlib
 import subprocess
-from io import BytesIO
+import threading
 import toml
 
 from tqdm import tqdm
@@ -63,6 +66,10 @@ from library.lpw_stable_diffusion import StableDiffusionLongPromptWeightingPipel
 import library.model_util as model_util
 import library.huggingface_util as huggingface_util
 import library.sai_model_spec as sai_model_spec
+import library.safetensors_utils as safetensors_utils
+import library.checkpoint_writer as checkpoint_writer
+from library.latent_store import ShardedLatentStore, get_latent_store, storage_array_to_tensor, tensor_to_storage_array
+from library.image_cache import SharedImageCache
 
 # from library.attention_processors import FlashAttnProcessor
 # from library.hypernetwork import replace_attentions_for_hypernetwork
@@ -111,6 +118,7 @@ IMAGE_TRANSFORMS = transforms.Compose(
 )
 
 TEXT_ENCODER_OUTPUTS_CACHE_SUFFIX = "_te_outputs.npz"
+TEXT_ENCODER_OUTPUTS_CACHE_DIR_NAME = "te_outputs_cache"  # content-addressed cache, shared by images with the same caption
 
 
 class ImageInfo:
@@ -137,6 +145,10 @@ class ImageInfo:
         self.text_encoder_pool2: Optional[torch.Tensor] = None
 
 
+BUCKET_RESO_KEY_BASE = 1 << 32  # (width, height) -> width * BASE + height
+SELECT_BUCKETS_CHUNK_SIZE = 65536
+
+
 class BucketManager:
     def __init__(self, no_upscale, max_reso, min_size, max_size, reso_steps) -> None:
         self.no_upscale = no_upscale
@@ -262,6 +274,99 @@ class BucketManager:
         ar_error = (reso[0] / reso[1]) - aspect_ratio
         return reso, resized_size, ar_error
 
+    def select_buckets(self, image_widths, image_heights) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        r"""
+        vectorized version of select_bucket for many images.
+        returns bucket ids (index of self.resos), resized sizes (N, 2) and ar errors.
+        the results, and the order of the resos added to self.resos, are the same as calling select_bucket for each image
+        """
+        image_widths = np.asarray(image_widths, dtype=np.int64).reshape(-1)
+        image_heights = np.asarray(image_heights, dtype=np.int64).reshape(-1)
+        if len(image_widths) == 0:
+            return np.zeros((0,), dtype=np.int64), np.zeros((0, 2), dtype=np.int64), np.zeros((0,), dtype=np.float64)
+
+        aspect_ratios = image_widths / image_heights
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if not self.no_upscale:
+                # 同じ解像度があればそれを優先し、なければaspect ratio errorが最も少ないものを選ぶ
+                predefined_resos = np.array(list(self.predefined_resos), dtype=np.int64).reshape(-1, 2)
+                is_predefined = np.isin(
+                    image_widths * BUCKET_RESO_KEY_BASE + image_heights,
+                    predefined_resos[:, 0] * BUCKET_RESO_KEY_BASE + predefined_resos[:, 1],
+                )
+                bucket_widths = image_widths.copy()
+                bucket_heights = image_heights.copy()
+                (indices,) = np.nonzero(~is_predefined)
+                for i in range(0, len(indices), SELECT_BUCKETS_CHUNK_SIZE):  # (N, num resos) の配列が大きくなりすぎないように分割する
+                    chunk = indices[i : i + SELECT_BUCKETS_CHUNK_SIZE]
+                    ar_errors = self.predefined_aspect_ratios[None, :] - aspect_ratios[chunk, None]
+                    predefined_bucket_ids = np.abs(ar_errors).argmin(axis=1)
+                    bucket_widths[chunk] = predefined_resos[predefined_bucket_ids, 0]
+                    bucket_heights[chunk] = predefined_resos[predefined_bucket_ids, 1]
+
+                ar_resos = bucket_widths / bucket_heights
+                scales = np.where(aspect_ratios > ar_resos, bucket_heights / image_heights, bucket_widths / image_widths)
+                resized_widths = np.floor(image_widths * scales + 0.5).astype(np.int64)
+                resized_heights = np.floor(image_heights * scales + 0.5).astype(np.int64)
+            else:
+                def round_to_steps(x):
+                    x = np.floor(x + 0.5).astype(np.int64)
+                    return x - x % self.reso_steps
+
+                # 大きすぎる画像はアスペクト比を保ったまま縮小することを前提にbucketを決める（select_bucketと同じロジック）
+                is_large = image_widths * image_heights > self.max_area
+                large_widths = np.sqrt(self.max_area * aspect_ratios)
+                large_heights = self.max_area / large_widths
+                assert np.all(np.abs(large_widths / large_heights - aspect_ratios)[is_large] < 1e-2), "aspect is illegal"
+
+                b_widths_rounded = round_to_steps(large_widths)
+                b_heights_in_wr = round_to_steps(b_widths_rounded / aspect_ratios)
+                ar_widths_rounded = b_widths_rounded / b_heights_in_wr
+
+                b_heights_rounded = round_to_steps(large_heights)
+                b_widths_in_hr = round_to_steps(b_heights_rounded * aspect_ratios)
+                ar_heights_rounded = b_widths_in_hr / b_heights_rounded
+
+                is_zero_division = is_large & ((b_heights_in_wr == 0) | (b_heights_rounded == 0))
+                if np.any(is_zero_division):
+                    i = np.argmax(is_zero_division)
+                    self.select_bucket(int(image_widths[i]), int(image_heights[i]))  # raises the same error
+
+                use_width = np.abs(ar_widths_rounded - aspect_ratios) < np.abs(ar_heights_rounded - aspect_ratios)
+                resized_widths = np.where(
+                    use_width, b_widths_rounded, np.floor(b_heights_rounded * aspect_ratios + 0.5).astype(np.int64)
+                )
+                resized_heights = np.where(
+                    use_width, np.floor(b_widths_rounded / aspect_ratios + 0.5).astype(np.int64), b_heights_rounded
+                )
+                resized_widths = np.where(is_large, resized_widths, image_widths)
+                resized_heights = np.where(is_large, resized_heights, image_heights)
+
+                # 画像のサイズ未満をbucketのサイズとする（paddingせずにcroppingする）
+                bucket_widths = resized_widths - resized_widths % self.reso_steps
+                bucket_heights = resized_heights - resized_heights % self.reso_steps
+
+            if np.any(bucket_heights == 0):
+                i = np.argmax(bucket_heights == 0)
+                self.select_bucket(int(image_widths[i]), int(image_heights[i]))  # raises the same error
+
+            ar_errors = bucket_widths / bucket_heights - aspect_ratios
+
+        # select_bucketと同じ順番でbucketを追加する
+        reso_keys, first_indices, inverse = np.unique(
+            bucket_widths * BUCKET_RESO_KEY_BASE + bucket_heights, return_index=True, return_inverse=True
+        )
+        for i in np.sort(first_indices):
+            self.add_if_new_reso((int(bucket_widths[i]), int(bucket_heights[i])))
+        ids_of_keys = np.array(
+            [self.reso_to_id[(int(bucket_widths[i]), int(bucket_heights[i]))] for i in first_indices], dtype=np.int64
+        )
+        bucket_ids = ids_of_keys[inverse.reshape(-1)]
+
+        resized_sizes = np.stack([resized_widths, resized_heights], axis=1)
+        return bucket_ids, resized_sizes, ar_errors
+
     @staticmethod
     def get_crop_ltrb(bucket_reso: Tuple[int, int], image_size: Tuple[int, int]):
         # Stability AIの前処理に合わせてcrop left/topを計算する。crop rightはflipのaugmentationのために求める
@@ -325,6 +430,68 @@ class AugHelper:
     def get_augmentor(self, use_color_aug: bool):  # -> Optional[Callable[[np.ndarray], Dict[str, np.ndarray]]]:
         return self.color_aug if use_color_aug else None
 
+    def color_aug_batch(self, images: torch.Tensor, use_color_aug: torch.Tensor) -> torch.Tensor:
+        r"""
+        batched version of color_aug for image tensors on the training device
+        images: b,c,h,w in -1~1 (RGB), use_color_aug: b (bool)
+        """
+        hue_shift_limit = 8  # cv2のhueは0~180
+        b_size = images.shape[0]
+        device = images.device
+
+        applied = use_color_aug.to(device) & (torch.rand(b_size, device=device) <= 0.33)
+        hue_shifted = applied & (torch.rand(b_size, device=device) > 0.5)
+        gamma_applied = applied & ~hue_shifted
+
+        if hue_shifted.any():
+            hue_shift = torch.empty(b_size, device=device).uniform_(-hue_shift_limit, hue_shift_limit) / 180.0
+            shifted_images = shift_hue(images, hue_shift)
+            images = torch.where(hue_shifted[:, None, None, None], shifted_images, images)
+
+        if gamma_applied.any():
+            # random gamma: CPU版と同じく0~255の値に対してgammaを適用する
+            gamma = torch.empty(b_size, device=device).uniform_(0.95, 1.05)
+            pixels = ((images.float() + 1.0) * 127.5).clamp(0, 255)
+            pixels = (pixels ** gamma[:, None, None, None]).clamp(0, 255)
+            gamma_images = (pixels / 127.5 - 1.0).to(images.dtype)
+            images = torch.where(gamma_applied[:, None, None, None], gamma_images, images)
+
+        return images
+
+
+def shift_hue(images: torch.Tensor, hue_shift: torch.Tensor) -> torch.Tensor:
+    # images: b,3,h,w in -1~1, hue_shift: b, in fraction of hue circle. RGB -> HSV -> RGB
+    dtype = images.dtype
+    rgb = ((images.float() + 1.0) / 2.0).clamp(0, 1)
+    r, g, b = rgb.unbind(dim=1)
+
+    max_c, _ = rgb.max(dim=1)
+    min_c, _ = rgb.min(dim=1)
+    delta = max_c - min_c
+    v = max_c
+    s = torch.where(max_c > 0, delta / max_c.clamp(min=1e-8), torch.zeros_like(max_c))
+
+    delta_c = delta.clamp(min=1e-8)
+    h = torch.where(
+        max_c == r, (g - b) / delta_c, torch.where(max_c == g, 2.0 + (b - r) / delta_c, 4.0 + (r - g) / delta_c)
+    )
+    h = torch.where(delta > 0, (h / 6.0) % 1.0, torch.zeros_like(h))
+    h = (h + hue_shift[:, None, None]) % 1.0
+
+    h6 = h * 6.0
+    i = torch.floor(h6)
+    f = h6 - i
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    i = i.long() % 6
+
+    r = torch.stack([v, q, p, p, t, v], dim=1).gather(1, i[:, None]).squeeze(1)
+    g = torch.stack([t, v, v, q, p, p], dim=1).gather(1, i[:, None]).squeeze(1)
+    b = torch.stack([p, p, t, v, v, q], dim=1).gather(1, i[:, None]).squeeze(1)
+    rgb = torch.stack([r, g, b], dim=1)
+    return (rgb * 2.0 - 1.0).to(dtype)
+
 
 class BaseSubset:
     def __init__(
@@ -344,6 +511,7 @@ class BaseSubset:
         caption_suffix: Optional[str],
         token_warmup_min: int,
         token_warmup_step: Union[float, int],
+        cache_info: bool = False,
     ) -> None:
         self.image_dir = image_dir
         self.num_repeats = num_repeats
@@ -362,6 +530,8 @@ class BaseSubset:
         self.token_warmup_min = token_warmup_min  # step=0におけるタグの数
         self.token_warmup_step = token_warmup_step  # N（N<1ならN*max_train_steps）ステップ目でタグの数が最大になる
 
+        self.cache_info = cache_info  # 画像サイズとcaptionをディレクトリごとにキャッシュし、次回起動時に再利用する
+
         self.img_count = 0
 
 
@@ -386,6 +556,7 @@ class DreamBoothSubset(BaseSubset):
         caption_suffix,
         token_warmup_min,
         token_warmup_step,
+        cache_info=False,
     ) -> None:
         assert image_dir is not None, "image_dir must be specified / image_dirは指定が必須です"
 
@@ -405,6 +576,7 @@ class DreamBoothSubset(BaseSubset):
             caption_suffix,
             token_warmup_min,
             token_warmup_step,
+            cache_info,
         )
 
         self.is_reg = is_reg
@@ -438,6 +610,7 @@ class FineTuningSubset(BaseSubset):
         caption_suffix,
         token_warmup_min,
         token_warmup_step,
+        cache_info=False,
     ) -> None:
         assert metadata_file is not None, "metadata_file must be specified / metadata_fileは指定が必須です"
 
@@ -457,6 +630,7 @@ class FineTuningSubset(BaseSubset):
             caption_suffix,
             token_warmup_min,
             token_warmup_step,
+            cache_info,
         )
 
         self.metadata_file = metadata_file
@@ -487,6 +661,7 @@ class ControlNetSubset(BaseSubset):
         caption_suffix,
         token_warmup_min,
         token_warmup_step,
+        cache_info=False,
     ) -> None:
         assert image_dir is not None, "image_dir must be specified / image_dirは指定が必須です"
 
@@ -506,6 +681,7 @@ class ControlNetSubset(BaseSubset):
             caption_suffix,
             token_warmup_min,
             token_warmup_step,
+            cache_info,
         )
 
         self.conditioning_data_dir = conditioning_data_dir
@@ -566,11 +742,15 @@ class BaseDataset(torch.utils.data.Dataset):
 
         self.image_data: Dict[str, ImageInfo] = {}
         self.image_to_subset: Dict[str, Union[DreamBoothSubset, FineTuningSubset]] = {}
+        self.scan_cache = DatasetScanCache()  # used for subsets with cache_info
 
         self.replacements = {}
 
         # caching
         self.caching_mode = None  # None, 'latents', 'text'
+        self.latents_store: Optional[ShardedLatentStore] = None  # sharded latents cache, used instead of npz files
+        self.image_cache: Optional[SharedImageCache] = None  # decoded images in RAM, used if latents are not cached
+        self.gpu_augmentation = False  # color_aug and flip are applied on the training device by augment_batch_images
 
     def set_seed(self, seed):
         self.seed = seed
@@ -578,6 +758,12 @@ class BaseDataset(torch.utils.data.Dataset):
     def set_caching_mode(self, mode):
         self.caching_mode = mode
 
+    def set_image_cache(self, image_cache: Optional[SharedImageCache]):
+        self.image_cache = image_cache
+
+    def set_gpu_augmentation(self, gpu_augmentation: bool):
+        self.gpu_augmentation = gpu_augmentation
+
     def set_current_epoch(self, epoch):
         if not self.current_epoch == epoch:  # epochが切り替わったらバケツをシャッフルする
             self.shuffle_buckets()
@@ -733,9 +919,19 @@ class BaseDataset(torch.utils.data.Dataset):
         min_size and max_size are ignored when enable_bucket is False
         """
         print("loading image sizes.")
-        for info in tqdm(self.image_data.values()):
-            if info.image_size is None:
-                info.image_size = self.get_image_size(info.absolute_path)
+
+        def load_image_size(info: ImageInfo):
+            if self.image_to_subset[info.image_key].cache_info:
+                return self.scan_cache.get_image_size(info.absolute_path)
+            return self.get_image_size(info.absolute_path)
+
+        # ファイルシステムの待ち時間が大きいので並列に読み込む
+        infos_without_size = [info for info in self.image_data.values() if info.image_size is None]
+        with ThreadPoolExecutor() as executor:
+            image_sizes = list(tqdm(executor.map(load_image_size, infos_without_size), total=len(infos_without_size)))
+        for info, image_size in zip(infos_without_size, image_sizes):
+            info.image_size = image_size
+        self.scan_cache.save()
 
         if self.enable_bucket:
             print("make buckets")
@@ -759,23 +955,12 @@ class BaseDataset(torch.utils.data.Dataset):
                         "min_bucket_reso and max_bucket_reso are ignored if bucket_no_upscale is set, because bucket reso is defined by image size automatically / bucket_no_upscaleが指定された場合は、bucketの解像度は画像サイズから自動計算されるため、min_bucket_resoとmax_bucket_resoは無視されます"
                     )
 
-            img_ar_errors = []
-            for image_info in self.image_data.values():
-                image_width, image_height = image_info.image_size
-                image_info.bucket_reso, image_info.resized_size, ar_error = self.bucket_manager.select_bucket(
-                    image_width, image_height
-                )
-
-                # print(image_info.image_key, image_info.bucket_reso)
-                img_ar_errors.append(abs(ar_error))
-
+            img_ar_errors = self.select_buckets_for_images()
             self.bucket_manager.sort()
         else:
             self.bucket_manager = BucketManager(False, (self.width, self.height), None, None, None)
             self.bucket_manager.set_predefined_resos([(self.width, self.height)])  # ひとつの固定サイズbucketのみ
-            for image_info in self.image_data.values():
-                image_width, image_height = image_info.image_size
-                image_info.bucket_reso, image_info.resized_size, _ = self.bucket_manager.select_bucket(image_width, image_height)
+            self.select_buckets_for_images()
 
         for image_info in self.image_data.values():
             for _ in range(image_info.num_repeats):
@@ -822,6 +1007,16 @@ class BaseDataset(torch.utils.data.Dataset):
         self.shuffle_buckets()
         self._length = len(self.buckets_indices)
 
+    def select_buckets_for_images(self) -> np.ndarray:
+        # 全画像のbucketをまとめて決める。戻り値はaspect ratio errorの絶対値
+        image_infos = list(self.image_data.values())
+        image_sizes = np.array([info.image_size for info in image_infos], dtype=np.int64).reshape(-1, 2)
+        bucket_ids, resized_sizes, ar_errors = self.bucket_manager.select_buckets(image_sizes[:, 0], image_sizes[:, 1])
+        for image_info, bucket_id, resized_size in zip(image_infos, bucket_ids.tolist(), resized_sizes.tolist()):
+            image_info.bucket_reso = self.bucket_manager.resos[bucket_id]
+            image_info.resized_size = tuple(resized_size)
+        return np.abs(ar_errors)
+
     def shuffle_buckets(self):
         # set random seed for this epoch
         random.seed(self.seed + self.current_epoch)
@@ -851,104 +1046,224 @@ class BaseDataset(torch.utils.data.Dataset):
             ]
         )
 
-    def cache_latents(self, vae, vae_batch_size=1, cache_to_disk=False, is_main_process=True):
+    def cache_latents(
+        self,
+        vae,
+        vae_batch_size=1,
+        cache_to_disk=False,
+        is_main_process=True,
+        latents_cache_dir=None,
+        num_workers=0,
+        storage_dtype=None,
+        compress=False,
+    ):
         # マルチGPUには対応していないので、そちらはtools/cache_latents.pyを使うこと
         print("caching latents.")
 
+        # latents_cache_dirが指定された場合は、npzではなくsharded storeにキャッシュする
+        if cache_to_disk and latents_cache_dir is not None:
+            self.latents_store = get_latent_store(latents_cache_dir)
+
         image_infos = list(self.image_data.values())
 
         # sort by resolution
         image_infos.sort(key=lambda info: info.bucket_reso[0] * info.bucket_reso[1])
 
-        # split by resolution
-        batches = []
-        batch = []
-        print("checking cache validity...")
-        for info in tqdm(image_infos):
-            subset = self.image_to_subset[info.image_key]
+        # check disk cache exists and size of latents
+        # npzの場合はmanifestに記録されたファイルサイズと更新日時が一致すれば、npzを開かずに有効とみなす
+        manifest = None
+        if cache_to_disk and self.latents_store is None and is_main_process:
+            manifest = LatentsCacheManifest()
+
+        def is_cache_available(info: ImageInfo):
+            flip_aug = self.image_to_subset[info.image_key].flip_aug
+            if self.latents_store is not None:
+                return self.latents_store.is_cached(info.absolute_path, info.bucket_reso, flip_aug)
+            return manifest.is_disk_cached_latents_is_expected(info.bucket_reso, info.latents_npz, flip_aug)
 
+        infos_to_check = []
+        for info in image_infos:
             if info.latents_npz is not None:  # fine tuning dataset
                 continue
-
-            # check disk cache exists and size of latents
-            if cache_to_disk:
+            if cache_to_disk and self.latents_store is None:
                 info.latents_npz = os.path.splitext(info.absolute_path)[0] + ".npz"
-                if not is_main_process:  # store to info only
-                    continue
+            infos_to_check.append(info)
+
+        cached_keys = set()
+        if cache_to_disk and is_main_process:  # non-main process: store to info only, or read from the store after caching
+            print("checking cache validity...")
+            if manifest is not None and num_workers > 0:
+                # ネットワークファイルシステムではstatの待ち時間が大きいので並列に確認する
+                with ThreadPoolExecutor(num_workers) as executor:
+                    availables = list(tqdm(executor.map(is_cache_available, infos_to_check), total=len(infos_to_check)))
+            else:
+                availables = [is_cache_available(info) for info in tqdm(infos_to_check)]
+            cached_keys = set([info.image_key for info, available in zip(infos_to_check, availables) if available])
 
-                cache_available = is_disk_cached_latents_is_expected(info.bucket_reso, info.latents_npz, subset.flip_aug)
+        # split by resolution and augmentation of the subset: (image infos, flip_aug, random_crop)
+        batches = []
+        batch = []
+        batch_augs = None
+        for info in infos_to_check:
+            subset = self.image_to_subset[info.image_key]
+            augs = (subset.flip_aug, subset.random_crop)
 
-                if cache_available:  # do not add to batch
-                    continue
+            if info.image_key in cached_keys:  # do not add to batch
+                continue
 
-            # if last member of batch has different resolution, flush the batch
-            if len(batch) > 0 and batch[-1].bucket_reso != info.bucket_reso:
-                batches.append(batch)
+            # if last member of batch has different resolution or augmentation, flush the batch
+            if len(batch) > 0 and (batch[-1].bucket_reso != info.bucket_reso or batch_augs != augs):
+                batches.append((batch, *batch_augs))
                 batch = []
 
             batch.append(info)
+            batch_augs = augs
 
             # if number of data in batch is enough, flush the batch
             if len(batch) >= vae_batch_size:
-                batches.append(batch)
+                batches.append((batch, *batch_augs))
                 batch = []
 
         if len(batch) > 0:
-            batches.append(batch)
+            batches.append((batch, *batch_augs))
 
         if cache_to_disk and not is_main_process:  # if cache to disk, don't cache latents in non-main process, set to info only
             return
 
         # iterate batches: batch doesn't have image, image will be loaded in cache_batch_latents and discarded
-        print("caching latents...")
-        for batch in tqdm(batches, smoothing=1, total=len(batches)):
-            cache_batch_latents(vae, cache_to_disk, batch, subset.flip_aug, subset.random_crop)
+        if len(batches) > 0:
+            print("caching latents...")
+            if num_workers > 0:
+                # 画像の読み込みと保存をバックグラウンドで行う
+                cache_latents_pipelined(
+                    vae,
+                    batches,
+                    cache_to_disk,
+                    self.latents_store,
+                    num_workers,
+                    storage_dtype=storage_dtype,
+                    compress=compress,
+                )
+            else:
+                for batch, flip_aug, random_crop in tqdm(batches, smoothing=1, total=len(batches)):
+                    cache_batch_latents(
+                        vae,
+                        cache_to_disk,
+                        batch,
+                        flip_aug,
+                        random_crop,
+                        self.latents_store,
+                        storage_dtype=storage_dtype,
+                        compress=compress,
+                    )
+
+        if self.latents_store is not None:
+            self.latents_store.close()
+
+        if manifest is not None:
+            for batch, flip_aug, _ in batches:
+                for info in batch:
+                    manifest.update(info.latents_npz, info.bucket_reso, flip_aug)
+            manifest.save()
 
     # weight_dtypeを指定するとText Encoderそのもの、およひ出力がweight_dtypeになる
-    # SDXLでのみ有効だが、datasetのメソッドとする必要があるので、sdxl_train_util.pyではなくこちらに実装する
-    # SD1/2に対応するにはv2のフラグを持つ必要があるので後回し
+    # SDXLとSD1/2の両方で使うため、sdxl_train_util.pyではなくこちらに実装する
+    # SD1/2ではText Encoderはひとつで、v2とclip_skipはget_hidden_statesと同じように扱う
     def cache_text_encoder_outputs(
-        self, tokenizers, text_encoders, device, weight_dtype, cache_to_disk=False, is_main_process=True
+        self,
+        tokenizers,
+        text_encoders,
+        device,
+        weight_dtype,
+        cache_to_disk=False,
+        is_main_process=True,
+        v2=False,
+        clip_skip=None,
+        storage_dtype=None,
+        compress=False,
+        model_identity=None,
     ):
-        assert len(tokenizers) == 2, "only support SDXL"
+        assert len(tokenizers) in [1, 2], "only support SD1/2 or SDXL"
+        is_sdxl = len(tokenizers) == 2
 
         # latentsのキャッシュと同様に、ディスクへのキャッシュに対応する
         # またマルチGPUには対応していないので、そちらはtools/cache_latents.pyを使うこと
+        # 同じキャプションの画像は多い（class_tokensのみなど）ので、トークナイズしたキャプションと設定のハッシュで重複を除く
         print("caching text encoder outputs.")
         image_infos = list(self.image_data.values())
 
         print("checking cache existence...")
-        image_infos_to_cache = []
+        # 別のモデルやdtypeで作られたキャッシュは使わない / the cache depends on the weights and the dtype of the Text Encoders
+        te_dtype = weight_dtype if weight_dtype is not None else text_encoders[0].dtype
+        settings = {
+            "sdxl": is_sdxl,
+            "v2": v2,
+            "clip_skip": clip_skip,
+            "max_token_length": self.max_token_length,
+            "dtype": str(te_dtype),
+            "model": model_identity,
+        }
+        groups: Dict[str, List[ImageInfo]] = {}  # cache key -> image infos sharing the outputs
+        group_input_ids = {}
+        keys_to_cache = []
         for info in tqdm(image_infos):
             # subset = self.image_to_subset[info.image_key]
+            input_ids1 = self.get_input_ids(info.caption, tokenizers[0])
+            input_ids2 = self.get_input_ids(info.caption, tokenizers[1]) if is_sdxl else None
+            key = get_text_encoder_outputs_cache_key(input_ids1, input_ids2, settings)
+
             if cache_to_disk:
+                # 以前の画像ごとのキャッシュがあればそれを使う / use legacy per-image cache if exists
                 te_out_npz = os.path.splitext(info.absolute_path)[0] + TEXT_ENCODER_OUTPUTS_CACHE_SUFFIX
+                if is_sdxl:
+                    legacy_cache_exists = os.path.exists(te_out_npz)
+                else:
+                    legacy_cache_exists = is_disk_cached_text_encoder_outputs_is_expected(
+                        te_out_npz, self.tokenizer_max_length, clip_skip
+                    )
+                if legacy_cache_exists:
+                    info.text_encoder_outputs_npz = te_out_npz
+                    continue
+
+                # ディレクトリごとに、キーをファイル名としてキャッシュする
+                te_out_npz = os.path.join(
+                    os.path.dirname(info.absolute_path), TEXT_ENCODER_OUTPUTS_CACHE_DIR_NAME, key + ".npz"
+                )
+                key = te_out_npz  # 別のディレクトリの画像は別のファイルになる
                 info.text_encoder_outputs_npz = te_out_npz
 
                 if not is_main_process:  # store to info only
                     continue
 
-                if os.path.exists(te_out_npz):
+                if key not in groups and os.path.exists(te_out_npz):
+                    groups[key] = []  # already cached
                     continue
 
-            image_infos_to_cache.append(info)
+            if key not in groups:
+                groups[key] = []
+                group_input_ids[key] = (input_ids1, input_ids2)
+                keys_to_cache.append(key)
+            groups[key].append(info)
 
         if cache_to_disk and not is_main_process:  # if cache to disk, don't cache latents in non-main process, set to info only
             return
 
+        print(f"unique captions to cache: {len(keys_to_cache)} / images: {len(image_infos)}")
+
         # prepare tokenizers and text encoders
         for text_encoder in text_encoders:
             text_encoder.to(device)
             if weight_dtype is not None:
                 text_encoder.to(dtype=weight_dtype)
 
-        # create batch
+        # create batch: 同じキーの画像は代表の1枚だけText Encoderに通す
         batch = []
         batches = []
-        for info in image_infos_to_cache:
-            input_ids1 = self.get_input_ids(info.caption, tokenizers[0])
-            input_ids2 = self.get_input_ids(info.caption, tokenizers[1])
-            batch.append((info, input_ids1, input_ids2))
+        for key in keys_to_cache:
+            input_ids1, input_ids2 = group_input_ids[key]
+            if cache_to_disk:
+                os.makedirs(os.path.dirname(groups[key][0].text_encoder_outputs_npz), exist_ok=True)
+            batch.append((groups[key][0], input_ids1, input_ids2))
 
             if len(batch) >= self.batch_size:
                 batches.append(batch)
@@ -962,10 +1277,43 @@ class BaseDataset(torch.utils.data.Dataset):
         for batch in tqdm(batches):
             infos, input_ids1, input_ids2 = zip(*batch)
             input_ids1 = torch.stack(input_ids1, dim=0)
-            input_ids2 = torch.stack(input_ids2, dim=0)
-            cache_batch_text_encoder_outputs(
-                infos, tokenizers, text_encoders, self.max_token_length, cache_to_disk, input_ids1, input_ids2, weight_dtype
-            )
+            if is_sdxl:
+                input_ids2 = torch.stack(input_ids2, dim=0)
+                cache_batch_text_encoder_outputs(
+                    infos,
+                    tokenizers,
+                    text_encoders,
+                    self.max_token_length,
+                    cache_to_disk,
+                    input_ids1,
+                    input_ids2,
+                    weight_dtype,
+                    storage_dtype=storage_dtype,
+                    compress=compress,
+                )
+            else:
+                cache_batch_text_encoder_outputs_sd(
+                    infos,
+                    tokenizers[0],
+                    text_encoders[0],
+                    self.max_token_length,
+                    v2,
+                    clip_skip,
+                    cache_to_disk,
+                    input_ids1,
+                    weight_dtype,
+                    storage_dtype=storage_dtype,
+                    compress=compress,
+                )
+
+        if not cache_to_disk:
+            # 同じキーの画像は同じテンソルを参照する / images with the same key share the same tensors
+            for key in keys_to_cache:
+                representative, *others = groups[key]
+                for info in others:
+                    info.text_encoder_outputs1 = representative.text_encoder_outputs1
+                    info.text_encoder_outputs2 = representative.text_encoder_outputs2
+                    info.text_encoder_pool2 = representative.text_encoder_pool2
 
     def get_image_size(self, image_path):
         image = Image.open(image_path)
@@ -973,7 +1321,10 @@ class BaseDataset(torch.utils.data.Dataset):
 
     def load_image_with_face_info(self, subset: BaseSubset, image_path: str):
         img = load_image(image_path)
+        face_cx, face_cy, face_w, face_h = self.get_face_info(subset, image_path)
+        return img, face_cx, face_cy, face_w, face_h
 
+    def get_face_info(self, subset: BaseSubset, image_path: str):
         face_cx = face_cy = face_w = face_h = 0
         if subset.face_crop_aug_range is not None:
             tokens = os.path.splitext(os.path.basename(image_path))[0].split("_")
@@ -983,7 +1334,29 @@ class BaseDataset(torch.utils.data.Dataset):
                 face_w = int(tokens[-2])
                 face_h = int(tokens[-1])
 
-        return img, face_cx, face_cy, face_w, face_h
+        return face_cx, face_cy, face_w, face_h
+
+    def load_image_for_training(self, image_info: ImageInfo):
+        # bucketを使う場合はリサイズ済みの画像を返す。image_cacheがあればデコード・リサイズ済みの画像をキャッシュする
+        # returns image, original size (width, height) before resizing
+        if self.enable_bucket:
+            cache_key = f"{image_info.absolute_path}:{image_info.resized_size[0]}x{image_info.resized_size[1]}"
+        else:
+            cache_key = image_info.absolute_path
+
+        if self.image_cache is not None:
+            cached = self.image_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        img = load_image(image_info.absolute_path)
+        original_size = (img.shape[1], img.shape[0])
+        if self.enable_bucket and original_size != tuple(image_info.resized_size):
+            img = cv2.resize(img, image_info.resized_size, interpolation=cv2.INTER_AREA)  # INTER_AREAでやりたいのでcv2でリサイズ
+
+        if self.image_cache is not None:
+            self.image_cache.put(cache_key, img, original_size)
+        return img, original_size
 
     # いい感じに切り出す
     def crop_target(self, subset: BaseSubset, image, face_cx, face_cy, face_w, face_h):
@@ -1054,6 +1427,8 @@ class BaseDataset(torch.utils.data.Dataset):
         crop_top_lefts = []
         target_sizes_hw = []
         flippeds = []  # 変数名が微妙
+        gpu_color_augs = []  # gpu_augmentationの場合、学習デバイス上で行うaugmentation
+        gpu_flips = []
         text_encoder_outputs1_list = []
         text_encoder_outputs2_list = []
         text_encoder_pool2_list = []
@@ -1082,15 +1457,25 @@ class BaseDataset(torch.utils.data.Dataset):
                     del flipped_latents
                 latents = torch.FloatTensor(latents)
 
+                image = None
+            elif self.latents_store is not None:  # cache_latents_to_disk=True and latents_cache_dir is specified
+                latents, original_size, crop_ltrb, flipped_latents = self.latents_store.get(
+                    image_info.absolute_path, image_info.bucket_reso
+                )
+                if flipped:
+                    latents = flipped_latents
+                del flipped_latents
+
                 image = None
             else:
                 # 画像を読み込み、必要ならcropする
-                img, face_cx, face_cy, face_w, face_h = self.load_image_with_face_info(subset, image_info.absolute_path)
+                img, original_size = self.load_image_for_training(image_info)
+                face_cx, face_cy, face_w, face_h = self.get_face_info(subset, image_info.absolute_path)
                 im_h, im_w = img.shape[0:2]
 
                 if self.enable_bucket:
                     img, original_size, crop_ltrb = trim_and_resize_if_required(
-                        subset.random_crop, img, image_info.bucket_reso, image_info.resized_size
+                        subset.random_crop, img, image_info.bucket_reso, image_info.resized_size, original_size
                     )
                 else:
                     if face_cx > 0:  # 顔位置情報あり
@@ -1115,12 +1500,17 @@ class BaseDataset(torch.utils.data.Dataset):
                     crop_ltrb = (0, 0, 0, 0)
 
                 # augmentation
-                aug = self.aug_helper.get_augmentor(subset.color_aug)
-                if aug is not None:
-                    img = aug(image=img)["image"]
+                if self.gpu_augmentation:
+                    # color_augとflipはcollate後に学習デバイス上でまとめて行う（augment_batch_images）
+                    gpu_color_augs.append(subset.color_aug)
+                    gpu_flips.append(flipped)
+                else:
+                    aug = self.aug_helper.get_augmentor(subset.color_aug)
+                    if aug is not None:
+                        img = aug(image=img)["image"]
 
-                if flipped:
-                    img = img[:, ::-1, :].copy()  # copy to avoid negative stride problem
+                    if flipped:
+                        img = img[:, ::-1, :].copy()  # copy to avoid negative stride problem
 
                 latents = None
                 image = self.image_transforms(img)  # -1.0~1.0のtorch.Tensorになる
@@ -1209,8 +1599,12 @@ class BaseDataset(torch.utils.data.Dataset):
             # example["input_ids"] = torch.stack([self.get_input_ids(cap, self.tokenizers[0]) for cap in captions])
             # example["input_ids2"] = torch.stack([self.get_input_ids(cap, self.tokenizers[1]) for cap in captions])
             example["text_encoder_outputs1_list"] = torch.stack(text_encoder_outputs1_list)
-            example["text_encoder_outputs2_list"] = torch.stack(text_encoder_outputs2_list)
-            example["text_encoder_pool2_list"] = torch.stack(text_encoder_pool2_list)
+            if text_encoder_outputs2_list[0] is not None:  # SDXL
+                example["text_encoder_outputs2_list"] = torch.stack(text_encoder_outputs2_list)
+                example["text_encoder_pool2_list"] = torch.stack(text_encoder_pool2_list)
+            else:
+                example["text_encoder_outputs2_list"] = None
+                example["text_encoder_pool2_list"] = None
 
         if images[0] is not None:
             images = torch.stack(images)
@@ -1226,6 +1620,8 @@ class BaseDataset(torch.utils.data.Dataset):
         example["crop_top_lefts"] = torch.stack([torch.LongTensor(x) for x in crop_top_lefts])
         example["target_sizes_hw"] = torch.stack([torch.LongTensor(x) for x in target_sizes_hw])
         example["flippeds"] = flippeds
+        example["gpu_color_augs"] = torch.tensor(gpu_color_augs, dtype=torch.bool) if len(gpu_color_augs) > 0 else None
+        example["gpu_flips"] = torch.tensor(gpu_flips, dtype=torch.bool) if len(gpu_flips) > 0 else None
 
         if self.debug_dataset:
             example["image_keys"] = bucket[image_index : image_index + self.batch_size]
@@ -1336,7 +1732,7 @@ class DreamBoothDataset(BaseDataset):
             self.bucket_reso_steps = None  # この情報は使われない
             self.bucket_no_upscale = False
 
-        def read_caption(img_path, caption_extension):
+        def read_caption(img_path, caption_extension, scan_cache: Optional[DatasetScanCache] = None):
             # captionの候補ファイル名を作る
             base_name = os.path.splitext(img_path)[0]
             base_name_face_det = base_name
@@ -1347,15 +1743,12 @@ class DreamBoothDataset(BaseDataset):
 
             caption = None
             for cap_path in cap_paths:
-                if os.path.isfile(cap_path):
-                    with open(cap_path, "rt", encoding="utf-8") as f:
-                        try:
-                            lines = f.readlines()
-                        except UnicodeDecodeError as e:
-                            print(f"illegal char in file (not UTF-8) / ファイルにUTF-8以外の文字があります: {cap_path}")
-                            raise e
-                        assert len(lines) > 0, f"caption file is empty / キャプションファイルが空です: {cap_path}"
-                        caption = lines[0].strip()
+                if scan_cache is not None:
+                    caption = scan_cache.read_caption(cap_path)
+                    if caption is not None:
+                        break
+                elif os.path.isfile(cap_path):
+                    caption = read_caption_file(cap_path)
                     break
             return caption
 
@@ -1368,10 +1761,16 @@ class DreamBoothDataset(BaseDataset):
             print(f"found directory {subset.image_dir} contains {len(img_paths)} image files")
 
             # 画像ファイルごとにプロンプトを読み込み、もしあればそちらを使う
+            # ファイルシステムの待ち時間が大きいので並列に読み込む
+            scan_cache = self.scan_cache if subset.cache_info else None
+            with ThreadPoolExecutor() as executor:
+                caps_for_img = list(
+                    executor.map(lambda img_path: read_caption(img_path, subset.caption_extension, scan_cache), img_paths)
+                )
+
             captions = []
             missing_captions = []
-            for img_path in img_paths:
-                cap_for_img = read_caption(img_path, subset.caption_extension)
+            for img_path, cap_for_img in zip(img_paths, caps_for_img):
                 if cap_for_img is None and subset.class_tokens is None:
                     print(
                         f"neither caption file nor class tokens are found. use empty caption for {img_path} / キャプションファイルもclass tokenも見つかりませんでした。空のキャプションを使用します: {img_path}"
@@ -1466,6 +1865,8 @@ class DreamBoothDataset(BaseDataset):
 
         self.num_reg_images = num_reg_images
 
+        self.scan_cache.save()
+
 
 class FineTuningDataset(BaseDataset):
     def __init__(
@@ -1709,6 +2110,7 @@ class ControlNetDataset(BaseDataset):
                 subset.caption_suffix,
                 subset.token_warmup_min,
                 subset.token_warmup_step,
+                subset.cache_info,
             )
             db_subsets.append(db_subset)
 
@@ -1774,8 +2176,26 @@ class ControlNetDataset(BaseDataset):
         self.bucket_manager = self.dreambooth_dataset_delegate.bucket_manager
         self.buckets_indices = self.dreambooth_dataset_delegate.buckets_indices
 
-    def cache_latents(self, vae, vae_batch_size=1, cache_to_disk=False, is_main_process=True):
-        return self.dreambooth_dataset_delegate.cache_latents(vae, vae_batch_size, cache_to_disk, is_main_process)
+    def set_image_cache(self, image_cache: Optional[SharedImageCache]):
+        self.dreambooth_dataset_delegate.set_image_cache(image_cache)
+
+    def set_gpu_augmentation(self, gpu_augmentation: bool):
+        self.dreambooth_dataset_delegate.set_gpu_augmentation(gpu_augmentation)
+
+    def cache_latents(
+        self,
+        vae,
+        vae_batch_size=1,
+        cache_to_disk=False,
+        is_main_process=True,
+        latents_cache_dir=None,
+        num_workers=0,
+        storage_dtype=None,
+        compress=False,
+    ):
+        return self.dreambooth_dataset_delegate.cache_latents(
+            vae, vae_batch_size, cache_to_disk, is_main_process, latents_cache_dir, num_workers, storage_dtype, compress
+        )
 
     def __len__(self):
         return self.dreambooth_dataset_delegate.__len__()
@@ -1864,22 +2284,68 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
         for dataset in self.datasets:
             dataset.enable_XTI(*args, **kwargs)
 
-    def cache_latents(self, vae, vae_batch_size=1, cache_to_disk=False, is_main_process=True):
+    def cache_latents(
+        self,
+        vae,
+        vae_batch_size=1,
+        cache_to_disk=False,
+        is_main_process=True,
+        latents_cache_dir=None,
+        num_workers=0,
+        storage_dtype=None,
+        compress=False,
+    ):
         for i, dataset in enumerate(self.datasets):
             print(f"[Dataset {i}]")
-            dataset.cache_latents(vae, vae_batch_size, cache_to_disk, is_main_process)
+            dataset.cache_latents(
+                vae, vae_batch_size, cache_to_disk, is_main_process, latents_cache_dir, num_workers, storage_dtype, compress
+            )
 
     def cache_text_encoder_outputs(
-        self, tokenizers, text_encoders, device, weight_dtype, cache_to_disk=False, is_main_process=True
+        self,
+        tokenizers,
+        text_encoders,
+        device,
+        weight_dtype,
+        cache_to_disk=False,
+        is_main_process=True,
+        v2=False,
+        clip_skip=None,
+        storage_dtype=None,
+        compress=False,
+        model_identity=None,
     ):
         for i, dataset in enumerate(self.datasets):
             print(f"[Dataset {i}]")
-            dataset.cache_text_encoder_outputs(tokenizers, text_encoders, device, weight_dtype, cache_to_disk, is_main_process)
+            dataset.cache_text_encoder_outputs(
+                tokenizers,
+                text_encoders,
+                device,
+                weight_dtype,
+                cache_to_disk,
+                is_main_process,
+                v2=v2,
+                clip_skip=clip_skip,
+                storage_dtype=storage_dtype,
+                compress=compress,
+                model_identity=model_identity,
+            )
 
     def set_caching_mode(self, caching_mode):
         for dataset in self.datasets:
             dataset.set_caching_mode(caching_mode)
 
+    def set_gpu_augmentation(self, gpu_augmentation: bool):
+        for dataset in self.datasets:
+            dataset.set_gpu_augmentation(gpu_augmentation)
+
+    def enable_image_cache(self, max_size_mb: int):
+        # すべてのdatasetで、ひとつのキャッシュ（容量）を共有する
+        print(f"cache decoded images in RAM: {max_size_mb} MB / デコードした画像をRAMにキャッシュします: {max_size_mb} MB")
+        image_cache = SharedImageCache(max_size_mb * 1024 * 1024)
+        for dataset in self.datasets:
+            dataset.set_image_cache(image_cache)
+
     def verify_bucket_reso_steps(self, min_steps: int):
         for dataset in self.datasets:
             dataset.verify_bucket_reso_steps(min_steps)
@@ -1907,6 +2373,161 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
             dataset.disable_token_padding()
 
 
+DATASET_SCAN_CACHE_NAME = "dataset_scan_cache.json"
+LATENTS_CACHE_MANIFEST_NAME = "latents_cache_manifest.json"
+
+
+def load_cache_json(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "rt", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"failed to load cache file, ignore it / キャッシュファイルの読み込みに失敗したため無視します: {path}, {e}")
+        return {}
+
+
+def save_cache_json(path: str, data: dict):
+    try:
+        # 途中で中断されても壊れないように一時ファイルに書いてから置き換える
+        with open(path + ".tmp", "wt", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"failed to save cache file / キャッシュファイルの保存に失敗しました: {path}, {e}")
+
+
+class DatasetScanCache:
+    r"""
+    caches image sizes and captions keyed by file name, file size and mtime, one cache file per directory.
+    thread safe, so the dataset directories can be scanned on a thread pool
+    """
+
+    def __init__(self) -> None:
+        self.caches: Dict[str, dict] = {}  # directory -> {"images": {file name -> entry}, "captions": {file name -> entry}}
+        self.updated_dirs = set()
+        self.lock = threading.Lock()
+
+    def get_cache(self, dir_name: str, category: str) -> Dict[str, dict]:
+        with self.lock:
+            cache = self.caches.get(dir_name)
+            if cache is None:
+                cache = load_cache_json(os.path.join(dir_name, DATASET_SCAN_CACHE_NAME))
+                self.caches[dir_name] = cache
+            return cache.setdefault(category, {})
+
+    def lookup(self, path: str, category: str, stat: os.stat_result) -> Optional[dict]:
+        dir_name, file_name = os.path.split(path)
+        entry = self.get_cache(dir_name, category).get(file_name)
+        if entry is not None and entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+            return entry
+        return None
+
+    def update(self, path: str, category: str, stat: os.stat_result, **values):
+        dir_name, file_name = os.path.split(path)
+        cache = self.get_cache(dir_name, category)
+        with self.lock:
+            cache[file_name] = {"mtime": stat.st_mtime_ns, "size": stat.st_size, **values}
+            self.updated_dirs.add(dir_name)
+
+    def get_image_size(self, image_path: str) -> Tuple[int, int]:
+        stat = os.stat(image_path)
+        entry = self.lookup(image_path, "images", stat)
+        if entry is not None:
+            return tuple(entry["image_size"])
+
+        with Image.open(image_path) as image:
+            image_size = image.size
+        self.update(image_path, "images", stat, image_size=list(image_size))
+        return image_size
+
+    def read_caption(self, caption_path: str) -> Optional[str]:
+        # captionファイルがなければNoneを返す
+        try:
+            stat = os.stat(caption_path)
+        except FileNotFoundError:
+            return None
+
+        entry = self.lookup(caption_path, "captions", stat)
+        if entry is not None:
+            return entry["caption"]
+
+        caption = read_caption_file(caption_path)
+        self.update(caption_path, "captions", stat, caption=caption)
+        return caption
+
+    def save(self):
+        for dir_name in self.updated_dirs:
+            save_cache_json(os.path.join(dir_name, DATASET_SCAN_CACHE_NAME), self.caches[dir_name])
+        self.updated_dirs = set()
+
+
+class LatentsCacheManifest:
+    r"""
+    records the file size, mtime, bucket reso and flip flag of valid latents npz files, one manifest file per directory.
+    if the npz file is not changed since it was recorded, it is regarded as valid without opening it.
+    thread safe, so is_disk_cached_latents_is_expected can be called from multiple threads
+    """
+
+    def __init__(self) -> None:
+        self.manifests: Dict[str, Dict[str, dict]] = {}  # directory -> {npz file name -> entry}
+        self.updated_dirs = set()
+        self.lock = threading.Lock()
+
+    def get_manifest(self, dir_name: str) -> Dict[str, dict]:
+        with self.lock:
+            manifest = self.manifests.get(dir_name)
+            if manifest is None:
+                manifest = load_cache_json(os.path.join(dir_name, LATENTS_CACHE_MANIFEST_NAME))
+                self.manifests[dir_name] = manifest
+            return manifest
+
+    def is_disk_cached_latents_is_expected(self, reso, npz_path: str, flip_aug: bool):
+        dir_name, file_name = os.path.split(npz_path)
+        manifest = self.get_manifest(dir_name)
+
+        try:
+            stat = os.stat(npz_path)
+        except FileNotFoundError:
+            return False
+
+        entry = manifest.get(file_name)
+        if (
+            entry is not None
+            and entry["mtime"] == stat.st_mtime_ns
+            and entry["size"] == stat.st_size
+            and tuple(entry["reso"]) == tuple(reso)
+            and (entry["flip"] or not flip_aug)
+        ):
+            return True
+
+        # manifestにない、または更新されている場合はnpzを開いて確認する
+        if not is_disk_cached_latents_is_expected(reso, npz_path, flip_aug):
+            return False
+        self.update(npz_path, reso, flip_aug, stat)
+        return True
+
+    def update(self, npz_path: str, reso, flip_aug: bool, stat: Optional[os.stat_result] = None):
+        if stat is None:
+            stat = os.stat(npz_path)
+        dir_name, file_name = os.path.split(npz_path)
+        manifest = self.get_manifest(dir_name)
+        with self.lock:
+            manifest[file_name] = {
+                "mtime": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "reso": [int(reso[0]), int(reso[1])],
+                "flip": bool(flip_aug),
+            }
+            self.updated_dirs.add(dir_name)
+
+    def save(self):
+        for dir_name in self.updated_dirs:
+            save_cache_json(os.path.join(dir_name, LATENTS_CACHE_MANIFEST_NAME), self.manifests[dir_name])
+        self.updated_dirs = set()
+
+
 def is_disk_cached_latents_is_expected(reso, npz_path: str, flip_aug: bool):
     expected_latents_size = (reso[1] // 8, reso[0] // 8)  # bucket_resoはWxHなので注意
 
@@ -1936,26 +2557,57 @@ def load_latents_from_disk(
     if "latents" not in npz:
         raise ValueError(f"error: npz is old format. please re-generate {npz_path}")
 
-    latents = npz["latents"]
+    # fp16/bf16で保存されている場合はfloat32に戻す / upcast to float32 if stored in half precision
+    storage_dtype = get_npz_storage_dtype(npz)
+    latents = storage_array_to_tensor(npz["latents"], storage_dtype).numpy()
     original_size = npz["original_size"].tolist()
     crop_ltrb = npz["crop_ltrb"].tolist()
-    flipped_latents = npz["latents_flipped"] if "latents_flipped" in npz else None
+    flipped_latents = (
+        storage_array_to_tensor(npz["latents_flipped"], storage_dtype).numpy() if "latents_flipped" in npz else None
+    )
     return latents, original_size, crop_ltrb, flipped_latents
 
 
-def save_latents_to_disk(npz_path, latents_tensor, original_size, crop_ltrb, flipped_latents_tensor=None):
+def save_latents_to_disk(
+    npz_path, latents_tensor, original_size, crop_ltrb, flipped_latents_tensor=None, storage_dtype=None, compress=False
+):
     kwargs = {}
     if flipped_latents_tensor is not None:
-        kwargs["latents_flipped"] = flipped_latents_tensor.float().cpu().numpy()
-    np.savez(
+        kwargs["latents_flipped"] = tensor_to_storage_array(flipped_latents_tensor, storage_dtype)
+    save_npz(
         npz_path,
-        latents=latents_tensor.float().cpu().numpy(),
+        compress,
+        storage_dtype,
+        latents=tensor_to_storage_array(latents_tensor, storage_dtype),
         original_size=np.array(original_size),
         crop_ltrb=np.array(crop_ltrb),
         **kwargs,
     )
 
 
+# region cache storage format
+
+CACHE_STORAGE_DTYPES = ["float32", "float16", "bfloat16"]
+
+
+def get_npz_storage_dtype(npz) -> Optional[str]:
+    return str(npz["storage_dtype"]) if "storage_dtype" in npz else None
+
+
+def save_npz(npz_path, compress: bool, storage_dtype: Optional[str], **arrays):
+    # compressの場合はzip (deflate) で圧縮する。storage_dtypeはfloat32以外の場合のみ記録する
+    # np.load can read deflate without another dependency, but decompressing is slower than reading uncompressed npz
+    if storage_dtype is not None and storage_dtype != "float32":
+        arrays["storage_dtype"] = np.array(storage_dtype)
+    if compress:
+        np.savez_compressed(npz_path, **arrays)
+    else:
+        np.savez(npz_path, **arrays)
+
+
+# endregion
+
+
 def debug_dataset(train_dataset, show_input_ids=False):
     print(f"Total dataset length (steps) / データセットの長さ（ステップ数）: {len(train_dataset)}")
     print("`S` for next step, `E` for next epoch no. , Escape for exit. / Sキーで次のステップ、Eキーで次のエポック、Escキーで中断、終了します")
@@ -2130,6 +2782,17 @@ def load_arbitrary_dataset(args, tokenizer) -> MinimalDataset:
     return train_dataset_group
 
 
+def read_caption_file(cap_path):
+    with open(cap_path, "rt", encoding="utf-8") as f:
+        try:
+            lines = f.readlines()
+        except UnicodeDecodeError as e:
+            print(f"illegal char in file (not UTF-8) / ファイルにUTF-8以外の文字があります: {cap_path}")
+            raise e
+        assert len(lines) > 0, f"caption file is empty / キャプションファイルが空です: {cap_path}"
+        return lines[0].strip()
+
+
 def load_image(image_path):
     image = Image.open(image_path)
     if not image.mode == "RGB":
@@ -2140,10 +2803,16 @@ def load_image(image_path):
 
 # 画像を読み込む。戻り値はnumpy.ndarray,(original width, original height),(crop left, crop top, crop right, crop bottom)
 def trim_and_resize_if_required(
-    random_crop: bool, image: Image.Image, reso, resized_size: Tuple[int, int]
+    random_crop: bool,
+    image: Image.Image,
+    reso,
+    resized_size: Tuple[int, int],
+    original_size: Optional[Tuple[int, int]] = None,
 ) -> Tuple[np.ndarray, Tuple[int, int], Tuple[int, int, int, int]]:
+    # original_sizeは、リサイズ済みの画像を渡す場合に指定する / specify original_size if the image is already resized
     image_height, image_width = image.shape[0:2]
-    original_size = (image_width, image_height)  # size before resize
+    if original_size is None:
+        original_size = (image_width, image_height)  # size before resize
 
     if image_width != resized_size[0] or image_height != resized_size[1]:
         # リサイズする
@@ -2171,18 +2840,59 @@ def trim_and_resize_if_required(
     return image, original_size, crop_ltrb
 
 
+def augment_batch_images(batch, aug_helper: Optional[AugHelper] = None) -> torch.Tensor:
+    r"""
+    returns batch["images"] with color_aug and flip applied on its device, if the dataset uses gpu_augmentation
+    call this after the batch is moved to the training device, before encoding images by VAE
+    """
+    images = batch["images"]
+    if batch.get("gpu_flips") is None:
+        return images
+
+    if aug_helper is None:
+        aug_helper = AugHelper()
+    gpu_color_augs = batch["gpu_color_augs"].to(images.device)
+    if gpu_color_augs.any():
+        images = aug_helper.color_aug_batch(images, gpu_color_augs)
+
+    gpu_flips = batch["gpu_flips"].to(images.device)
+    if gpu_flips.any():
+        images = torch.where(gpu_flips[:, None, None, None], torch.flip(images, dims=[3]), images)
+    return images
+
+
 def cache_batch_latents(
-    vae: AutoencoderKL, cache_to_disk: bool, image_infos: List[ImageInfo], flip_aug: bool, random_crop: bool
+    vae: AutoencoderKL,
+    cache_to_disk: bool,
+    image_infos: List[ImageInfo],
+    flip_aug: bool,
+    random_crop: bool,
+    latents_store: Optional[ShardedLatentStore] = None,
+    storage_dtype: Optional[str] = None,
+    compress: bool = False,
 ) -> None:
     r"""
     requires image_infos to have: absolute_path, bucket_reso, resized_size, latents_npz
     optionally requires image_infos to have: image
     if cache_to_disk is True, set info.latents_npz
         flipped latents is also saved if flip_aug is True
+        if latents_store is given, latents are appended to the store instead of npz (keyed by absolute_path and bucket_reso)
+        latents are stored as storage_dtype (float32 if None), npz is compressed if compress is True
     if cache_to_disk is False, set info.latents
         latents_flipped is also set if flip_aug is True
     latents_original_size and latents_crop_ltrb are also set
     """
+    img_tensors = load_images_for_caching(image_infos, random_crop)
+    latents, flipped_latents = encode_batch_latents(vae, img_tensors, flip_aug)
+    save_batch_latents(image_infos, latents, flipped_latents, cache_to_disk, flip_aug, latents_store, storage_dtype, compress)
+
+    # FIXME this slows down caching a lot, specify this as an option
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def load_images_for_caching(image_infos: List[ImageInfo], random_crop: bool) -> torch.Tensor:
+    # 画像を読み込み、bucketに合わせてリサイズする。latents_original_sizeとlatents_crop_ltrbを設定する
     images = []
     for info in image_infos:
         image = load_image(info.absolute_path) if info.image is None else np.array(info.image, np.uint8)
@@ -2194,7 +2904,10 @@ def cache_batch_latents(
         info.latents_original_size = original_size
         info.latents_crop_ltrb = crop_ltrb
 
-    img_tensors = torch.stack(images, dim=0)
+    return torch.stack(images, dim=0)
+
+
+def encode_batch_latents(vae: AutoencoderKL, img_tensors: torch.Tensor, flip_aug: bool):
     img_tensors = img_tensors.to(device=vae.device, dtype=vae.dtype)
 
     with torch.no_grad():
@@ -2207,25 +2920,137 @@ def cache_batch_latents(
     else:
         flipped_latents = [None] * len(latents)
 
+    return latents, flipped_latents
+
+
+def save_batch_latents(
+    image_infos: List[ImageInfo],
+    latents: torch.Tensor,
+    flipped_latents,
+    cache_to_disk: bool,
+    flip_aug: bool,
+    latents_store: Optional[ShardedLatentStore] = None,
+    storage_dtype: Optional[str] = None,
+    compress: bool = False,
+) -> None:
     for info, latent, flipped_latent in zip(image_infos, latents, flipped_latents):
         # check NaN
         if torch.isnan(latents).any() or (flipped_latent is not None and torch.isnan(flipped_latent).any()):
             raise RuntimeError(f"NaN detected in latents: {info.absolute_path}")
 
-        if cache_to_disk:
-            save_latents_to_disk(info.latents_npz, latent, info.latents_original_size, info.latents_crop_ltrb, flipped_latent)
+        if cache_to_disk and latents_store is not None:
+            latents_store.put(
+                info.absolute_path,
+                info.bucket_reso,
+                latent,
+                info.latents_original_size,
+                info.latents_crop_ltrb,
+                flipped_latent,
+                storage_dtype=storage_dtype,
+            )
+        elif cache_to_disk:
+            save_latents_to_disk(
+                info.latents_npz,
+                latent,
+                info.latents_original_size,
+                info.latents_crop_ltrb,
+                flipped_latent,
+                storage_dtype=storage_dtype,
+                compress=compress,
+            )
         else:
             info.latents = latent
             if flip_aug:
                 info.latents_flipped = flipped_latent
 
-    # FIXME this slows down caching a lot, specify this as an option
+
+def cache_latents_pipelined(
+    vae: AutoencoderKL,
+    batches: List[Tuple[List[ImageInfo], bool, bool]],
+    cache_to_disk: bool,
+    latents_store: Optional[ShardedLatentStore] = None,
+    num_workers: int = 4,
+    storage_dtype: Optional[str] = None,
+    compress: bool = False,
+) -> None:
+    r"""
+    same as calling cache_batch_latents for each batch, but image decoding/resizing and saving run in background threads,
+    so the VAE does not wait for them. batches are (image infos, flip_aug, random_crop), and must be grouped by bucket_reso
+    and the augmentation of the subset (as cache_latents does)
+    """
+    # sharded storeはスレッドセーフではないので、書き込みは1スレッドで行う
+    num_writers = 1 if latents_store is not None else num_workers
+    max_pending = num_workers * 2  # メモリ使用量を抑えるため、先読みと書き込み待ちのbatch数を制限する
+
+    num_images = sum([len(batch) for batch, _, _ in batches])
+    busy_times = {"decode": 0.0, "encode": 0.0, "write": 0.0}
+
+    def decode(batch, random_crop):
+        start_time = time.perf_counter()
+        img_tensors = load_images_for_caching(batch, random_crop)
+        return img_tensors, time.perf_counter() - start_time
+
+    def write(batch, latents, flipped_latents, flip_aug):
+        start_time = time.perf_counter()
+        save_batch_latents(batch, latents, flipped_latents, cache_to_disk, flip_aug, latents_store, storage_dtype, compress)
+        return time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(num_workers) as decoders, ThreadPoolExecutor(num_writers) as writers:
+        batch_iter = iter(batches)
+        decode_futures = collections.deque()
+        for batch, flip_aug, random_crop in itertools.islice(batch_iter, max_pending):
+            decode_futures.append((batch, flip_aug, decoders.submit(decode, batch, random_crop)))
+
+        write_futures = collections.deque()
+        for _ in tqdm(range(len(batches)), smoothing=1):
+            batch, flip_aug, decode_future = decode_futures.popleft()
+            img_tensors, elapsed = decode_future.result()
+            busy_times["decode"] += elapsed
+
+            next_batch = next(batch_iter, None)
+            if next_batch is not None:
+                next_infos, next_flip_aug, next_random_crop = next_batch
+                decode_futures.append((next_infos, next_flip_aug, decoders.submit(decode, next_infos, next_random_crop)))
+
+            encode_start_time = time.perf_counter()
+            latents, flipped_latents = encode_batch_latents(vae, img_tensors, flip_aug)
+            busy_times["encode"] += time.perf_counter() - encode_start_time
+
+            write_futures.append(writers.submit(write, batch, latents, flipped_latents, flip_aug))
+            while len(write_futures) > max_pending:
+                busy_times["write"] += write_futures.popleft().result()
+
+        while len(write_futures) > 0:
+            busy_times["write"] += write_futures.popleft().result()
+    total_time = time.perf_counter() - start_time
+
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
 
+    # 各ステージのスループットを表示する（ワーカー数を考慮した、そのステージだけで処理した場合の速度）
+    def images_per_sec(busy_time, parallelism):
+        return num_images * parallelism / busy_time if busy_time > 0 else float("inf")
+
+    print(
+        f"cached {num_images} images in {total_time:.1f}s ({images_per_sec(total_time, 1):.2f} images/s)"
+        + f", decode/resize: {images_per_sec(busy_times['decode'], num_workers):.2f} images/s ({num_workers} workers)"
+        + f", VAE encode: {images_per_sec(busy_times['encode'], 1):.2f} images/s"
+        + f", write: {images_per_sec(busy_times['write'], num_writers):.2f} images/s ({num_writers} workers)"
+    )
+
 
 def cache_batch_text_encoder_outputs(
-    image_infos, tokenizers, text_encoders, max_token_length, cache_to_disk, input_ids1, input_ids2, dtype
+    image_infos,
+    tokenizers,
+    text_encoders,
+    max_token_length,
+    cache_to_disk,
+    input_ids1,
+    input_ids2,
+    dtype,
+    storage_dtype=None,
+    compress=False,
 ):
     input_ids1 = input_ids1.to(text_encoders[0].device)
     input_ids2 = input_ids2.to(text_encoders[1].device)
@@ -2249,27 +3074,124 @@ def cache_batch_text_encoder_outputs(
 
     for info, hidden_state1, hidden_state2, pool2 in zip(image_infos, b_hidden_state1, b_hidden_state2, b_pool2):
         if cache_to_disk:
-            save_text_encoder_outputs_to_disk(info.text_encoder_outputs_npz, hidden_state1, hidden_state2, pool2)
+            save_text_encoder_outputs_to_disk(
+                info.text_encoder_outputs_npz, hidden_state1, hidden_state2, pool2, storage_dtype=storage_dtype, compress=compress
+            )
         else:
             info.text_encoder_outputs1 = hidden_state1
             info.text_encoder_outputs2 = hidden_state2
             info.text_encoder_pool2 = pool2
 
 
-def save_text_encoder_outputs_to_disk(npz_path, hidden_state1, hidden_state2, pool2):
-    np.savez(
-        npz_path,
-        hidden_state1=hidden_state1.cpu().float().numpy(),
-        hidden_state2=hidden_state2.cpu().float().numpy(),
-        pool2=pool2.cpu().float().numpy(),
-    )
+def cache_batch_text_encoder_outputs_sd(
+    image_infos,
+    tokenizer,
+    text_encoder,
+    max_token_length,
+    v2,
+    clip_skip,
+    cache_to_disk,
+    input_ids,
+    dtype,
+    storage_dtype=None,
+    compress=False,
+):
+    # SD1/2: get_hidden_statesと同じ処理で、clip_skipとmax_token_lengthの分割を扱う
+    input_ids = input_ids.to(text_encoder.device)
+    hidden_states_args = argparse.Namespace(v2=v2, clip_skip=clip_skip, max_token_length=max_token_length)
+
+    with torch.no_grad():
+        b_hidden_state = get_hidden_states(hidden_states_args, input_ids, tokenizer, text_encoder, dtype)
+
+        # ここでcpuに移動しておかないと、上書きされてしまう
+        b_hidden_state = b_hidden_state.detach().to("cpu")  # b,n*75+2,768 or 1024
+
+    for info, hidden_state in zip(image_infos, b_hidden_state):
+        if cache_to_disk:
+            save_text_encoder_outputs_to_disk(
+                info.text_encoder_outputs_npz,
+                hidden_state,
+                None,
+                None,
+                clip_skip=clip_skip,
+                storage_dtype=storage_dtype,
+                compress=compress,
+            )
+        else:
+            info.text_encoder_outputs1 = hidden_state
+
+
+def save_text_encoder_outputs_to_disk(
+    npz_path, hidden_state1, hidden_state2, pool2, clip_skip=None, storage_dtype=None, compress=False
+):
+    # SD1/2ではhidden_state2とpool2はNoneになる
+    kwargs = {"hidden_state1": tensor_to_storage_array(hidden_state1, storage_dtype)}
+    if hidden_state2 is not None:
+        kwargs["hidden_state2"] = tensor_to_storage_array(hidden_state2, storage_dtype)
+    if pool2 is not None:
+        kwargs["pool2"] = tensor_to_storage_array(pool2, storage_dtype)
+    if clip_skip is not None:
+        kwargs["clip_skip"] = np.array(clip_skip)
+    save_npz(npz_path, compress, storage_dtype, **kwargs)
+
+
+def get_text_encoder_model_identity(args: argparse.Namespace) -> dict:
+    # Text Encoderの重みを識別する情報：モデルのパス、サイズと更新日時、およびマージしたbase_weights
+    # identity of the weights of the Text Encoders for the cache key: the checkpoint and the merged base weights
+    def get_file_identity(path):
+        if not os.path.exists(path):
+            return path  # model id of Hugging Face Hub
+        stat = os.stat(path)
+        return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+    identity = {"model": get_file_identity(args.pretrained_model_name_or_path)}
+    base_weights = getattr(args, "base_weights", None)
+    if base_weights is not None:
+        multipliers = getattr(args, "base_weights_multiplier", None) or []
+        identity["base_weights"] = [
+            [get_file_identity(path), multipliers[i] if i < len(multipliers) else 1.0] for i, path in enumerate(base_weights)
+        ]
+    return identity
+
+
+def get_text_encoder_outputs_cache_key(input_ids1, input_ids2, settings: dict) -> str:
+    # トークナイズしたキャプションとText Encoderの設定から、キャッシュのキーを作る
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    for input_ids in [input_ids1, input_ids2]:
+        if input_ids is not None:
+            hasher.update(str(tuple(input_ids.shape)).encode("utf-8"))
+            hasher.update(input_ids.cpu().numpy().astype(np.int64).tobytes())
+    return hasher.hexdigest()
+
+
+def is_disk_cached_text_encoder_outputs_is_expected(npz_path, tokenizer_max_length, clip_skip):
+    # SD1/2用: SDXLのキャッシュや、異なるmax_token_length、clip_skipで作られたキャッシュは使わない
+    if not os.path.exists(npz_path):
+        return False
+
+    try:
+        with np.load(npz_path) as f:
+            if "hidden_state2" in f:  # SDXL
+                return False
+            if f["hidden_state1"].shape[0] != tokenizer_max_length:
+                return False
+            cached_clip_skip = int(f["clip_skip"]) if "clip_skip" in f else None
+            if cached_clip_skip != clip_skip:
+                return False
+    except Exception as e:
+        print(f"Error loading file: {npz_path}")
+        raise e
+
+    return True
 
 
 def load_text_encoder_outputs_from_disk(npz_path):
     with np.load(npz_path) as f:
-        hidden_state1 = torch.from_numpy(f["hidden_state1"])
-        hidden_state2 = torch.from_numpy(f["hidden_state2"]) if "hidden_state2" in f else None
-        pool2 = torch.from_numpy(f["pool2"]) if "pool2" in f else None
+        storage_dtype = get_npz_storage_dtype(f)  # fp16/bf16で保存されている場合はfloat32に戻す
+        hidden_state1 = storage_array_to_tensor(f["hidden_state1"], storage_dtype)
+        hidden_state2 = storage_array_to_tensor(f["hidden_state2"], storage_dtype) if "hidden_state2" in f else None
+        pool2 = storage_array_to_tensor(f["pool2"], storage_dtype) if "pool2" in f else None
     return hidden_state1, hidden_state2, pool2
 
 
@@ -2342,13 +3264,8 @@ def precalculate_safetensors_hashes(tensors, metadata):
     # Because writing user metadata to the file can change the result of
     # sd_models.model_hash(), only retain the training metadata for purposes of
     # calculating the hash, as they are meant to be immutable
-    metadata = {k: v for k, v in metadata.items() if k.startswith("ss_")}
-
-    bytes = safetensors.torch.save(tensors, metadata)
-    b = BytesIO(bytes)
-
-    model_hash = addnet_hash_safetensors(b)
-    legacy_hash = addnet_hash_legacy(b)
+    # safetensors_utils.get_hash_metadata keeps ss_* only. the tensors are hashed one by one without serializing the file
+    model_hash, legacy_hash, _ = safetensors_utils.calculate_hashes(tensors, metadata)
     return model_hash, legacy_hash
 
 
@@ -2738,6 +3655,24 @@ def add_training_arguments(parser: argparse.ArgumentParser, support_dreambooth:
         action="store_true",
         help="upload to huggingface asynchronously / huggingfaceに非同期でアップロードする",
     )
+    parser.add_argument(
+        "--async_upload_workers",
+        type=int,
+        default=1,
+        help="number of concurrent uploads with --async_upload / --async_upload で同時に行うアップロード数",
+    )
+    parser.add_argument(
+        "--async_upload_max_pending",
+        type=int,
+        default=4,
+        help="number of uploads waiting in the queue with --async_upload, next upload waits if exceeded / --async_upload で待機できるアップロード数、超えると次のアップロードは待つ",
+    )
+    parser.add_argument(
+        "--huggingface_upload_retries",
+        type=int,
+        default=3,
+        help="number of retries of failed uploads to huggingface / huggingfaceへのアップロードに失敗したときの再試行回数",
+    )
     parser.add_argument(
         "--save_precision",
         type=str,
@@ -2745,6 +3680,19 @@ def add_training_arguments(parser: argparse.ArgumentParser, support_dreambooth:
         choices=[None, "float", "fp16", "bf16"],
         help="precision in saving / 保存時に精度を変更して保存する",
     )
+    parser.add_argument(
+        "--async_save",
+        action="store_true",
+        help="save checkpoints in background: weights are copied to CPU memory and written while training continues (StableDiffusion format and networks)"
+        + " / チェックポイントをバックグラウンドで保存する。重みをCPUメモリにコピーし、学習を続けながら書き込む（StableDiffusion形式とnetwork）",
+    )
+    parser.add_argument(
+        "--async_save_max_pending",
+        type=int,
+        default=1,
+        help="number of checkpoints waiting to be written with --async_save, next save waits if exceeded (each takes CPU memory of the model size)"
+        + " / --async_save で書き込み待ちにできるチェックポイント数、超えると次の保存は待つ（それぞれモデルサイズのCPUメモリを使う）",
+    )
     parser.add_argument(
         "--save_every_n_epochs", type=int, default=None, help="save checkpoint every N epochs / 学習中のモデルを指定エポックごとに保存する"
     )
@@ -2957,6 +3905,24 @@ def add_training_arguments(parser: argparse.ArgumentParser, support_dreambooth:
     parser.add_argument(
         "--sample_prompts", type=str, default=None, help="file for prompts to generate sample images / 学習中モデルのサンプル出力用プロンプトのファイル"
     )
+    parser.add_argument(
+        "--sample_in_background",
+        action="store_true",
+        help="generate sample images in a separate process while training continues. the process loads the models once and receives the trained weights"
+        + " / サンプル画像を別プロセスで生成し、学習を続ける。プロセスはモデルを一度だけ読み込み、学習中の重みを受け取る",
+    )
+    parser.add_argument(
+        "--sample_device",
+        type=str,
+        default=None,
+        help="device for --sample_in_background, e.g. cuda:1 (default: same as training) / --sample_in_background で使うデバイス、例: cuda:1（省略時は学習と同じ）",
+    )
+    parser.add_argument(
+        "--sample_max_pending",
+        type=int,
+        default=1,
+        help="number of sample jobs waiting for --sample_in_background, next sampling waits if exceeded / --sample_in_background で待機できるサンプル生成の数、超えると次の生成は待つ",
+    )
     parser.add_argument(
         "--sample_sampler",
         type=str,
@@ -3037,6 +4003,10 @@ def verify_training_args(args: argparse.Namespace):
     if args.v2 and args.clip_skip is not None:
         print("v2 with clip_skip will be unexpected / v2でclip_skipを使用することは想定されていません")
 
+    if args.latents_cache_dir is not None and not args.cache_latents_to_disk:
+        args.cache_latents_to_disk = True
+        print("latents_cache_dir is specified, so cache_latents_to_disk is also enabled / latents_cache_dirが指定されたため、cache_latents_to_diskを有効にします")
+
     if args.cache_latents_to_disk and not args.cache_latents:
         args.cache_latents = True
         print(
@@ -3133,6 +4103,12 @@ def add_dataset_arguments(
         default=None,
         help="resolution in training ('size' or 'width,height') / 学習時の画像解像度（'サイズ'指定、または'幅,高さ'指定）",
     )
+    parser.add_argument(
+        "--cache_info",
+        action="store_true",
+        help="cache image sizes and captions to a file in each image directory for faster dataset loading on next launch"
+        + " / 次回以降のデータセット読み込みを高速化するため、画像サイズとcaptionを画像ディレクトリごとのファイルにキャッシュする",
+    )
     parser.add_argument(
         "--cache_latents",
         action="store_true",
@@ -3144,6 +4120,49 @@ def add_dataset_arguments(
         action="store_true",
         help="cache latents to disk to reduce VRAM usage (augmentations must be disabled) / VRAM削減のためにlatentをディスクにcacheする（augmentationは使用不可）",
     )
+    parser.add_argument(
+        "--cache_latents_workers",
+        type=int,
+        default=0,
+        help="number of threads to load/resize images and save latents in background while caching latents (0 for sequential)"
+        + " / latentのcache時に、画像の読み込み・リサイズとlatentの保存をバックグラウンドで行うスレッド数（0で逐次処理）",
+    )
+    parser.add_argument(
+        "--cache_storage_dtype",
+        type=str,
+        default="float32",
+        choices=CACHE_STORAGE_DTYPES,
+        help="dtype to store cached latents and text encoder outputs on disk (upcast to float32 on load)"
+        + " / ディスクにキャッシュするlatentとText Encoderの出力の保存形式（読み込み時にfloat32に戻す）",
+    )
+    parser.add_argument(
+        "--cache_compress",
+        action="store_true",
+        help="compress npz of cached latents and text encoder outputs (zip deflate). saves disk space, but loading is slower"
+        + " (about 3x-4x for fp16 latents), use it only when the disk space or the bandwidth of the storage is the limit"
+        + " / キャッシュするlatentとText Encoderの出力のnpzを圧縮する（zip deflate）。ディスク容量は減るが読み込みは遅くなる"
+        + "（fp16のlatentで3～4倍程度）ため、ディスク容量やストレージの帯域が制約になる場合のみ使用する",
+    )
+    parser.add_argument(
+        "--gpu_augmentation",
+        action="store_true",
+        help="apply color_aug and flip_aug to the batch on the training device instead of each image in DataLoader workers"
+        + " / color_augとflip_augを、DataLoaderのworkerで画像ごとに行う代わりに、学習デバイス上でbatchごとに行う",
+    )
+    parser.add_argument(
+        "--image_ram_cache_size",
+        type=int,
+        default=0,
+        help="size in MB of RAM cache for decoded and resized images, shared by DataLoader workers. used if latents are not cached (0 to disable)"
+        + " / デコード・リサイズ済みの画像をRAMにキャッシュする容量（MB）、DataLoaderのworker間で共有する。latentをキャッシュしない場合に使われる（0で無効）",
+    )
+    parser.add_argument(
+        "--latents_cache_dir",
+        type=str,
+        default=None,
+        help="cache latents to sharded, memory-mapped files in this directory instead of .npz next to each image (enables cache_latents_to_disk)"
+        + " / 画像ごとの.npzの代わりに、このディレクトリのshardファイルにlatentをまとめてキャッシュする（cache_latents_to_diskが有効になります）",
+    )
     parser.add_argument(
         "--enable_bucket", action="store_true", help="enable buckets for multi aspect ratio training / 複数解像度学習のためのbucketを有効にする"
     )
@@ -4090,6 +5109,25 @@ def get_remove_step_no(args: argparse.Namespace, step_no: int):
     return remove_step_no
 
 
+_checkpoint_writer: Optional[checkpoint_writer.CheckpointWriter] = None
+
+
+def get_checkpoint_writer(args: argparse.Namespace) -> Optional[checkpoint_writer.CheckpointWriter]:
+    # --async_save の場合、バックグラウンドで保存するためのwriterを返す（プロセスで一つ）
+    global _checkpoint_writer
+    if not args.async_save:
+        return None
+    if _checkpoint_writer is None:
+        _checkpoint_writer = checkpoint_writer.CheckpointWriter(args.async_save_max_pending)
+    return _checkpoint_writer
+
+
+def flush_checkpoint_writer():
+    # バックグラウンドでの保存の完了を待つ / wait until the checkpoints are written
+    if _checkpoint_writer is not None:
+        _checkpoint_writer.flush()
+
+
 # epochとstepの保存、メタデータにepoch/stepが含まれ引数が同じになるため、統合している
 # on_epoch_end: Trueならepoch終了時、Falseならstep経過時
 def save_sd_model_on_epoch_end_or_stepwise(
@@ -4107,12 +5145,20 @@ def save_sd_model_on_epoch_end_or_stepwise(
     unet,
     vae,
 ):
-    def sd_saver(ckpt_file, epoch_no, global_step):
+    def sd_saver(ckpt_file, epoch_no, global_step, text_encoder=text_encoder, unet=unet, vae=vae):
         sai_metadata = get_sai_model_spec(None, args, False, False, False, is_stable_diffusion_ckpt=True)
         model_util.save_stable_diffusion_checkpoint(
             args.v2, ckpt_file, text_encoder, unet, src_path, epoch_no, global_step, sai_metadata, save_dtype, vae
         )
 
+    def sd_snapshot():
+        # バックグラウンドで保存するため、重みをコピーする / copy the weights to save them in background
+        return {
+            "text_encoder": checkpoint_writer.StateDictSnapshot(text_encoder, save_dtype),
+            "unet": checkpoint_writer.StateDictSnapshot(unet, save_dtype),
+            "vae": checkpoint_writer.StateDictSnapshot(vae, save_dtype),
+        }
+
     def diffusers_saver(out_dir):
         model_util.save_diffusers_checkpoint(
             args.v2, out_dir, text_encoder, unet, src_path, vae=vae, use_safetensors=use_safetensors
@@ -4129,6 +5175,7 @@ def save_sd_model_on_epoch_end_or_stepwise(
         global_step,
         sd_saver,
         diffusers_saver,
+        sd_snapshot,
     )
 
 
@@ -4143,7 +5190,13 @@ def save_sd_model_on_epoch_end_or_stepwise_common(
     global_step: int,
     sd_saver,
     diffusers_saver,
+    sd_snapshot=None,
 ):
+    r"""
+    sd_saver(ckpt_file, epoch_no, global_step, **models) saves the models, sd_snapshot() returns the copies of the models
+    as kwargs of sd_saver. if both --async_save and sd_snapshot are given, the checkpoint is saved from the copies in
+    background, and the upload and the removal of the old checkpoint follow it in the writer thread
+    """
     if on_epoch_end:
         epoch_no = epoch + 1
         saving = epoch_no % args.save_every_n_epochs == 0 and epoch_no < num_train_epochs
@@ -4169,24 +5222,34 @@ def save_sd_model_on_epoch_end_or_stepwise_common(
             ckpt_name = get_step_ckpt_name(args, ext, global_step)
 
         ckpt_file = os.path.join(args.output_dir, ckpt_name)
-        print(f"\nsaving checkpoint: {ckpt_file}")
-        sd_saver(ckpt_file, epoch_no, global_step)
-
-        if args.huggingface_repo_id is not None:
-            huggingface_util.upload(args, ckpt_file, "/" + ckpt_name)
 
         # remove older checkpoints
+        remove_ckpt_file = None
         if remove_no is not None:
             if on_epoch_end:
                 remove_ckpt_name = get_epoch_ckpt_name(args, ext, remove_no)
             else:
                 remove_ckpt_name = get_step_ckpt_name(args, ext, remove_no)
-
             remove_ckpt_file = os.path.join(args.output_dir, remove_ckpt_name)
-            if os.path.exists(remove_ckpt_file):
+
+        def save_and_remove(models):
+            print(f"\nsaving checkpoint: {ckpt_file}")
+            sd_saver(ckpt_file, epoch_no, global_step, **models)
+
+            if args.huggingface_repo_id is not None:
+                huggingface_util.upload(args, ckpt_file, "/" + ckpt_name)
+
+            if remove_ckpt_file is not None and os.path.exists(remove_ckpt_file):
                 print(f"removing old checkpoint: {remove_ckpt_file}")
                 os.remove(remove_ckpt_file)
 
+        writer = get_checkpoint_writer(args)
+        if writer is not None and sd_snapshot is not None:
+            models = sd_snapshot()
+            writer.submit(save_and_remove, models)
+        else:
+            save_and_remove({})
+
     else:
         if on_epoch_end:
             out_dir = os.path.join(args.output_dir, EPOCH_DIFFUSERS_DIR_NAME.format(model_name, epoch_no))
@@ -4316,6 +5379,9 @@ def save_sd_model_on_train_end_common(
 ):
     model_name = default_if_none(args.output_name, DEFAULT_LAST_OUTPUT_NAME)
 
+    # the last model is saved synchronously after the checkpoints in background
+    flush_checkpoint_writer()
+
     if save_stable_diffusion_format:
         os.makedirs(args.output_dir, exist_ok=True)
 
@@ -4377,43 +5443,7 @@ def sample_images(*args, **kwargs):
     return sample_images_common(StableDiffusionLongPromptWeightingPipeline, *args, **kwargs)
 
 
-def sample_images_common(
-    pipe_class,
-    accelerator,
-    args: argparse.Namespace,
-    epoch,
-    steps,
-    device,
-    vae,
-    tokenizer,
-    text_encoder,
-    unet,
-    prompt_replacement=None,
-    controlnet=None,
-):
-    """
-    StableDiffusionLongPromptWeightingPipelineの改造版を使うようにしたので、clip skipおよびプロンプトの重みづけに対応した
-    """
-    if args.sample_every_n_steps is None and args.sample_every_n_epochs is None:
-        return
-    if args.sample_every_n_epochs is not None:
-        # sample_every_n_steps は無視する
-        if epoch is None or epoch % args.sample_every_n_epochs != 0:
-            return
-    else:
-        if steps % args.sample_every_n_steps != 0 or epoch is not None:  # steps is not divisible or end of epoch
-            return
-
-    print(f"\ngenerating sample images at step / サンプル画像生成 ステップ: {steps}")
-    if not os.path.isfile(args.sample_prompts):
-        print(f"No prompt file / プロンプトファイルがありません: {args.sample_prompts}")
-        return
-
-    org_vae_device = vae.device  # CPUにいるはず
-    vae.to(device)
-
-    # read prompts
-
+def load_sample_prompts(args: argparse.Namespace):
     # with open(args.sample_prompts, "rt", encoding="utf-8") as f:
     #     prompts = f.readlines()
 
@@ -4428,8 +5458,10 @@ def sample_images_common(
     elif args.sample_prompts.endswith(".json"):
         with open(args.sample_prompts, "r", encoding="utf-8") as f:
             prompts = json.load(f)
+    return prompts
 
-    # schedulerを用意する
+
+def get_sample_scheduler(args: argparse.Namespace):
     sched_init_args = {}
     if args.sample_sampler == "ddim":
         scheduler_cls = DDIMScheduler
@@ -4473,31 +5505,23 @@ def sample_images_common(
         # print("set clip_sample to True")
         scheduler.config.clip_sample = True
 
-    pipeline = pipe_class(
-        text_encoder=text_encoder,
-        vae=vae,
-        unet=unet,
-        tokenizer=tokenizer,
-        scheduler=scheduler,
-        safety_checker=None,
-        feature_extractor=None,
-        requires_safety_checker=False,
-        clip_skip=args.clip_skip,
-    )
-    pipeline.to(device)
+    return scheduler
+
 
+def generate_sample_images(
+    pipeline, args: argparse.Namespace, epoch, steps, prompts, autocast, prompt_replacement=None, controlnet=None, log_image=None
+):
+    r"""
+    generates the sample images with pipeline and saves them to {output_dir}/sample. returns the list of the records of the
+    images (file name and generation parameters). autocast is a context manager factory, log_image(i, image) is called for
+    each image if given
+    """
     save_dir = args.output_dir + "/sample"
     os.makedirs(save_dir, exist_ok=True)
 
-    rng_state = torch.get_rng_state()
-    cuda_rng_state = torch.cuda.get_rng_state() if torch.cuda.is_available() else None
-
+    records = []
     with torch.no_grad():
-        # with accelerator.autocast():
         for i, prompt in enumerate(prompts):
-            if not accelerator.is_main_process:
-                continue
-
             if isinstance(prompt, dict):
                 negative_prompt = prompt.get("negative_prompt")
                 sample_steps = prompt.get("sample_steps", 30)
@@ -4583,7 +5607,7 @@ def sample_images_common(
             print(f"width: {width}")
             print(f"sample_steps: {sample_steps}")
             print(f"scale: {scale}")
-            with accelerator.autocast():
+            with autocast():
                 latents = pipeline(
                     prompt=prompt,
                     height=height,
@@ -4605,18 +5629,117 @@ def sample_images_common(
             )
 
             image.save(os.path.join(save_dir, img_filename))
+            records.append(
+                {
+                    "file": img_filename,
+                    "epoch": epoch,
+                    "steps": steps,
+                    "index": i,
+                    "prompt": prompt,
+                    "negative_prompt": negative_prompt,
+                    "width": width,
+                    "height": height,
+                    "sample_steps": sample_steps,
+                    "scale": scale,
+                    "seed": seed,
+                }
+            )
+
+            if log_image is not None:
+                log_image(i, image)
+
+    return records
 
-            # wandb有効時のみログを送信
+
+def sample_images_common(
+    pipe_class,
+    accelerator,
+    args: argparse.Namespace,
+    epoch,
+    steps,
+    device,
+    vae,
+    tokenizer,
+    text_encoder,
+    unet,
+    prompt_replacement=None,
+    controlnet=None,
+    network=None,
+    allow_background=True,
+):
+    """
+    StableDiffusionLongPromptWeightingPipelineの改造版を使うようにしたので、clip skipおよびプロンプトの重みづけに対応した
+    network: trained network (LoRA etc.), used with --sample_in_background to send its weights instead of the models
+    allow_background: False to generate in the training process even with --sample_in_background (Textual Inversion)
+    """
+    if args.sample_every_n_steps is None and args.sample_every_n_epochs is None:
+        return
+    if args.sample_every_n_epochs is not None:
+        # sample_every_n_steps は無視する
+        if epoch is None or epoch % args.sample_every_n_epochs != 0:
+            return
+    else:
+        if steps % args.sample_every_n_steps != 0 or epoch is not None:  # steps is not divisible or end of epoch
+            return
+
+    if args.sample_in_background and accelerator.is_main_process:
+        if controlnet is None and allow_background:
+            if isinstance(text_encoder, (list, tuple)):
+                text_encoder = [accelerator.unwrap_model(t) for t in text_encoder]
+            else:
+                text_encoder = accelerator.unwrap_model(text_encoder)
+            submit_sample_job(args, pipe_class, epoch, steps, device, text_encoder, accelerator.unwrap_model(unet), network)
+            return
+        print("sample images are generated in training process for ControlNet and Textual Inversion")
+
+    print(f"\ngenerating sample images at step / サンプル画像生成 ステップ: {steps}")
+    if not os.path.isfile(args.sample_prompts):
+        print(f"No prompt file / プロンプトファイルがありません: {args.sample_prompts}")
+        return
+
+    org_vae_device = vae.device  # CPUにいるはず
+    vae.to(device)
+
+    # read prompts
+    prompts = load_sample_prompts(args)
+
+    # schedulerを用意する
+    scheduler = get_sample_scheduler(args)
+
+    pipeline = pipe_class(
+        text_encoder=text_encoder,
+        vae=vae,
+        unet=unet,
+        tokenizer=tokenizer,
+        scheduler=scheduler,
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+        clip_skip=args.clip_skip,
+    )
+    pipeline.to(device)
+
+    rng_state = torch.get_rng_state()
+    cuda_rng_state = torch.cuda.get_rng_state() if torch.cuda.is_available() else None
+
+    def log_image(i, image):
+        # wandb有効時のみログを送信
+        try:
+            wandb_tracker = accelerator.get_tracker("wandb")
             try:
-                wandb_tracker = accelerator.get_tracker("wandb")
-                try:
-                    import wandb
-                except ImportError:  # 事前に一度確認するのでここはエラー出ないはず
-                    raise ImportError("No wandb / wandb がインストールされていないようです")
-
-                wandb_tracker.log({f"sample_{i}": wandb.Image(image)})
-            except:  # wandb 無効時
-                pass
+                import wandb
+            except ImportError:  # 事前に一度確認するのでここはエラー出ないはず
+                raise ImportError("No wandb / wandb がインストールされていないようです")
+
+            wandb_tracker.log({f"sample_{i}": wandb.Image(image)})
+        except:  # wandb 無効時
+            pass
+
+    if accelerator.is_main_process:
+        # with accelerator.autocast():
+        generate_sample_images(
+            pipeline, args, epoch, steps, prompts, accelerator.autocast, prompt_replacement, controlnet, log_image
+        )
 
     # clear pipeline and cache to reduce vram usage
     del pipeline
@@ -4628,6 +5751,30 @@ def sample_images_common(
     vae.to(org_vae_device)
 
 
+_sample_worker = None
+
+
+def submit_sample_job(args: argparse.Namespace, pipe_class, epoch, steps, device, text_encoder, unet, network=None):
+    # 学習中の重みをコピーして、サンプル画像生成用のプロセスに送る
+    # the worker has its own copy of the base models, so only the trained weights are sent: the network, or the U-Net and
+    # the Text Encoder(s) for fine tuning
+    global _sample_worker
+    from library import sample_worker
+
+    is_sdxl = isinstance(text_encoder, (list, tuple))
+    if _sample_worker is None:
+        _sample_worker = sample_worker.SampleWorker(args, pipe_class, is_sdxl, str(device))
+
+    if network is not None:
+        state_dicts = {"network": sample_worker.copy_state_dict(network.state_dict())}
+    else:
+        text_encoders = text_encoder if isinstance(text_encoder, (list, tuple)) else [text_encoder]
+        state_dicts = {f"text_encoder{i}": sample_worker.copy_state_dict(t.state_dict()) for i, t in enumerate(text_encoders)}
+        state_dicts["unet"] = sample_worker.copy_state_dict(unet.state_dict())
+
+    print(f"\nsubmit sample images at step to background / サンプル画像生成をバックグラウンドで行います ステップ: {steps}")
+    _sample_worker.submit(epoch, steps, state_dicts)
+
 # endregion
 
 # region 前処理用
@@ -428,17 +428,10 @@ class DyLoRANetwork(torch.nn.Module):
                 state_dict[key] = v
 
         if os.path.splitext(file)[1] == ".safetensors":
-            from safetensors.torch import save_file
-            from library import train_util
+            from library import safetensors_utils
 
-            # Precalculate model hashes to save time on indexing
-            if metadata is None:
-                metadata = {}
-            model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(state_dict, metadata)
-            metadata["sshs_model_hash"] = model_hash
-            metadata["sshs_legacy_hash"] = legacy_hash
-
-            save_file(state_dict, file, metadata)
+            # Calculate model hashes while writing to save time on indexing
+            safetensors_utils.save_file(state_dict, file, metadata, add_hashes=True)
         else:
             torch.save(state_dict, file)
 
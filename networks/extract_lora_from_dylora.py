@@ -6,9 +6,9 @@ import argparse
 import math
 import os
 import torch
-from safetensors.torch import load_file, save_file, safe_open
+from safetensors.torch import load_file, safe_open
 from tqdm import tqdm
-from library import train_util, model_util
+from library import model_util, safetensors_utils
 import numpy as np
 
 
@@ -26,7 +26,7 @@ def load_state_dict(file_name):
 
 def save_to_file(file_name, model, metadata):
     if model_util.is_safetensors(file_name):
-        save_file(model, file_name, metadata)
+        safetensors_utils.save_file(model, file_name, metadata, add_hashes=True)  # hashes are calculated while writing
     else:
         torch.save(model, file_name)
 
@@ -87,10 +87,6 @@ def split(args):
         new_metadata["ss_network_dim"] = str(new_rank)
         # new_metadata["ss_network_alpha"] = str(new_alpha.float().numpy())
 
-        model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(state_dict, metadata)
-        metadata["sshs_model_hash"] = model_hash
-        metadata["sshs_legacy_hash"] = legacy_hash
-
         filename, ext = os.path.splitext(args.save_to)
         model_file_name = filename + f"-{new_rank:04d}{ext}"
 
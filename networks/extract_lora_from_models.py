@@ -8,8 +8,7 @@ import os
 import time
 import torch
 from safetensors.torch import load_file, save_file
-from tqdm import tqdm
-from library import sai_model_spec, model_util, sdxl_model_util
+from library import sai_model_spec, model_util, sdxl_model_util, svd_util
 import lora
 
 # CLAMP_QUANTILE = 1
@@ -27,6 +26,50 @@ def save_to_file(file_name, model, state_dict, dtype):
         torch.save(model, file_name)
 
 
+def extract_lora_module(mat, dim, conv_dim, device, clamp_quantile, svd_method, svd_niter):
+    # 差分の重みから1モジュール分のLoRAを抽出する。svd_util.map_modulesで別プロセスから呼ばれることもある
+    with torch.no_grad():
+        # if conv_dim is None, diffs do not include LoRAs for conv2d-3x3
+        conv2d = len(mat.size()) == 4
+        kernel_size = None if not conv2d else mat.size()[2:4]
+        conv2d_3x3 = conv2d and kernel_size != (1, 1)
+
+        rank = dim if not conv2d_3x3 or conv_dim is None else conv_dim
+        out_dim, in_dim = mat.size()[0:2]
+
+        if device:
+            mat = mat.to(device)
+
+        # print(lora_name, mat.size(), mat.device, rank, in_dim, out_dim)
+        rank = min(rank, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
+
+        if conv2d:
+            if conv2d_3x3:
+                mat = mat.flatten(start_dim=1)
+            else:
+                mat = mat.squeeze()
+
+        U, S, Vh, error = svd_util.truncated_svd(mat, rank, svd_method, niter=svd_niter)
+
+        U = U @ torch.diag(S)
+
+        dist = torch.cat([U.flatten(), Vh.flatten()])
+        hi_val = torch.quantile(dist, clamp_quantile)
+        low_val = -hi_val
+
+        U = U.clamp(low_val, hi_val)
+        Vh = Vh.clamp(low_val, hi_val)
+
+        if conv2d:
+            U = U.reshape(out_dim, rank, 1, 1)
+            Vh = Vh.reshape(rank, in_dim, kernel_size[0], kernel_size[1])
+
+        U = U.to("cpu").contiguous()
+        Vh = Vh.to("cpu").contiguous()
+
+    return U, Vh, error
+
+
 def svd(args):
     def str_to_dtype(p):
         if p == "float":
@@ -114,53 +157,23 @@ def svd(args):
         diffs[lora_name] = diff
 
     # make LoRA with svd
-    print("calculating by svd")
+    print(f"calculating by svd: {args.svd_method}")
     lora_weights = {}
-    with torch.no_grad():
-        for lora_name, mat in tqdm(list(diffs.items())):
-            # if args.conv_dim is None, diffs do not include LoRAs for conv2d-3x3
-            conv2d = len(mat.size()) == 4
-            kernel_size = None if not conv2d else mat.size()[2:4]
-            conv2d_3x3 = conv2d and kernel_size != (1, 1)
-
-            rank = args.dim if not conv2d_3x3 or args.conv_dim is None else args.conv_dim
-            out_dim, in_dim = mat.size()[0:2]
-
-            if args.device:
-                mat = mat.to(args.device)
+    errors = []
 
-            # print(lora_name, mat.size(), mat.device, rank, in_dim, out_dim)
-            rank = min(rank, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
+    def module_args():
+        for lora_name, mat in diffs.items():
+            if args.svd_workers > 0:
+                mat = mat.to("cpu")  # tensors are sent to worker processes
+            yield (mat, args.dim, args.conv_dim, args.device, args.clamp_quantile, args.svd_method, args.svd_niter)
 
-            if conv2d:
-                if conv2d_3x3:
-                    mat = mat.flatten(start_dim=1)
-                else:
-                    mat = mat.squeeze()
+    results = svd_util.map_modules(extract_lora_module, module_args(), args.svd_workers, len(diffs))
+    for lora_name, (U, Vh, error) in zip(list(diffs.keys()), results):
+        errors.append(error)
+        lora_weights[lora_name] = (U, Vh)
 
-            U, S, Vh = torch.linalg.svd(mat)
-
-            U = U[:, :rank]
-            S = S[:rank]
-            U = U @ torch.diag(S)
-
-            Vh = Vh[:rank, :]
-
-            dist = torch.cat([U.flatten(), Vh.flatten()])
-            hi_val = torch.quantile(dist, args.clamp_quantile)
-            low_val = -hi_val
-
-            U = U.clamp(low_val, hi_val)
-            Vh = Vh.clamp(low_val, hi_val)
-
-            if conv2d:
-                U = U.reshape(out_dim, rank, 1, 1)
-                Vh = Vh.reshape(rank, in_dim, kernel_size[0], kernel_size[1])
-
-            U = U.to("cpu").contiguous()
-            Vh = Vh.to("cpu").contiguous()
-
-            lora_weights[lora_name] = (U, Vh)
+    if len(errors) > 0:
+        print(f"relative Frobenius error of low rank approximation: mean {sum(errors) / len(errors):.4f}, max {max(errors):.4f}")
 
     # make state dict for LoRA
     lora_sd = {}
@@ -248,6 +261,27 @@ def setup_parser() -> argparse.ArgumentParser:
         help="dimension (rank) of LoRA for Conv2d-3x3 (default None, disabled) / LoRAのConv2d-3x3の次元数（rank）（デフォルトNone、適用なし）",
     )
     parser.add_argument("--device", type=str, default=None, help="device to use, cuda for GPU / 計算を行うデバイス、cuda でGPUを使う")
+    parser.add_argument(
+        "--svd_method",
+        type=str,
+        default="exact",
+        choices=svd_util.SVD_METHODS,
+        help="SVD method. randomized is much faster on CPU and prints the approximation error (default: exact)"
+        + " / SVDの方法。randomizedはCPUで大幅に高速で、近似誤差を表示する（デフォルト: exact）",
+    )
+    parser.add_argument(
+        "--svd_niter",
+        type=int,
+        default=svd_util.DEFAULT_NITER,
+        help="number of power iterations for randomized SVD / randomized SVDのpower iterationの回数",
+    )
+    parser.add_argument(
+        "--svd_workers",
+        type=int,
+        default=0,
+        help="number of worker processes to extract modules in parallel (0: in main process)"
+        + " / モジュールを並列に抽出するプロセス数（0でメインプロセスのみ）",
+    )
     parser.add_argument(
         "--clamp_quantile",
         type=float,
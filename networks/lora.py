@@ -380,6 +380,88 @@ class LoRAInfModule(LoRAModule):
         return out
 
 
+class FusedLoRAInfModule(torch.nn.Module):
+    """
+    replaces forward of the original module on behalf of LoRAInfModules of several networks applied to the same module.
+    downs are concatenated to one down (sum of ranks) and ups to one up, so the networks cost one pair of GEMMs (convs)
+    instead of N nested forwards. multiplier * scale of each network is kept as a scale vector over the ranks, which is
+    updated when the multipliers of the networks are changed (set_multiplier). regional LoRA is not supported.
+    """
+
+    def __init__(self, loras: List[LoRAInfModule]):
+        super().__init__()
+        self.lora_names = [lora.lora_name for lora in loras]
+        self.loras = loras  # not registered as submodules, the weights are owned by the networks
+        self.ranks = [lora.lora_dim for lora in loras]
+
+        down = loras[0].lora_down
+        self.is_conv = isinstance(down, torch.nn.Conv2d)
+        if self.is_conv:
+            self.stride = down.stride
+            self.padding = down.padding
+
+        # (sum of ranks, in) and (out, sum of ranks), or conv weights
+        self.register_buffer("down_weight", torch.cat([lora.lora_down.weight.detach() for lora in loras], dim=0))
+        self.register_buffer("up_weight", torch.cat([lora.lora_up.weight.detach() for lora in loras], dim=1))
+        self.register_buffer("scale_vector", torch.ones(sum(self.ranks), dtype=self.down_weight.dtype, device=self.down_weight.device))
+        self.multipliers = None
+
+        # the first LoRA is applied first, so its org_forward is the forward of the original module
+        self.org_module_ref = loras[0].org_module_ref
+        self.org_forward = loras[0].org_forward
+
+    @staticmethod
+    def can_fuse(loras: List[LoRAInfModule]) -> bool:
+        if len(loras) < 2 or not all(type(lora) == LoRAInfModule for lora in loras):
+            return False
+        # the forwards must be chained only by these LoRAs, other modules may be applied to the same module
+        if loras[-1].org_module_ref[0].forward != loras[-1].forward:
+            return False
+        for prev, lora in zip(loras[:-1], loras[1:]):
+            if lora.org_forward != prev.forward:
+                return False
+
+        down = loras[0].lora_down
+        for lora in loras[1:]:
+            if type(lora.lora_down) != type(down) or lora.lora_down.weight.shape[1:] != down.weight.shape[1:]:
+                return False
+            if isinstance(down, torch.nn.Conv2d) and (lora.lora_down.stride, lora.lora_down.padding) != (down.stride, down.padding):
+                return False
+            if lora.lora_down.weight.dtype != down.weight.dtype or lora.lora_down.weight.device != down.weight.device:
+                return False
+        return True
+
+    def apply_to(self):
+        self.org_module_ref[0].forward = self.forward
+
+    def remove(self):
+        # 元のLoRAの連鎖に戻す / restore the chain of the forwards of the LoRAs
+        self.org_module_ref[0].forward = self.loras[-1].forward
+
+    def update_scale_vector(self):
+        multipliers = tuple(lora.multiplier if lora.enabled else 0.0 for lora in self.loras)
+        if multipliers == self.multipliers:
+            return
+
+        scales = [m * lora.scale for m, lora in zip(multipliers, self.loras)]
+        scale_vector = torch.cat([torch.full((rank,), s) for rank, s in zip(self.ranks, scales)])
+        self.scale_vector.copy_(scale_vector)
+        self.multipliers = multipliers
+
+    def forward(self, x):
+        self.update_scale_vector()
+
+        if self.is_conv:
+            lx = torch.nn.functional.conv2d(x, self.down_weight, stride=self.stride, padding=self.padding)
+            lx = lx * self.scale_vector.view(1, -1, 1, 1)
+            lx = torch.nn.functional.conv2d(lx, self.up_weight)
+        else:
+            lx = torch.nn.functional.linear(x, self.down_weight)
+            lx = lx * self.scale_vector
+            lx = torch.nn.functional.linear(lx, self.up_weight)
+
+        return self.org_forward(x) + lx
+
 def parse_block_lr_kwargs(nw_kwargs):
     down_lr_weight = nw_kwargs.get("down_lr_weight", None)
     mid_lr_weight = nw_kwargs.get("mid_lr_weight", None)
@@ -1088,17 +1170,10 @@ class LoRANetwork(torch.nn.Module):
                 state_dict[key] = v
 
         if os.path.splitext(file)[1] == ".safetensors":
-            from safetensors.torch import save_file
-            from library import train_util
-
-            # Precalculate model hashes to save time on indexing
-            if metadata is None:
-                metadata = {}
-            model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(state_dict, metadata)
-            metadata["sshs_model_hash"] = model_hash
-            metadata["sshs_legacy_hash"] = legacy_hash
+            from library import safetensors_utils
 
-            save_file(state_dict, file, metadata)
+            # Calculate model hashes while writing to save time on indexing
+            safetensors_utils.save_file(state_dict, file, metadata, add_hashes=True)
         else:
             torch.save(state_dict, file)
 
@@ -1182,45 +1257,73 @@ class LoRANetwork(torch.nn.Module):
             org_module._lora_restored = False
             lora.enabled = False
 
+    def get_max_norm_groups(self):
+        # LoRAモジュールを重みの形状でまとめる / group the modules by the shapes of up and down, to process a group at once
+        if getattr(self, "_max_norm_groups", None) is None:
+            groups = {}
+            for lora in self.text_encoder_loras + self.unet_loras:
+                up = lora.lora_up.weight
+                down = lora.lora_down.weight
+                groups.setdefault((tuple(up.shape), tuple(down.shape), up.dtype), []).append(lora)
+            self._max_norm_groups = list(groups.values())
+        return self._max_norm_groups
+
     def apply_max_norm_regularization(self, max_norm_value, device):
-        downkeys = []
-        upkeys = []
-        alphakeys = []
+        r"""
+        scales lora_up and lora_down of the modules whose weight (up @ down * alpha / dim) has a larger norm than max_norm_value.
+        the norm is calculated from rank x rank Gram matrices, ||U D||^2 = sum((U^T U) * (D D^T)), without the product.
+        up of conv is 1x1, so conv (1x1 or 3x3) is same as linear with the flattened down. returns (number of scaled modules,
+        mean norm, max norm) with one synchronization
+        """
         norms = []
-        keys_scaled = 0
+        ratios = []
+        with torch.no_grad():
+            for loras in self.get_max_norm_groups():
+                ups = torch.stack([lora.lora_up.weight.reshape(lora.lora_up.weight.shape[0], -1) for lora in loras])
+                downs = torch.stack([lora.lora_down.weight.reshape(lora.lora_dim, -1) for lora in loras])
+                ups = ups.to(device, dtype=torch.float32)  # (B, out, rank)
+                downs = downs.to(device, dtype=torch.float32)  # (B, rank, in * kernel size)
+                scales = torch.stack([lora.alpha.to(device, dtype=torch.float32) / lora.lora_dim for lora in loras]).abs()
+
+                gram_up = torch.bmm(ups.transpose(1, 2), ups)
+                gram_down = torch.bmm(downs, downs.transpose(1, 2))
+                norm = (gram_up * gram_down).sum(dim=(1, 2)).clamp(min=0).sqrt() * scales
+
+                clamped_norm = norm.clamp(min=max_norm_value / 2)
+                desired = torch.clamp(clamped_norm, max=max_norm_value)
+                ratio = desired / clamped_norm
+                sqrt_ratio = ratio.sqrt()
+                for i, lora in enumerate(loras):
+                    lora.lora_up.weight.mul_(sqrt_ratio[i].to(lora.lora_up.weight.device))
+                    lora.lora_down.weight.mul_(sqrt_ratio[i].to(lora.lora_down.weight.device))
+
+                norms.append(norm * ratio)
+                ratios.append(ratio)
+
+        norms = torch.cat(norms)
+        keys_scaled = (torch.cat(ratios) != 1).sum()
+        keys_scaled, mean_norm, max_norm = torch.stack([keys_scaled.float(), norms.mean(), norms.max()]).tolist()
+        return int(keys_scaled), mean_norm, max_norm
+
+
+def fuse_networks(networks: List[LoRANetwork]) -> List[FusedLoRAInfModule]:
+    r"""
+    fuses LoRAInfModules of the networks (applied with apply_to, in order) which target the same module. modules targeted
+    by one network, or by modules other than LoRAInfModule, are kept as is. returns the fused modules
+    """
+    loras_for_module = {}
+    for network in networks:
+        for lora in network.text_encoder_loras + network.unet_loras:
+            org_module = lora.org_module_ref[0] if hasattr(lora, "org_module_ref") else None
+            loras_for_module.setdefault(id(org_module), []).append(lora)
+
+    fused_modules = []
+    for key, loras in loras_for_module.items():
+        if key == id(None) or not FusedLoRAInfModule.can_fuse(loras):
+            continue
+        fused = FusedLoRAInfModule(loras)
+        fused.apply_to()
+        fused_modules.append(fused)
 
-        state_dict = self.state_dict()
-        for key in state_dict.keys():
-            if "lora_down" in key and "weight" in key:
-                downkeys.append(key)
-                upkeys.append(key.replace("lora_down", "lora_up"))
-                alphakeys.append(key.replace("lora_down.weight", "alpha"))
-
-        for i in range(len(downkeys)):
-            down = state_dict[downkeys[i]].to(device)
-            up = state_dict[upkeys[i]].to(device)
-            alpha = state_dict[alphakeys[i]].to(device)
-            dim = down.shape[0]
-            scale = alpha / dim
-
-            if up.shape[2:] == (1, 1) and down.shape[2:] == (1, 1):
-                updown = (up.squeeze(2).squeeze(2) @ down.squeeze(2).squeeze(2)).unsqueeze(2).unsqueeze(3)
-            elif up.shape[2:] == (3, 3) or down.shape[2:] == (3, 3):
-                updown = torch.nn.functional.conv2d(down.permute(1, 0, 2, 3), up).permute(1, 0, 2, 3)
-            else:
-                updown = up @ down
-
-            updown *= scale
-
-            norm = updown.norm().clamp(min=max_norm_value / 2)
-            desired = torch.clamp(norm, max=max_norm_value)
-            ratio = desired.cpu() / norm.cpu()
-            sqrt_ratio = ratio**0.5
-            if ratio != 1:
-                keys_scaled += 1
-                state_dict[upkeys[i]] *= sqrt_ratio
-                state_dict[downkeys[i]] *= sqrt_ratio
-            scalednorm = updown.norm() * ratio
-            norms.append(scalednorm.item())
-
-        return keys_scaled, sum(norms) / len(norms), max(norms)
+    print(f"fused LoRA modules of {len(networks)} networks: {len(fused_modules)} modules")
+    return fused_modules
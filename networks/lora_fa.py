@@ -1103,17 +1103,10 @@ class LoRANetwork(torch.nn.Module):
                 state_dict[key] = v
 
         if os.path.splitext(file)[1] == ".safetensors":
-            from safetensors.torch import save_file
-            from library import train_util
+            from library import safetensors_utils
 
-            # Precalculate model hashes to save time on indexing
-            if metadata is None:
-                metadata = {}
-            model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(state_dict, metadata)
-            metadata["sshs_model_hash"] = model_hash
-            metadata["sshs_legacy_hash"] = legacy_hash
-
-            save_file(state_dict, file, metadata)
+            # Calculate model hashes while writing to save time on indexing
+            safetensors_utils.save_file(state_dict, file, metadata, add_hashes=True)
         else:
             torch.save(state_dict, file)
 
@@ -1197,45 +1190,50 @@ class LoRANetwork(torch.nn.Module):
             org_module._lora_restored = False
             lora.enabled = False
 
+    def get_max_norm_groups(self):
+        # LoRAモジュールを重みの形状でまとめる / group the modules by the shapes of up and down, to process a group at once
+        if getattr(self, "_max_norm_groups", None) is None:
+            groups = {}
+            for lora in self.text_encoder_loras + self.unet_loras:
+                up = lora.lora_up.weight
+                down = lora.lora_down.weight
+                groups.setdefault((tuple(up.shape), tuple(down.shape), up.dtype), []).append(lora)
+            self._max_norm_groups = list(groups.values())
+        return self._max_norm_groups
+
     def apply_max_norm_regularization(self, max_norm_value, device):
-        downkeys = []
-        upkeys = []
-        alphakeys = []
+        r"""
+        scales lora_up and lora_down of the modules whose weight (up @ down * alpha / dim) has a larger norm than max_norm_value.
+        the norm is calculated from rank x rank Gram matrices, ||U D||^2 = sum((U^T U) * (D D^T)), without the product.
+        up of conv is 1x1, so conv (1x1 or 3x3) is same as linear with the flattened down. returns (number of scaled modules,
+        mean norm, max norm) with one synchronization
+        """
         norms = []
-        keys_scaled = 0
-
-        state_dict = self.state_dict()
-        for key in state_dict.keys():
-            if "lora_down" in key and "weight" in key:
-                downkeys.append(key)
-                upkeys.append(key.replace("lora_down", "lora_up"))
-                alphakeys.append(key.replace("lora_down.weight", "alpha"))
-
-        for i in range(len(downkeys)):
-            down = state_dict[downkeys[i]].to(device)
-            up = state_dict[upkeys[i]].to(device)
-            alpha = state_dict[alphakeys[i]].to(device)
-            dim = down.shape[0]
-            scale = alpha / dim
-
-            if up.shape[2:] == (1, 1) and down.shape[2:] == (1, 1):
-                updown = (up.squeeze(2).squeeze(2) @ down.squeeze(2).squeeze(2)).unsqueeze(2).unsqueeze(3)
-            elif up.shape[2:] == (3, 3) or down.shape[2:] == (3, 3):
-                updown = torch.nn.functional.conv2d(down.permute(1, 0, 2, 3), up).permute(1, 0, 2, 3)
-            else:
-                updown = up @ down
-
-            updown *= scale
-
-            norm = updown.norm().clamp(min=max_norm_value / 2)
-            desired = torch.clamp(norm, max=max_norm_value)
-            ratio = desired.cpu() / norm.cpu()
-            sqrt_ratio = ratio**0.5
-            if ratio != 1:
-                keys_scaled += 1
-                state_dict[upkeys[i]] *= sqrt_ratio
-                state_dict[downkeys[i]] *= sqrt_ratio
-            scalednorm = updown.norm() * ratio
-            norms.append(scalednorm.item())
-
-        return keys_scaled, sum(norms) / len(norms), max(norms)
+        ratios = []
+        with torch.no_grad():
+            for loras in self.get_max_norm_groups():
+                ups = torch.stack([lora.lora_up.weight.reshape(lora.lora_up.weight.shape[0], -1) for lora in loras])
+                downs = torch.stack([lora.lora_down.weight.reshape(lora.lora_dim, -1) for lora in loras])
+                ups = ups.to(device, dtype=torch.float32)  # (B, out, rank)
+                downs = downs.to(device, dtype=torch.float32)  # (B, rank, in * kernel size)
+                scales = torch.stack([lora.alpha.to(device, dtype=torch.float32) / lora.lora_dim for lora in loras]).abs()
+
+                gram_up = torch.bmm(ups.transpose(1, 2), ups)
+                gram_down = torch.bmm(downs, downs.transpose(1, 2))
+                norm = (gram_up * gram_down).sum(dim=(1, 2)).clamp(min=0).sqrt() * scales
+
+                clamped_norm = norm.clamp(min=max_norm_value / 2)
+                desired = torch.clamp(clamped_norm, max=max_norm_value)
+                ratio = desired / clamped_norm
+                sqrt_ratio = ratio.sqrt()
+                for i, lora in enumerate(loras):
+                    lora.lora_up.weight.mul_(sqrt_ratio[i].to(lora.lora_up.weight.device))
+                    lora.lora_down.weight.mul_(sqrt_ratio[i].to(lora.lora_down.weight.device))
+
+                norms.append(norm * ratio)
+                ratios.append(ratio)
+
+        norms = torch.cat(norms)
+        keys_scaled = (torch.cat(ratios) != 1).sum()
+        keys_scaled, mean_norm, max_norm = torch.stack([keys_scaled.float(), norms.mean(), norms.max()]).tolist()
+        return int(keys_scaled), mean_norm, max_norm
@@ -0,0 +1,269 @@
+# 生成サーバー用に、LoRAの重みをデバイス上に常駐させてリクエストごとに切り替える
+# resident LoRA registry for generation servers which change the set of LoRAs per request.
+#
+# create_network_from_weights parses the file and creates the modules for every load, and backup_weights/restore_weights/
+# pre_calculation clone and reload the whole state_dict of each module. the registry keeps the low-rank factors (up, down
+# and scale) of loaded LoRA files on the device, within a memory budget with LRU eviction, and applies/unapplies the
+# deltas (multiplier * scale * up @ down) in place on the weights of the target modules. the weights are changed in
+# float32 and cast back, so a module which has no LoRA after unapplying is restored from its CPU backup every
+# restore_interval updates, to avoid accumulating rounding errors of fp16/bf16 weights.
+
+import collections
+import os
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+import torch
+
+from networks.lora import LoRANetwork
+
+
+class LoRAFactors(NamedTuple):
+    up: torch.Tensor
+    down: torch.Tensor
+    scale: float
+
+
+class LoRAEntry:
+    def __init__(self, path: str, factors: Dict[str, LoRAFactors]) -> None:
+        self.path = path
+        self.factors = factors
+        self.nbytes = sum(f.up.numel() * f.up.element_size() + f.down.numel() * f.down.element_size() for f in factors.values())
+
+
+def get_target_modules(text_encoder, unet) -> Dict[str, torch.nn.Module]:
+    r"""
+    returns lora_name -> Linear/Conv2d module for all modules which LoRANetwork can target (including Conv2d 3x3)
+    """
+    targets = {}
+
+    def add_targets(prefix, root_module, target_replace_modules):
+        for name, module in root_module.named_modules():
+            if module.__class__.__name__ in target_replace_modules:
+                for child_name, child_module in module.named_modules():
+                    if child_module.__class__.__name__ in ["Linear", "Conv2d"]:
+                        lora_name = (prefix + "." + name + "." + child_name).replace(".", "_")
+                        targets[lora_name] = child_module
+
+    text_encoders = text_encoder if type(text_encoder) == list else [text_encoder]
+    for i, text_encoder in enumerate(text_encoders):
+        if len(text_encoders) == 1:
+            prefix = LoRANetwork.LORA_PREFIX_TEXT_ENCODER
+        else:
+            prefix = LoRANetwork.LORA_PREFIX_TEXT_ENCODER1 if i == 0 else LoRANetwork.LORA_PREFIX_TEXT_ENCODER2
+        add_targets(prefix, text_encoder, LoRANetwork.TEXT_ENCODER_TARGET_REPLACE_MODULE)
+
+    unet_target_modules = LoRANetwork.UNET_TARGET_REPLACE_MODULE + LoRANetwork.UNET_TARGET_REPLACE_MODULE_CONV2D_3X3
+    add_targets(LoRANetwork.LORA_PREFIX_UNET, unet, unet_target_modules)
+    return targets
+
+
+def load_factors(path: str, device, dtype) -> Dict[str, LoRAFactors]:
+    # パスはサーバーのクライアントから渡されるので、任意のpickleを読み込まないようにsafetensorsのみ受け付ける
+    # the paths come from the clients of the server, so only .safetensors is accepted (torch.load unpickles any file)
+    if os.path.splitext(path)[1] != ".safetensors":
+        raise ValueError(f"only .safetensors is supported / .safetensors のみ対応しています: {path}")
+
+    from safetensors.torch import load_file
+
+    weights_sd = load_file(path)
+
+    factors = {}
+    for key, value in weights_sd.items():
+        if "." not in key or "lora_down" not in key:
+            continue
+        lora_name = key.split(".")[0]
+        down = value
+        up = weights_sd[key.replace("lora_down", "lora_up")]
+        dim = down.size()[0]
+        alpha = weights_sd.get(lora_name + ".alpha", dim)
+        alpha = float(alpha.float()) if type(alpha) == torch.Tensor else float(alpha)
+        factors[lora_name] = LoRAFactors(up.to(device, dtype=dtype), down.to(device, dtype=dtype), alpha / dim)
+    return factors
+
+
+def get_delta(factors: LoRAFactors, multiplier: float) -> torch.Tensor:
+    # same as LoRAInfModule.get_weight
+    up = factors.up.to(torch.float)
+    down = factors.down.to(torch.float)
+    if len(down.size()) == 2:
+        # linear
+        weight = up @ down
+    elif down.size()[2:4] == (1, 1):
+        # conv2d 1x1
+        weight = (up.squeeze(3).squeeze(2) @ down.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
+    else:
+        # conv2d 3x3
+        weight = torch.nn.functional.conv2d(down.permute(1, 0, 2, 3), up).permute(1, 0, 2, 3)
+    return weight * (multiplier * factors.scale)
+
+
+class LoRARegistry:
+    r"""
+    loads LoRA files once and switches the LoRAs applied to the models with set_loras({path: multiplier}).
+    the LoRAs are merged to the weights, so the models run without any LoRA module. set_multiplier or regional LoRA of
+    LoRANetwork is not available, call set_loras with other multipliers instead
+    """
+
+    def __init__(
+        self,
+        text_encoder,
+        unet,
+        device,
+        dtype: Optional[torch.dtype] = None,
+        memory_budget_mb: float = 1024,
+        restore_interval: int = 16,
+    ) -> None:
+        self.targets = get_target_modules(text_encoder, unet)
+        self.device = device
+        self.dtype = dtype
+        self.memory_budget = int(memory_budget_mb * 1024**2)
+        self.restore_interval = restore_interval
+
+        self.entries: "collections.OrderedDict[str, LoRAEntry]" = collections.OrderedDict()  # in LRU order
+        self.applied: Dict[str, float] = {}  # path -> multiplier
+        self.active_counts: Dict[str, int] = collections.defaultdict(int)  # lora_name -> number of applied LoRAs
+        self.update_counts: Dict[str, int] = collections.defaultdict(int)  # lora_name -> in place updates since backup
+        self.backups: Dict[str, torch.Tensor] = {}  # lora_name -> original weight on CPU
+
+        self.stats = collections.defaultdict(float)
+        self.swap_times: List[float] = []
+
+    def get_memory_usage(self) -> int:
+        return sum(entry.nbytes for entry in self.entries.values())
+
+    def synchronize(self) -> None:
+        if torch.cuda.is_available() and torch.device(self.device).type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def load(self, path: str) -> LoRAEntry:
+        entry = self.entries.get(path)
+        if entry is not None:
+            self.entries.move_to_end(path)
+            self.stats["hits"] += 1
+            return entry
+
+        start = time.perf_counter()
+        factors = load_factors(path, self.device, self.dtype)
+        unknown = [lora_name for lora_name in factors.keys() if lora_name not in self.targets]
+        if len(unknown) > 0:
+            print(f"{len(unknown)} modules of {path} are not found in the model, ignored / モデルにないモジュールは無視します: {unknown[:3]}")
+            for lora_name in unknown:
+                del factors[lora_name]
+
+        # Linearを対象とする (out, in, 1, 1) の重みは2次元にする / weights saved as (out, in, 1, 1) for Linear are squeezed
+        for lora_name, f in factors.items():
+            if len(self.targets[lora_name].weight.size()) == 2 and len(f.down.size()) == 4:
+                factors[lora_name] = LoRAFactors(f.up.squeeze(3).squeeze(2), f.down.squeeze(3).squeeze(2), f.scale)
+
+        entry = LoRAEntry(path, factors)
+        self.entries[path] = entry
+        self.evict()
+
+        self.synchronize()
+        self.stats["misses"] += 1
+        self.stats["load_time"] += time.perf_counter() - start
+        return entry
+
+    def evict(self) -> None:
+        # 適用中でない、最も古く使われたLoRAから破棄する / evict least recently used LoRAs which are not applied
+        for path in list(self.entries.keys()):
+            if self.get_memory_usage() <= self.memory_budget:
+                return
+            if path in self.applied or path == next(reversed(self.entries)):
+                continue
+            del self.entries[path]
+            self.stats["evictions"] += 1
+
+        if self.get_memory_usage() > self.memory_budget:
+            print(
+                f"LoRAs in use exceed memory budget / 使用中のLoRAがメモリの上限を超えています: {self.get_memory_usage() / 1024**2:.1f}MB"
+            )
+
+    def update_weight(self, lora_name: str, delta: torch.Tensor) -> None:
+        weight = self.targets[lora_name].weight
+        if lora_name not in self.backups:
+            self.backups[lora_name] = weight.detach().to("cpu", copy=True)
+        weight.data.copy_((weight.data.to(torch.float) + delta.to(weight.device)).to(weight.dtype))
+        self.update_counts[lora_name] += 1
+
+    def restore_weight(self, lora_name: str) -> None:
+        weight = self.targets[lora_name].weight
+        weight.data.copy_(self.backups[lora_name].to(weight.device))
+        self.update_counts[lora_name] = 0
+
+    @torch.no_grad()
+    def apply(self, path: str, multiplier: float = 1.0) -> None:
+        if path in self.applied:
+            self.unapply(path)
+
+        entry = self.load(path)
+        for lora_name, factors in entry.factors.items():
+            self.update_weight(lora_name, get_delta(factors, multiplier))
+            self.active_counts[lora_name] += 1
+        self.applied[path] = multiplier
+
+    @torch.no_grad()
+    def unapply(self, path: str) -> None:
+        multiplier = self.applied.pop(path)
+        entry = self.entries[path]  # applied LoRAs are not evicted
+        for lora_name, factors in entry.factors.items():
+            self.active_counts[lora_name] -= 1
+            if self.active_counts[lora_name] == 0 and self.update_counts[lora_name] >= self.restore_interval:
+                self.restore_weight(lora_name)  # no LoRA on this module, restore exactly
+            else:
+                self.update_weight(lora_name, get_delta(factors, -multiplier))
+
+    def set_loras(self, loras: Union[Dict[str, float], List[Tuple[str, float]]]) -> float:
+        r"""
+        changes the applied LoRAs to loras (path -> multiplier). LoRAs already applied with the same multiplier are kept.
+        returns the time of the swap in seconds
+        """
+        loras = dict(loras)
+        start = time.perf_counter()
+
+        for path in list(self.applied.keys()):
+            if path not in loras or loras[path] != self.applied[path]:
+                self.unapply(path)
+        for path, multiplier in loras.items():
+            if path not in self.applied:
+                self.apply(path, multiplier)
+
+        self.synchronize()
+        elapsed = time.perf_counter() - start
+        self.swap_times.append(elapsed)
+        return elapsed
+
+    def reset(self) -> None:
+        r"""
+        unapplies all LoRAs and restores the original weights exactly
+        """
+        with torch.no_grad():
+            for path in list(self.applied.keys()):
+                self.unapply(path)
+            for lora_name in list(self.backups.keys()):
+                if self.update_counts[lora_name] > 0:
+                    self.restore_weight(lora_name)
+
+    def get_stats(self) -> Dict[str, float]:
+        swap_times = self.swap_times
+        return {
+            "loaded": len(self.entries),
+            "applied": len(self.applied),
+            "memory_mb": self.get_memory_usage() / 1024**2,
+            "hits": int(self.stats["hits"]),
+            "misses": int(self.stats["misses"]),
+            "evictions": int(self.stats["evictions"]),
+            "load_time": self.stats["load_time"],
+            "swaps": len(swap_times),
+            "mean_swap_time": sum(swap_times) / len(swap_times) if swap_times else 0.0,
+            "max_swap_time": max(swap_times) if swap_times else 0.0,
+        }
+
+    def print_stats(self) -> None:
+        stats = self.get_stats()
+        print(
+            f"LoRA registry: {stats['loaded']} loaded ({stats['memory_mb']:.1f}MB), {stats['applied']} applied,"
+            + f" hits: {stats['hits']}, misses: {stats['misses']}, evictions: {stats['evictions']},"
+            + f" swap: {stats['swaps']} times, mean {stats['mean_swap_time'] * 1000:.1f}ms, max {stats['max_swap_time'] * 1000:.1f}ms"
+        )
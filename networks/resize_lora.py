@@ -4,9 +4,8 @@
 
 import argparse
 import torch
-from safetensors.torch import load_file, save_file, safe_open
-from tqdm import tqdm
-from library import train_util, model_util
+from library import model_util, safetensors_utils, svd_util
+from library.safetensors_utils import LazyStateDict
 import numpy as np
 
 MIN_SV = 1e-6
@@ -15,12 +14,12 @@ MIN_SV = 1e-6
 
 def load_state_dict(file_name, dtype):
   if model_util.is_safetensors(file_name):
-    sd = load_file(file_name)
-    with safe_open(file_name, framework="pt") as f:
-      metadata = f.metadata()
-  else:
-    sd = torch.load(file_name, map_location='cpu')
-    metadata = None
+    # tensors are loaded and converted to dtype on access / テンソルはアクセス時に読み込んでdtypeに変換する
+    sd = LazyStateDict(file_name, dtype)
+    return sd, sd.metadata()
+
+  sd = torch.load(file_name, map_location='cpu')
+  metadata = None
 
   for key in list(sd.keys()):
     if type(sd[key]) == torch.Tensor:
@@ -36,7 +35,7 @@ def save_to_file(file_name, model, state_dict, dtype, metadata):
         state_dict[key] = state_dict[key].to(dtype)
 
   if model_util.is_safetensors(file_name):
-    save_file(model, file_name, metadata)
+    safetensors_utils.save_file(model, file_name, metadata, add_hashes=True)  # hashes are calculated while writing
   else:
     torch.save(model, file_name)
 
@@ -72,9 +71,10 @@ def index_sv_ratio(S, target):
 
 
 # Modified from Kohaku-blueleaf's extract/merge functions
-def extract_conv(weight, lora_rank, dynamic_method, dynamic_param, device, scale=1):
+# rank_bound is the rank of the original LoRA: the merged weight has at most this rank, so svd_util can skip full SVD
+def extract_conv(weight, lora_rank, dynamic_method, dynamic_param, device, scale=1, svd_method="auto", rank_bound=None):
     out_size, in_size, kernel_size, _ = weight.size()
-    U, S, Vh = torch.linalg.svd(weight.reshape(out_size, -1).to(device))
+    U, S, Vh, _ = svd_util.truncated_svd(weight.reshape(out_size, -1).to(device), None, svd_method, rank_bound)
     
     param_dict = rank_resize(S, lora_rank, dynamic_method, dynamic_param, scale)
     lora_rank = param_dict["new_rank"]
@@ -90,10 +90,10 @@ def extract_conv(weight, lora_rank, dynamic_method, dynamic_param, device, scale
     return param_dict
 
 
-def extract_linear(weight, lora_rank, dynamic_method, dynamic_param, device, scale=1):
+def extract_linear(weight, lora_rank, dynamic_method, dynamic_param, device, scale=1, svd_method="auto", rank_bound=None):
     out_size, in_size = weight.size()
     
-    U, S, Vh = torch.linalg.svd(weight.to(device))
+    U, S, Vh, _ = svd_util.truncated_svd(weight.to(device), None, svd_method, rank_bound)
     
     param_dict = rank_resize(S, lora_rank, dynamic_method, dynamic_param, scale)
     lora_rank = param_dict["new_rank"]
@@ -186,7 +186,30 @@ def rank_resize(S, rank, dynamic_method, dynamic_param, scale=1):
     return param_dict
 
 
-def resize_lora_model(lora_sd, new_rank, save_dtype, device, dynamic_method, dynamic_param, verbose):
+def resize_lora_module(lora_down_weight, lora_up_weight, lora_alpha, new_rank, device, dynamic_method, dynamic_param, svd_method):
+  # 1モジュール分のリサイズ。svd_util.map_modulesで別プロセスから呼ばれることもある
+  conv2d = (len(lora_down_weight.size()) == 4)
+  if lora_alpha is None:
+    scale = 1.0
+  else:
+    scale = lora_alpha/lora_down_weight.size()[0]
+
+  with torch.no_grad():
+    rank_bound = lora_down_weight.size()[0]
+    if conv2d:
+      full_weight_matrix = merge_conv(lora_down_weight, lora_up_weight, device)
+      param_dict = extract_conv(full_weight_matrix, new_rank, dynamic_method, dynamic_param, device, scale, svd_method, rank_bound)
+    else:
+      full_weight_matrix = merge_linear(lora_down_weight, lora_up_weight, device)
+      param_dict = extract_linear(full_weight_matrix, new_rank, dynamic_method, dynamic_param, device, scale, svd_method, rank_bound)
+
+  # tensors in param_dict are on cpu, convert statistics to python values to send back from workers
+  for key in ["sum_retained", "max_ratio"]:
+    param_dict[key] = float(param_dict[key])
+  return param_dict
+
+
+def resize_lora_model(lora_sd, new_rank, save_dtype, device, dynamic_method, dynamic_param, verbose, svd_method="auto", num_workers=0):
   network_alpha = None
   network_dim = None
   verbose_str = "\n"
@@ -203,76 +226,57 @@ def resize_lora_model(lora_sd, new_rank, save_dtype, device, dynamic_method, dyn
     if network_alpha is None:
       network_alpha = network_dim
 
-  scale = network_alpha/network_dim
-
   if dynamic_method:
     print(f"Dynamically determining new alphas and dims based off {dynamic_method}: {dynamic_param}, max rank is {new_rank}")
 
-  lora_down_weight = None
-  lora_up_weight = None
+  o_lora_sd = {}
+
+  # find corresponding lora_up and alpha for each lora_down. only keys are used, tensors are loaded module by module
+  block_names = []
+  for key in lora_sd.keys():
+    if 'lora_down' not in key:
+      continue
+    block_down_name = key.split(".")[0]
+    weight_name = key.split(".")[-1]
+    if block_down_name + '.lora_up.' + weight_name in lora_sd:
+      block_names.append((block_down_name, weight_name))
+
+  def module_args():
+    for block_down_name, weight_name in block_names:
+      lora_down_weight = lora_sd[block_down_name + '.lora_down.' + weight_name]
+      lora_up_weight = lora_sd[block_down_name + '.lora_up.' + weight_name]
+      lora_alpha = lora_sd.get(block_down_name + '.alpha', None)
+      yield (lora_down_weight, lora_up_weight, lora_alpha, new_rank, device, dynamic_method, dynamic_param, svd_method)
 
-  o_lora_sd = lora_sd.copy()
-  block_down_name = None
-  block_up_name = None
+  param_dicts = svd_util.map_modules(resize_lora_module, module_args(), num_workers, len(block_names))
+  for (block_down_name, _), param_dict in zip(block_names, param_dicts):
+    block_up_name = block_down_name
 
-  with torch.no_grad():
-    for key, value in tqdm(lora_sd.items()):
-      weight_name = None
-      if 'lora_down' in key:
-        block_down_name = key.split(".")[0]
-        weight_name = key.split(".")[-1]
-        lora_down_weight = value
-      else:
-        continue
-
-      # find corresponding lora_up and alpha
-      block_up_name = block_down_name
-      lora_up_weight = lora_sd.get(block_up_name + '.lora_up.' + weight_name, None)
-      lora_alpha = lora_sd.get(block_down_name + '.alpha', None)
+    if verbose:
+      max_ratio = param_dict['max_ratio']
+      sum_retained = param_dict['sum_retained']
+      fro_retained = param_dict['fro_retained']
+      if not np.isnan(fro_retained):
+        fro_list.append(float(fro_retained))
 
-      weights_loaded = (lora_down_weight is not None and lora_up_weight is not None)
-
-      if weights_loaded:
-
-        conv2d = (len(lora_down_weight.size()) == 4)
-        if lora_alpha is None:
-          scale = 1.0
-        else:
-          scale = lora_alpha/lora_down_weight.size()[0]
-
-        if conv2d:
-          full_weight_matrix = merge_conv(lora_down_weight, lora_up_weight, device)
-          param_dict = extract_conv(full_weight_matrix, new_rank, dynamic_method, dynamic_param, device, scale)
-        else:
-          full_weight_matrix = merge_linear(lora_down_weight, lora_up_weight, device)
-          param_dict = extract_linear(full_weight_matrix, new_rank, dynamic_method, dynamic_param, device, scale)
-
-        if verbose:
-          max_ratio = param_dict['max_ratio']
-          sum_retained = param_dict['sum_retained']
-          fro_retained = param_dict['fro_retained']
-          if not np.isnan(fro_retained):
-            fro_list.append(float(fro_retained))
-
-          verbose_str+=f"{block_down_name:75} | "
-          verbose_str+=f"sum(S) retained: {sum_retained:.1%}, fro retained: {fro_retained:.1%}, max(S) ratio: {max_ratio:0.1f}"
-
-        if verbose and dynamic_method:
-          verbose_str+=f", dynamic | dim: {param_dict['new_rank']}, alpha: {param_dict['new_alpha']}\n"
-        else:
-          verbose_str+=f"\n"
-
-        new_alpha = param_dict['new_alpha']
-        o_lora_sd[block_down_name + "." + "lora_down.weight"] = param_dict["lora_down"].to(save_dtype).contiguous()
-        o_lora_sd[block_up_name + "." + "lora_up.weight"] = param_dict["lora_up"].to(save_dtype).contiguous()
-        o_lora_sd[block_up_name + "." "alpha"] = torch.tensor(param_dict['new_alpha']).to(save_dtype)
-
-        block_down_name = None
-        block_up_name = None
-        lora_down_weight = None
-        lora_up_weight = None
-        weights_loaded = False
-        del param_dict
+      verbose_str+=f"{block_down_name:75} | "
+      verbose_str+=f"sum(S) retained: {sum_retained:.1%}, fro retained: {fro_retained:.1%}, max(S) ratio: {max_ratio:0.1f}"
+
+    if verbose and dynamic_method:
+      verbose_str+=f", dynamic | dim: {param_dict['new_rank']}, alpha: {param_dict['new_alpha']}\n"
+    else:
+      verbose_str+=f"\n"
+
+    new_alpha = param_dict['new_alpha']
+    o_lora_sd[block_down_name + "." + "lora_down.weight"] = param_dict["lora_down"].to(save_dtype).contiguous()
+    o_lora_sd[block_up_name + "." + "lora_up.weight"] = param_dict["lora_up"].to(save_dtype).contiguous()
+    o_lora_sd[block_up_name + "." "alpha"] = torch.tensor(param_dict['new_alpha']).to(save_dtype)
+    del param_dict
+
+  # copy the weights which are not resized
+  for key in lora_sd.keys():
+    if key not in o_lora_sd:
+      o_lora_sd[key] = lora_sd[key]
 
   if verbose:
     print(verbose_str)
@@ -305,7 +309,7 @@ def resize(args):
   lora_sd, metadata = load_state_dict(args.model, merge_dtype)
 
   print("Resizing Lora...")
-  state_dict, old_dim, new_alpha = resize_lora_model(lora_sd, args.new_rank, save_dtype, args.device, args.dynamic_method, args.dynamic_param, args.verbose)
+  state_dict, old_dim, new_alpha = resize_lora_model(lora_sd, args.new_rank, save_dtype, args.device, args.dynamic_method, args.dynamic_param, args.verbose, args.svd_method, args.svd_workers)
 
   # update metadata
   if metadata is None:
@@ -322,10 +326,6 @@ def resize(args):
     metadata["ss_network_dim"] = 'Dynamic'
     metadata["ss_network_alpha"] = 'Dynamic'
 
-  model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(state_dict, metadata)
-  metadata["sshs_model_hash"] = model_hash
-  metadata["sshs_legacy_hash"] = legacy_hash
-
   print(f"saving model to: {args.save_to}")
   save_to_file(args.save_to, state_dict, state_dict, save_dtype, metadata)
 
@@ -348,6 +348,10 @@ def setup_parser() -> argparse.ArgumentParser:
                       help="Specify dynamic resizing method, --new_rank is used as a hard limit for max rank")
   parser.add_argument("--dynamic_param", type=float, default=None,
                       help="Specify target for dynamic reduction")
+  parser.add_argument("--svd_workers", type=int, default=0,
+                      help="number of worker processes to resize modules in parallel (0: in main process) / モジュールを並列にリサイズするプロセス数（0でメインプロセスのみ）")
+  parser.add_argument("--svd_method", type=str, default="auto", choices=svd_util.SVD_METHODS,
+                      help="SVD method. auto uses randomized SVD, which is exact here because the rank of LoRA is known / SVDの方法。autoではrandomized SVDを使う（LoRAのrankが既知なので結果は厳密なSVDと同じ）")
        
   return parser
 
@@ -3,20 +3,22 @@ import argparse
 import os
 import time
 import torch
-from safetensors.torch import load_file, save_file
 from tqdm import tqdm
-from library import sai_model_spec, sdxl_model_util, train_util
+from library import sai_model_spec, safetensors_utils, sdxl_model_util, train_util
+from library.safetensors_utils import LazyStateDict
 import library.model_util as model_util
 import lora
 
 
 def load_state_dict(file_name, dtype):
     if os.path.splitext(file_name)[1] == ".safetensors":
-        sd = load_file(file_name)
+        # tensors are loaded and converted to dtype on access / テンソルはアクセス時に読み込んでdtypeに変換する
+        sd = LazyStateDict(file_name, dtype)
         metadata = train_util.load_metadata_from_safetensors(file_name)
-    else:
-        sd = torch.load(file_name, map_location="cpu")
-        metadata = {}
+        return sd, metadata
+
+    sd = torch.load(file_name, map_location="cpu")
+    metadata = {}
 
     for key in list(sd.keys()):
         if type(sd[key]) == torch.Tensor:
@@ -32,12 +34,12 @@ def save_to_file(file_name, model, state_dict, dtype, metadata):
                 state_dict[key] = state_dict[key].to(dtype)
 
     if os.path.splitext(file_name)[1] == ".safetensors":
-        save_file(model, file_name, metadata=metadata)
+        safetensors_utils.save_file(model, file_name, metadata, add_hashes=True)  # hashes are calculated while writing
     else:
         torch.save(model, file_name)
 
 
-def merge_to_sd_model(text_encoder1, text_encoder2, unet, models, ratios, merge_dtype):
+def merge_to_sd_model(text_encoder1, text_encoder2, unet, models, ratios, merge_dtype, batched=False):
     text_encoder1.to(merge_dtype)
     text_encoder1.to(merge_dtype)
     unet.to(merge_dtype)
@@ -65,6 +67,10 @@ def merge_to_sd_model(text_encoder1, text_encoder2, unet, models, ratios, merge_
                         lora_name = lora_name.replace(".", "_")
                         name_to_module[lora_name] = child_module
 
+    if batched:
+        merge_to_modules_batched(name_to_module, models, ratios, merge_dtype)
+        return
+
     for model, ratio in zip(models, ratios):
         print(f"loading: {model}")
         lora_sd, _ = load_state_dict(model, merge_dtype)
@@ -113,6 +119,59 @@ def merge_to_sd_model(text_encoder1, text_encoder2, unet, models, ratios, merge_
                 module.weight = torch.nn.Parameter(weight)
 
 
+def merge_to_modules_batched(name_to_module, models, ratios, merge_dtype):
+    # モジュールごとにすべてのLoRAをまとめ、一回の行列積でマージする
+    # W <- W + [U1 * r1 * s1, U2 * r2 * s2, ...] @ [D1; D2; ...], i.e. one LoRA with the concatenated ranks
+    module_loras = {}  # module name -> list of (lora_sd, down key, ratio)
+    for model, ratio in zip(models, ratios):
+        print(f"loading: {model}")
+        lora_sd, _ = load_state_dict(model, merge_dtype)
+
+        for key in lora_sd.keys():
+            if "lora_down" in key:
+                module_name = ".".join(key.split(".")[:-2])  # remove trailing ".lora_down.weight"
+                if module_name not in name_to_module:
+                    print(f"no module found for LoRA weight: {key}")
+                    continue
+                module_loras.setdefault(module_name, []).append((lora_sd, key, ratio))
+
+    print(f"merging...")
+    for module_name, loras in tqdm(module_loras.items()):
+        module = name_to_module[module_name]
+        weight = module.weight
+
+        ups = []
+        downs = []
+        for lora_sd, key, ratio in loras:
+            down_weight = lora_sd[key]
+            up_weight = lora_sd[key.replace("lora_down", "lora_up")]
+
+            dim = down_weight.size()[0]
+            alpha = lora_sd.get(key[: key.index("lora_down")] + "alpha", dim)
+            scale = alpha / dim
+
+            if len(weight.size()) == 2 and len(up_weight.size()) == 4:  # use linear projection mismatch
+                up_weight = up_weight.squeeze(3).squeeze(2)
+                down_weight = down_weight.squeeze(3).squeeze(2)
+            ups.append(up_weight * (ratio * scale))
+            downs.append(down_weight)
+
+        up_weight = torch.cat(ups, dim=1)
+        down_weight = torch.cat(downs, dim=0)
+
+        if len(weight.size()) == 2:
+            # linear
+            weight = weight + up_weight @ down_weight
+        elif down_weight.size()[2:4] == (1, 1):
+            # conv2d 1x1
+            weight = weight + (up_weight.squeeze(3).squeeze(2) @ down_weight.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
+        else:
+            # conv2d 3x3
+            weight = weight + torch.nn.functional.conv2d(down_weight.permute(1, 0, 2, 3), up_weight).permute(1, 0, 2, 3)
+
+        module.weight = torch.nn.Parameter(weight)
+
+
 def merge_lora_models(models, ratios, merge_dtype):
     base_alphas = {}  # alpha for merged model
     base_dims = {}
@@ -168,14 +227,15 @@ def merge_lora_models(models, ratios, merge_dtype):
             alpha = alphas[lora_module_name]
 
             scale = math.sqrt(alpha / base_alpha) * ratio
+            weight = lora_sd[key]  # read once: lora_sd may load the tensor from the file on each access
 
             if key in merged_sd:
                 assert (
-                    merged_sd[key].size() == lora_sd[key].size()
+                    merged_sd[key].size() == weight.size()
                 ), f"weights shape mismatch merging v1 and v2, different dims? / 重みのサイズが合いません。v1とv2、または次元数の異なるモデルはマージできません"
-                merged_sd[key] = merged_sd[key] + lora_sd[key] * scale
+                merged_sd[key] = merged_sd[key] + weight * scale
             else:
-                merged_sd[key] = lora_sd[key] * scale
+                merged_sd[key] = weight * scale
 
     # set alpha to sd
     for lora_module_name, alpha in base_alphas.items():
@@ -236,7 +296,7 @@ def merge(args):
             ckpt_info,
         ) = sdxl_model_util.load_models_from_sdxl_checkpoint(sdxl_model_util.MODEL_VERSION_SDXL_BASE_V1_0, args.sd_model, "cpu")
 
-        merge_to_sd_model(text_model1, text_model2, unet, args.models, args.ratios, merge_dtype)
+        merge_to_sd_model(text_model1, text_model2, unet, args.models, args.ratios, merge_dtype, args.batched_merge)
 
         if args.no_metadata:
             sai_metadata = None
@@ -254,11 +314,7 @@ def merge(args):
     else:
         state_dict, metadata = merge_lora_models(args.models, args.ratios, merge_dtype)
 
-        print(f"calculating hashes and creating metadata...")
-
-        model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(state_dict, metadata)
-        metadata["sshs_model_hash"] = model_hash
-        metadata["sshs_legacy_hash"] = legacy_hash
+        print(f"creating metadata...")
 
         if not args.no_metadata:
             merged_from = sai_model_spec.build_merged_from(args.models)
@@ -301,6 +357,12 @@ def setup_parser() -> argparse.ArgumentParser:
         "--models", type=str, nargs="*", help="LoRA models to merge: ckpt or safetensors file / マージするLoRAモデル、ckptまたはsafetensors"
     )
     parser.add_argument("--ratios", type=float, nargs="*", help="ratios for each model / それぞれのLoRAモデルの比率")
+    parser.add_argument(
+        "--batched_merge",
+        action="store_true",
+        help="merge all LoRAs for each module with one matrix product, faster for many LoRAs (results may differ slightly by rounding)"
+        + " / モジュールごとにすべてのLoRAを一回の行列積でマージする。多数のLoRAで高速（丸め誤差で結果がわずかに異なる場合がある）",
+    )
     parser.add_argument(
         "--no_metadata",
         action="store_true",
@@ -3,9 +3,9 @@ import argparse
 import os
 import time
 import torch
-from safetensors.torch import load_file, save_file
 from tqdm import tqdm
-from library import sai_model_spec, train_util
+from library import sai_model_spec, safetensors_utils, svd_util, train_util
+from library.safetensors_utils import LazyStateDict
 import library.model_util as model_util
 import lora
 
@@ -15,11 +15,13 @@ CLAMP_QUANTILE = 0.99
 
 def load_state_dict(file_name, dtype):
     if os.path.splitext(file_name)[1] == ".safetensors":
-        sd = load_file(file_name)
+        # tensors are loaded and converted to dtype on access / テンソルはアクセス時に読み込んでdtypeに変換する
+        sd = LazyStateDict(file_name, dtype)
         metadata = train_util.load_metadata_from_safetensors(file_name)
-    else:
-        sd = torch.load(file_name, map_location="cpu")
-        metadata = {}
+        return sd, metadata
+
+    sd = torch.load(file_name, map_location="cpu")
+    metadata = {}
 
     for key in list(sd.keys()):
         if type(sd[key]) == torch.Tensor:
@@ -35,14 +37,53 @@ def save_to_file(file_name, state_dict, dtype, metadata):
                 state_dict[key] = state_dict[key].to(dtype)
 
     if os.path.splitext(file_name)[1] == ".safetensors":
-        save_file(state_dict, file_name, metadata=metadata)
+        safetensors_utils.save_file(state_dict, file_name, metadata, add_hashes=True)  # hashes are calculated while writing
     else:
         torch.save(state_dict, file_name)
 
 
-def merge_lora_models(models, ratios, new_rank, new_conv_rank, device, merge_dtype):
+def extract_lora_module(mat, new_rank, new_conv_rank, device, svd_method, rank_bound):
+    # マージした重みから1モジュール分のLoRAを抽出する。svd_util.map_modulesで別プロセスから呼ばれることもある
+    if device:
+        mat = mat.to(device)
+
+    with torch.no_grad():
+        conv2d = len(mat.size()) == 4
+        kernel_size = None if not conv2d else mat.size()[2:4]
+        conv2d_3x3 = conv2d and kernel_size != (1, 1)
+        out_dim, in_dim = mat.size()[0:2]
+
+        if conv2d:
+            if conv2d_3x3:
+                mat = mat.flatten(start_dim=1)
+            else:
+                mat = mat.squeeze()
+
+        module_new_rank = new_conv_rank if conv2d_3x3 else new_rank
+        module_new_rank = min(module_new_rank, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
+
+        U, S, Vh, _ = svd_util.truncated_svd(mat, module_new_rank, svd_method, rank_bound)
+
+        U = U @ torch.diag(S)
+
+        dist = torch.cat([U.flatten(), Vh.flatten()])
+        hi_val = torch.quantile(dist, CLAMP_QUANTILE)
+        low_val = -hi_val
+
+        U = U.clamp(low_val, hi_val)
+        Vh = Vh.clamp(low_val, hi_val)
+
+        if conv2d:
+            U = U.reshape(out_dim, module_new_rank, 1, 1)
+            Vh = Vh.reshape(module_new_rank, in_dim, kernel_size[0], kernel_size[1])
+
+    return U.to("cpu").contiguous(), Vh.to("cpu").contiguous(), module_new_rank
+
+
+def merge_lora_models(models, ratios, new_rank, new_conv_rank, device, merge_dtype, svd_method="auto", num_workers=0):
     print(f"new rank: {new_rank}, new conv rank: {new_conv_rank}")
     merged_sd = {}
+    merged_ranks = {}  # merged weight has at most the sum of the ranks of the LoRAs
     v2 = None
     base_model = None
     for model, ratio in zip(models, ratios):
@@ -108,51 +149,23 @@ def merge_lora_models(models, ratios, new_rank, new_conv_rank, device, merge_dty
                 weight = weight + ratio * conved * scale
 
             merged_sd[lora_module_name] = weight
+            merged_ranks[lora_module_name] = merged_ranks.get(lora_module_name, 0) + network_dim
 
     # extract from merged weights
     print("extract new lora...")
     merged_lora_sd = {}
-    with torch.no_grad():
-        for lora_module_name, mat in tqdm(list(merged_sd.items())):
-            conv2d = len(mat.size()) == 4
-            kernel_size = None if not conv2d else mat.size()[2:4]
-            conv2d_3x3 = conv2d and kernel_size != (1, 1)
-            out_dim, in_dim = mat.size()[0:2]
 
-            if conv2d:
-                if conv2d_3x3:
-                    mat = mat.flatten(start_dim=1)
-                else:
-                    mat = mat.squeeze()
+    def module_args():
+        for lora_module_name, mat in merged_sd.items():
+            if num_workers > 0:
+                mat = mat.to("cpu")  # tensors are sent to worker processes
+            yield (mat, new_rank, new_conv_rank, device, svd_method, merged_ranks[lora_module_name])
 
-            module_new_rank = new_conv_rank if conv2d_3x3 else new_rank
-            module_new_rank = min(module_new_rank, in_dim, out_dim)  # LoRA rank cannot exceed the original dim
-
-            U, S, Vh = torch.linalg.svd(mat)
-
-            U = U[:, :module_new_rank]
-            S = S[:module_new_rank]
-            U = U @ torch.diag(S)
-
-            Vh = Vh[:module_new_rank, :]
-
-            dist = torch.cat([U.flatten(), Vh.flatten()])
-            hi_val = torch.quantile(dist, CLAMP_QUANTILE)
-            low_val = -hi_val
-
-            U = U.clamp(low_val, hi_val)
-            Vh = Vh.clamp(low_val, hi_val)
-
-            if conv2d:
-                U = U.reshape(out_dim, module_new_rank, 1, 1)
-                Vh = Vh.reshape(module_new_rank, in_dim, kernel_size[0], kernel_size[1])
-
-            up_weight = U
-            down_weight = Vh
-
-            merged_lora_sd[lora_module_name + ".lora_up.weight"] = up_weight.to("cpu").contiguous()
-            merged_lora_sd[lora_module_name + ".lora_down.weight"] = down_weight.to("cpu").contiguous()
-            merged_lora_sd[lora_module_name + ".alpha"] = torch.tensor(module_new_rank)
+    results = svd_util.map_modules(extract_lora_module, module_args(), num_workers, len(merged_sd))
+    for lora_module_name, (up_weight, down_weight, module_new_rank) in zip(list(merged_sd.keys()), results):
+        merged_lora_sd[lora_module_name + ".lora_up.weight"] = up_weight
+        merged_lora_sd[lora_module_name + ".lora_down.weight"] = down_weight
+        merged_lora_sd[lora_module_name + ".alpha"] = torch.tensor(module_new_rank)
 
     # build minimum metadata
     dims = f"{new_rank}"
@@ -185,14 +198,10 @@ def merge(args):
 
     new_conv_rank = args.new_conv_rank if args.new_conv_rank is not None else args.new_rank
     state_dict, metadata, v2, base_model = merge_lora_models(
-        args.models, args.ratios, args.new_rank, new_conv_rank, args.device, merge_dtype
+        args.models, args.ratios, args.new_rank, new_conv_rank, args.device, merge_dtype, args.svd_method, args.svd_workers
     )
 
-    print(f"calculating hashes and creating metadata...")
-
-    model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(state_dict, metadata)
-    metadata["sshs_model_hash"] = model_hash
-    metadata["sshs_legacy_hash"] = legacy_hash
+    print(f"creating metadata...")
 
     if not args.no_metadata:
         is_sdxl = base_model is not None and base_model.lower().startswith("sdxl")
@@ -243,6 +252,21 @@ def setup_parser() -> argparse.ArgumentParser:
         help="Specify rank of output LoRA for Conv2d 3x3, None for same as new_rank / 出力するConv2D 3x3 LoRAのrank (dim)、Noneでnew_rankと同じ",
     )
     parser.add_argument("--device", type=str, default=None, help="device to use, cuda for GPU / 計算を行うデバイス、cuda でGPUを使う")
+    parser.add_argument(
+        "--svd_workers",
+        type=int,
+        default=0,
+        help="number of worker processes to extract modules in parallel (0: in main process)"
+        + " / モジュールを並列に抽出するプロセス数（0でメインプロセスのみ）",
+    )
+    parser.add_argument(
+        "--svd_method",
+        type=str,
+        default="auto",
+        choices=svd_util.SVD_METHODS,
+        help="SVD method. auto uses randomized SVD, which is exact here because the merged weight has at most the sum of the ranks"
+        + " / SVDの方法。autoではrandomized SVDを使う（マージした重みのrankはLoRAのrankの合計以下なので結果は厳密なSVDと同じ）",
+    )
     parser.add_argument(
         "--no_metadata",
         action="store_true",
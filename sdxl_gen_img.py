@@ -46,7 +46,7 @@ import library.model_util as model_util
 import library.train_util as train_util
 import library.sdxl_model_util as sdxl_model_util
 import library.sdxl_train_util as sdxl_train_util
-from networks.lora import LoRANetwork
+from networks.lora import LoRANetwork, fuse_networks
 from library.sdxl_original_unet import SdxlUNet2DConditionModel
 from library.original_unet import FlashAttentionFunction
 from networks.control_net_lllite import ControlNetLLLite
@@ -1312,6 +1312,7 @@ class BatchDataExt(NamedTuple):
     strength: float
     network_muls: Tuple[float]
     num_sub_prompts: int
+    loras: Optional[Tuple[Tuple[str, float]]] = None  # LoRAs of the job in server mode, applied with LoRARegistry
 
 
 class BatchData(NamedTuple):
@@ -1563,8 +1564,17 @@ def main(args):
             else:
                 network.merge_to([text_encoder1, text_encoder2], unet, weights_sd, dtype, device)
 
+        # 複数のLoRAを対象モジュールごとに1つにまとめる / fuse LoRAs of the networks for each target module
+        fused_lora_modules = []
+        if args.network_fuse:
+            if network_pre_calc:
+                print("network_fuse is ignored with network_pre_calc / network_pre_calcが指定されているためnetwork_fuseは無視されます")
+            else:
+                fused_lora_modules = fuse_networks([n for n in networks if isinstance(n, LoRANetwork)])
+
     else:
         networks = []
+        fused_lora_modules = []
 
     # upscalerの指定があれば取得する
     upscaler = None
@@ -1727,7 +1737,7 @@ def main(args):
     else:
         prompt_list = []
 
-    if args.interactive:
+    if args.interactive or args.server:
         args.n_iter = 1
 
     # img2imgの前処理、画像の読み込みなど
@@ -1821,6 +1831,10 @@ def main(args):
         regional_network = True
         print("use mask as region")
 
+        # fused modules do not support regional LoRA
+        for fused in fused_lora_modules:
+            fused.remove()
+
         size = None
         for i, network in enumerate(networks):
             if i < 3:
@@ -1863,6 +1877,22 @@ def main(args):
     if args.H is None:
         args.H = 1024
 
+    # サーバーモード：プロンプトをHTTPで受け付ける / server mode: accept prompts over HTTP
+    server = None
+    lora_registry = None
+    if args.server:
+        from library.gen_img_server import GenerationServer
+
+        if args.network_pre_calc:
+            print("LoRAs of the jobs are not available with network_pre_calc / network_pre_calcが指定されているためジョブのLoRAは使えません")
+        else:
+            from networks.lora_registry import LoRARegistry
+
+            lora_registry = LoRARegistry([text_encoder1, text_encoder2], unet, device, dtype, args.server_lora_cache_mb)
+
+        server = GenerationServer(args.server_host, args.server_port)
+        server.lora_registry = lora_registry
+
     # 画像生成のループ
     os.makedirs(args.outdir, exist_ok=True)
     max_embeddings_multiples = 1 if args.max_embeddings_multiples is None else args.max_embeddings_multiples
@@ -1918,6 +1948,7 @@ def main(args):
                         strength_1st,
                         ext.network_muls,
                         ext.num_sub_prompts,
+                        ext.loras,
                     )
                     batch_1st.append(BatchData(is_1st_latent, base, ext_1st))
 
@@ -1987,6 +2018,7 @@ def main(args):
                     strength,
                     network_muls,
                     num_sub_prompts,
+                    loras,
                 ),
             ) = batch[0]
             noise_shape = (LATENT_CHANNELS, height // DOWNSAMPLING_FACTOR, width // DOWNSAMPLING_FACTOR)
@@ -2093,6 +2125,13 @@ def main(args):
                         n.pre_calculation()
                     print("pre-calculation... done")
 
+            if lora_registry is not None:
+                # サーバーモード：ジョブのLoRAを適用する / apply LoRAs of the jobs in server mode
+                with server.lora_lock:  # get_stats of the server reads the registry from the HTTP thread
+                    swap_time = lora_registry.set_loras(loras or {})
+                if swap_time > 0.001:
+                    print(f"LoRAs are changed in {swap_time * 1000:.1f}ms: {loras}")
+
             images = pipe(
                 prompts,
                 negative_prompts,
@@ -2160,6 +2199,8 @@ def main(args):
                     fln = f"im_{ts_str}_{highres_prefix}{i:03d}_{seed}.png"
 
                 image.save(os.path.join(args.outdir, fln), pnginfo=metadata)
+                if server is not None and not highres_1st:
+                    server.complete(batch[i].base.step, os.path.join(args.outdir, fln))
 
             if not args.no_preview and not highres_1st and args.interactive:
                 try:
@@ -2174,12 +2215,34 @@ def main(args):
 
             return images
 
+        def flush_batch(batch: List[BatchData], highres_fix):
+            if server is None:
+                return process_batch(batch, highres_fix)
+
+            # サーバーモードではエラーをジョブに返して続行する / in server mode, report the error to the jobs and continue
+            try:
+                images = process_batch(batch, highres_fix)
+                server.batch_processed(len(batch))
+                return images
+            except Exception as e:
+                print(f"failed to generate images / 画像の生成に失敗しました: {e}")
+                server.fail([bd.base.step for bd in batch], str(e))
+                return [None]
+
         # 画像生成のプロンプトが一周するまでのループ
         prompt_index = 0
         global_step = 0
         batch_data = []
-        while args.interactive or prompt_index < len(prompt_list):
-            if len(prompt_list) == 0:
+        while args.interactive or prompt_index < len(prompt_list) or server is not None:
+            job = None
+            if server is not None:
+                # wait for a job if there is no batch, or process the batch if no prompt is waiting
+                job, raw_prompt = server.get_prompt(block=len(batch_data) == 0)
+                if raw_prompt is None:
+                    flush_batch(batch_data, highres_fix)
+                    batch_data.clear()
+                    continue
+            elif len(prompt_list) == 0:
                 # interactive
                 valid = False
                 while not valid:
@@ -2411,15 +2474,18 @@ def main(args):
                         strength,
                         tuple(network_muls) if network_muls else None,
                         num_sub_prompts,
+                        job.loras if job is not None else None,
                     ),
                 )
                 if len(batch_data) > 0 and batch_data[-1].ext != b1.ext:  # バッチ分割必要？
-                    process_batch(batch_data, highres_fix)
+                    flush_batch(batch_data, highres_fix)
                     batch_data.clear()
 
+                if job is not None:
+                    server.add_image(job, global_step)
                 batch_data.append(b1)
                 if len(batch_data) == args.batch_size:
-                    prev_image = process_batch(batch_data, highres_fix)[0]
+                    prev_image = flush_batch(batch_data, highres_fix)[0]
                     batch_data.clear()
 
                 global_step += 1
@@ -2446,6 +2512,19 @@ def setup_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--no_preview", action="store_true", help="do not show generated image in interactive mode / 対話モードで画像を表示しない"
     )
+    parser.add_argument(
+        "--server",
+        action="store_true",
+        help="server mode, keep the models loaded and accept prompts over HTTP (POST /generate) / サーバーモード、モデルを読み込んだままHTTPでプロンプトを受け付ける",
+    )
+    parser.add_argument("--server_host", type=str, default="127.0.0.1", help="host for server mode / サーバーモードのホスト")
+    parser.add_argument("--server_port", type=int, default=8860, help="port for server mode / サーバーモードのポート")
+    parser.add_argument(
+        "--server_lora_cache_mb",
+        type=float,
+        default=1024,
+        help="memory budget (MB) of LoRAs of the jobs kept on the device in server mode / サーバーモードでデバイスに保持するジョブのLoRAのメモリ上限（MB）",
+    )
     parser.add_argument(
         "--image_path", type=str, default=None, help="image to inpaint or to generate from / img2imgまたはinpaintを行う元画像"
     )
@@ -2578,6 +2657,12 @@ def setup_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--network_pre_calc", action="store_true", help="pre-calculate network for generation / ネットワークのあらかじめ計算して生成する"
     )
+    parser.add_argument(
+        "--network_fuse",
+        action="store_true",
+        help="fuse multiple LoRAs (without merge) into one down/up for each module for faster generation, multipliers can be changed"
+        + " / 複数のLoRAをモジュールごとに1つのdown/upにまとめて高速に生成する、倍率は変更可能",
+    )
     parser.add_argument(
         "--textual_inversion_embeddings",
         type=str,
@@ -184,6 +184,11 @@ def train(args):
             train_dataset_group.is_latent_cacheable()
         ), "when caching latents, either color_aug or random_crop cannot be used / latentをキャッシュするときはcolor_augとrandom_cropは使えません"
 
+    if args.image_ram_cache_size > 0 and not cache_latents:
+        train_dataset_group.enable_image_cache(args.image_ram_cache_size)
+    if args.gpu_augmentation:
+        train_dataset_group.set_gpu_augmentation(True)
+
     if args.cache_text_encoder_outputs:
         assert (
             train_dataset_group.is_text_encoder_output_cacheable()
@@ -255,7 +260,16 @@ def train(args):
         vae.requires_grad_(False)
         vae.eval()
         with torch.no_grad():
-            train_dataset_group.cache_latents(vae, args.vae_batch_size, args.cache_latents_to_disk, accelerator.is_main_process)
+            train_dataset_group.cache_latents(
+                vae,
+                args.vae_batch_size,
+                args.cache_latents_to_disk,
+                accelerator.is_main_process,
+                latents_cache_dir=args.latents_cache_dir,
+                num_workers=args.cache_latents_workers,
+                storage_dtype=args.cache_storage_dtype,
+                compress=args.cache_compress,
+            )
         vae.to("cpu")
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
@@ -295,6 +309,9 @@ def train(args):
                     None,
                     args.cache_text_encoder_outputs_to_disk,
                     accelerator.is_main_process,
+                    storage_dtype=args.cache_storage_dtype,
+                    compress=args.cache_compress,
+                    model_identity=train_util.get_text_encoder_model_identity(args),
                 )
             accelerator.wait_for_everyone()
 
@@ -461,7 +478,7 @@ def train(args):
                 else:
                     with torch.no_grad():
                         # latentに変換
-                        latents = vae.encode(batch["images"].to(vae_dtype)).latent_dist.sample().to(weight_dtype)
+                        latents = vae.encode(train_util.augment_batch_images(batch).to(vae_dtype)).latent_dist.sample().to(weight_dtype)
 
                         # NaNが含まれていれば警告を表示し0に置き換える
                         if torch.any(torch.isnan(latents)):
@@ -120,6 +120,11 @@ def train(args):
     else:
         print("WARNING: random_crop is not supported yet for ControlNet training / ControlNetの学習ではrandom_cropはまだサポートされていません")
 
+    if args.image_ram_cache_size > 0 and not cache_latents:
+        train_dataset_group.enable_image_cache(args.image_ram_cache_size)
+    if args.gpu_augmentation:
+        train_dataset_group.set_gpu_augmentation(True)
+
     if args.cache_text_encoder_outputs:
         assert (
             train_dataset_group.is_text_encoder_output_cacheable()
@@ -156,6 +161,10 @@ def train(args):
                 args.vae_batch_size,
                 args.cache_latents_to_disk,
                 accelerator.is_main_process,
+                latents_cache_dir=args.latents_cache_dir,
+                num_workers=args.cache_latents_workers,
+                storage_dtype=args.cache_storage_dtype,
+                compress=args.cache_compress,
             )
         vae.to("cpu")
         if torch.cuda.is_available():
@@ -175,6 +184,9 @@ def train(args):
                 None,
                 args.cache_text_encoder_outputs_to_disk,
                 accelerator.is_main_process,
+                storage_dtype=args.cache_storage_dtype,
+                compress=args.cache_compress,
+                model_identity=train_util.get_text_encoder_model_identity(args),
             )
         accelerator.wait_for_everyone()
 
@@ -385,7 +397,7 @@ def train(args):
                         latents = batch["latents"].to(accelerator.device)
                     else:
                         # latentに変換
-                        latents = vae.encode(batch["images"].to(dtype=vae_dtype)).latent_dist.sample()
+                        latents = vae.encode(train_util.augment_batch_images(batch).to(dtype=vae_dtype)).latent_dist.sample()
 
                         # NaNが含まれていれば警告を表示し0に置き換える
                         if torch.any(torch.isnan(latents)):
@@ -14,15 +14,6 @@ class SdxlNetworkTrainer(train_network.NetworkTrainer):
         super().assert_extra_args(args, train_dataset_group)
         sdxl_train_util.verify_sdxl_training_args(args)
 
-        if args.cache_text_encoder_outputs:
-            assert (
-                train_dataset_group.is_text_encoder_output_cacheable()
-            ), "when caching Text Encoder output, either caption_dropout_rate, shuffle_caption, token_warmup_step or caption_tag_dropout_rate cannot be used / Text Encoderの出力をキャッシュするときはcaption_dropout_rate, shuffle_caption, token_warmup_step, caption_tag_dropout_rateは使えません"
-
-        assert (
-            args.network_train_unet_only or not args.cache_text_encoder_outputs
-        ), "network for Text Encoder cannot be trained with caching Text Encoder outputs / Text Encoderの出力をキャッシュしながらText Encoderのネットワークを学習することはできません"
-
         train_dataset_group.verify_bucket_reso_steps(32)
 
     def load_target_model(self, args, weight_dtype, accelerator):
@@ -70,6 +61,9 @@ class SdxlNetworkTrainer(train_network.NetworkTrainer):
                 weight_dtype,
                 args.cache_text_encoder_outputs_to_disk,
                 accelerator.is_main_process,
+                storage_dtype=args.cache_storage_dtype,
+                compress=args.cache_compress,
+                model_identity=train_util.get_text_encoder_model_identity(args),
             )
 
             text_encoders[0].to("cpu", dtype=torch.float32)  # Text Encoder doesn't work with fp16 on CPU
@@ -156,13 +150,15 @@ class SdxlNetworkTrainer(train_network.NetworkTrainer):
         noise_pred = unet(noisy_latents, timesteps, text_embedding, vector_embedding)
         return noise_pred
 
-    def sample_images(self, accelerator, args, epoch, global_step, device, vae, tokenizer, text_encoder, unet):
-        sdxl_train_util.sample_images(accelerator, args, epoch, global_step, device, vae, tokenizer, text_encoder, unet)
+    def sample_images(self, accelerator, args, epoch, global_step, device, vae, tokenizer, text_encoder, unet, network=None):
+        sdxl_train_util.sample_images(
+            accelerator, args, epoch, global_step, device, vae, tokenizer, text_encoder, unet, network=network
+        )
 
 
 def setup_parser() -> argparse.ArgumentParser:
     parser = train_network.setup_parser()
-    sdxl_train_util.add_sdxl_training_arguments(parser)
+    # don't add sdxl_train_util.add_sdxl_training_arguments(parser): text encoder caching args are added by train_network
     return parser
 
 
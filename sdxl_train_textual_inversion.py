@@ -78,8 +78,19 @@ class SdxlTextualInversionTrainer(train_textual_inversion.TextualInversionTraine
         return noise_pred
 
     def sample_images(self, accelerator, args, epoch, global_step, device, vae, tokenizer, text_encoder, unet, prompt_replacement):
+        # the worker process loads the base Text Encoder without the new tokens, so samples are generated here
         sdxl_train_util.sample_images(
-            accelerator, args, epoch, global_step, device, vae, tokenizer, text_encoder, unet, prompt_replacement
+            accelerator,
+            args,
+            epoch,
+            global_step,
+            device,
+            vae,
+            tokenizer,
+            text_encoder,
+            unet,
+            prompt_replacement,
+            allow_background=False,
         )
 
     def save_weights(self, file, updated_embs, save_dtype, metadata):
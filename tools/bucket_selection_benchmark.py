@@ -0,0 +1,73 @@
+# BucketManager.select_bucket (1枚ずつ) と select_buckets (まとめて) の速度を比較する
+# micro-benchmark: scalar select_bucket loop vs vectorized select_buckets
+
+import argparse
+import time
+
+import numpy as np
+
+from library.train_util import BucketManager
+
+
+def make_bucket_manager(no_upscale, resolution, min_bucket_reso, max_bucket_reso, bucket_reso_steps):
+    bucket_manager = BucketManager(no_upscale, (resolution, resolution), min_bucket_reso, max_bucket_reso, bucket_reso_steps)
+    if not no_upscale:
+        bucket_manager.make_buckets()
+    return bucket_manager
+
+
+def benchmark(args, no_upscale):
+    rng = np.random.default_rng(args.seed)
+    widths = rng.integers(args.min_image_size, args.max_image_size + 1, size=args.num_images)
+    heights = rng.integers(args.min_image_size, args.max_image_size + 1, size=args.num_images)
+
+    bucket_manager = make_bucket_manager(
+        no_upscale, args.resolution, args.min_bucket_reso, args.max_bucket_reso, args.bucket_reso_steps
+    )
+    w_list = widths.tolist()
+    h_list = heights.tolist()
+    start = time.perf_counter()
+    scalar_results = [bucket_manager.select_bucket(w, h) for w, h in zip(w_list, h_list)]
+    scalar_time = time.perf_counter() - start
+    scalar_resos = bucket_manager.resos
+
+    bucket_manager = make_bucket_manager(
+        no_upscale, args.resolution, args.min_bucket_reso, args.max_bucket_reso, args.bucket_reso_steps
+    )
+    start = time.perf_counter()
+    bucket_ids, resized_sizes, ar_errors = bucket_manager.select_buckets(widths, heights)
+    vectorized_time = time.perf_counter() - start
+
+    # 結果が同じことを確認する / check the results are identical
+    assert bucket_manager.resos == scalar_resos, "bucket order mismatch"
+    resos = [bucket_manager.resos[i] for i in bucket_ids.tolist()]
+    assert resos == [r[0] for r in scalar_results], "bucket mismatch"
+    assert [tuple(s) for s in resized_sizes.tolist()] == [tuple(r[1]) for r in scalar_results], "resized size mismatch"
+    assert np.allclose(ar_errors, [r[2] for r in scalar_results]), "ar error mismatch"
+
+    mode = "no_upscale" if no_upscale else "predefined"
+    print(
+        f"{mode}: {args.num_images} images, {len(bucket_manager.resos)} buckets, "
+        + f"select_bucket {scalar_time:.3f}s, select_buckets {vectorized_time:.3f}s, speedup {scalar_time / vectorized_time:.1f}x"
+    )
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_images", type=int, default=1000000, help="number of image sizes / 画像サイズの数")
+    parser.add_argument("--resolution", type=int, default=1024, help="training resolution / 学習解像度")
+    parser.add_argument("--min_bucket_reso", type=int, default=256, help="minimum resolution for buckets / bucketの最小解像度")
+    parser.add_argument("--max_bucket_reso", type=int, default=2048, help="maximum resolution for buckets / bucketの最大解像度")
+    parser.add_argument("--bucket_reso_steps", type=int, default=64, help="steps of resolution for buckets / bucketの解像度の単位")
+    parser.add_argument("--min_image_size", type=int, default=256, help="minimum image size / 画像サイズの最小値")
+    parser.add_argument("--max_image_size", type=int, default=4096, help="maximum image size / 画像サイズの最大値")
+    parser.add_argument("--seed", type=int, default=42, help="random seed / 乱数シード")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+
+    args = parser.parse_args()
+    benchmark(args, False)
+    benchmark(args, True)
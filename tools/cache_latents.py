@@ -12,6 +12,7 @@ from tqdm import tqdm
 from library import config_util
 from library import train_util
 from library import sdxl_train_util
+from library.latent_store import get_latent_store
 from library.config_util import (
     ConfigSanitizer,
     BlueprintGenerator,
@@ -22,7 +23,9 @@ def cache_to_disk(args: argparse.Namespace) -> None:
     train_util.prepare_dataset_args(args, True)
 
     # check cache latents arg
-    assert args.cache_latents_to_disk, "cache_latents_to_disk must be True / cache_latents_to_diskはTrueである必要があります"
+    assert (
+        args.cache_latents_to_disk or args.latents_cache_dir is not None
+    ), "cache_latents_to_disk must be True / cache_latents_to_diskはTrueである必要があります"
 
     use_dreambooth_method = args.in_json is None
 
@@ -128,6 +131,11 @@ def cache_to_disk(args: argparse.Namespace) -> None:
     # acceleratorを使ってモデルを準備する：マルチGPUで使えるようになるはず
     train_dataloader = accelerator.prepare(train_dataloader)
 
+    # sharded storeはプロセスごとに別のshard/indexファイルに書き込む
+    latents_store = None
+    if args.latents_cache_dir is not None:
+        latents_store = get_latent_store(args.latents_cache_dir, accelerator.process_index)
+
     # データ取得のためのループ
     for batch in tqdm(train_dataloader):
         b_size = len(batch["images"])
@@ -151,14 +159,30 @@ def cache_to_disk(args: argparse.Namespace) -> None:
                 image_info.latents_npz = os.path.splitext(absolute_path)[0] + ".npz"
 
                 if args.skip_existing:
-                    if train_util.is_disk_cached_latents_is_expected(image_info.bucket_reso, image_info.latents_npz, flip_aug):
+                    if latents_store is not None:
+                        if latents_store.is_cached(absolute_path, bucket_reso, flip_aug):
+                            print(f"Skipping {absolute_path} because it already exists in {args.latents_cache_dir}.")
+                            continue
+                    elif train_util.is_disk_cached_latents_is_expected(image_info.bucket_reso, image_info.latents_npz, flip_aug):
                         print(f"Skipping {image_info.latents_npz} because it already exists.")
                         continue
 
                 image_infos.append(image_info)
 
             if len(image_infos) > 0:
-                train_util.cache_batch_latents(vae, True, image_infos, flip_aug, random_crop)
+                train_util.cache_batch_latents(
+                    vae,
+                    True,
+                    image_infos,
+                    flip_aug,
+                    random_crop,
+                    latents_store,
+                    storage_dtype=args.cache_storage_dtype,
+                    compress=args.cache_compress,
+                )
+
+    if latents_store is not None:
+        latents_store.close()
 
     accelerator.wait_for_everyone()
     accelerator.print(f"Finished caching latents for {len(train_dataset_group)} batches.")
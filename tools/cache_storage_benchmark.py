@@ -0,0 +1,106 @@
+# latentとText Encoderの出力のキャッシュについて、保存形式（dtype、圧縮）ごとのディスク使用量と読み込み速度を比較する
+# report disk usage and load throughput of cache storage formats (dtype, compression)
+
+import argparse
+import glob
+import itertools
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from library import train_util
+
+
+def load_samples(args):
+    # 既存のキャッシュがあればそれを使い、なければランダムな値を使う
+    samples = []
+    if args.npz_dir is not None:
+        for npz_path in sorted(glob.glob(os.path.join(args.npz_dir, "*.npz")))[: args.num_files]:
+            with np.load(npz_path) as f:
+                if "latents" in f:
+                    latents, original_size, crop_ltrb, flipped_latents = train_util.load_latents_from_disk(npz_path)
+                    samples.append(("latents", torch.from_numpy(latents), original_size, crop_ltrb))
+                elif "hidden_state1" in f:
+                    hidden_state1, hidden_state2, pool2 = train_util.load_text_encoder_outputs_from_disk(npz_path)
+                    samples.append(("te", hidden_state1, hidden_state2, pool2))
+        print(f"loaded {len(samples)} cache files from {args.npz_dir}")
+
+    if len(samples) == 0:
+        print(f"use {args.num_files} random latents ({args.latents_size}x{args.latents_size}) and SDXL text encoder outputs")
+        for i in range(args.num_files):
+            if i % 2 == 0:
+                latents = torch.randn(4, args.latents_size, args.latents_size)
+                samples.append(("latents", latents, [args.latents_size * 8] * 2, [0, 0, args.latents_size * 8, args.latents_size * 8]))
+            else:
+                samples.append(("te", torch.randn(77, 768), torch.randn(77, 1280), torch.randn(1280)))
+    return samples
+
+
+def benchmark(args):
+    samples = load_samples(args)
+
+    results = []
+    for storage_dtype, compress in itertools.product(train_util.CACHE_STORAGE_DTYPES, [False, True]):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            paths = []
+            for i, sample in enumerate(samples):
+                npz_path = os.path.join(temp_dir, f"{i:06d}.npz")
+                if sample[0] == "latents":
+                    _, latents, original_size, crop_ltrb = sample
+                    train_util.save_latents_to_disk(
+                        npz_path, latents, original_size, crop_ltrb, storage_dtype=storage_dtype, compress=compress
+                    )
+                else:
+                    _, hidden_state1, hidden_state2, pool2 = sample
+                    train_util.save_text_encoder_outputs_to_disk(
+                        npz_path, hidden_state1, hidden_state2, pool2, storage_dtype=storage_dtype, compress=compress
+                    )
+                paths.append(npz_path)
+            total_size = sum([os.path.getsize(path) for path in paths])
+
+            # 読み込み時間と、float32との差の最大値を測る / measure load time and max error from float32
+            max_error = 0.0
+            start_time = time.perf_counter()
+            for sample, npz_path in zip(samples, paths):
+                if sample[0] == "latents":
+                    loaded = torch.from_numpy(train_util.load_latents_from_disk(npz_path)[0])
+                else:
+                    loaded = train_util.load_text_encoder_outputs_from_disk(npz_path)[0]
+                max_error = max(max_error, (loaded - sample[1].float()).abs().max().item())
+            load_time = time.perf_counter() - start_time
+
+            results.append((storage_dtype, compress, total_size, len(paths) / load_time, max_error))
+
+    base_size = results[0][2]
+    base_speed = results[0][3]
+    print(f"{'dtype':<10}{'compress':<10}{'size (MB)':>12}{'saved':>9}{'files/s':>12}{'speed':>9}{'max error':>12}")
+    for storage_dtype, compress, total_size, files_per_sec, max_error in results:
+        print(
+            f"{storage_dtype:<10}{str(compress):<10}{total_size / 1024**2:>12.2f}{1 - total_size / base_size:>9.1%}"
+            + f"{files_per_sec:>12.1f}{files_per_sec / base_speed:>8.2f}x{max_error:>12.2e}"
+        )
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--npz_dir",
+        type=str,
+        default=None,
+        help="directory of existing latents / text encoder outputs cache (npz) / 既存のキャッシュ（npz）のディレクトリ",
+    )
+    parser.add_argument("--num_files", type=int, default=1000, help="number of files to benchmark / ベンチマークするファイル数")
+    parser.add_argument(
+        "--latents_size", type=int, default=128, help="size of random latents (1024px: 128) / ランダムなlatentのサイズ（1024px: 128）"
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+
+    args = parser.parse_args()
+    benchmark(args)
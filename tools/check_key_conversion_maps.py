@@ -0,0 +1,115 @@
+# model_util / sdxl_model_util のキー変換（Diffusers <-> StableDiffusion）が往復で元に戻ることを確認する
+# check that the key conversion maps of each architecture are lossless: Diffusers keys -> SD keys -> Diffusers keys.
+# models are created on the meta device, so no weights are needed and it runs in a few seconds on CPU
+
+import argparse
+
+from accelerate import init_empty_weights
+from diffusers import AutoencoderKL, ControlNetModel, UNet2DConditionModel as DiffusersUNet2DConditionModel
+
+from library import model_util, sdxl_model_util, sdxl_original_unet
+from library.original_unet import UNet2DConditionModel
+
+
+def report(name, failed, num_keys):
+    print(f"{name:<24}{num_keys:>6} keys  " + ("OK" if len(failed) == 0 else f"NG: {len(failed)} keys are not restored"))
+    for key in failed[:10]:
+        print(f"  {key}")
+    return len(failed) == 0
+
+
+def compare_keys(name, keys, restored_keys):
+    keys = set(keys)
+    restored_keys = set(restored_keys)
+    failed = sorted(keys ^ restored_keys)
+    return report(name, failed, len(keys))
+
+
+def check_sd_unet(v2):
+    name = "SD2 U-Net" if v2 else "SD1 U-Net"
+    unet_config = model_util.create_unet_diffusers_config(v2)
+    with init_empty_weights():
+        unet = UNet2DConditionModel(**unet_config)
+    unet_sd = unet.state_dict()
+
+    ok = report(name, model_util.get_unet_key_conversion_map().check_round_trip(unet_sd.keys()), len(unet_sd))
+
+    # save (key map) -> load (convert_ldm_unet_checkpoint) must restore the keys of the model
+    sd = model_util.convert_unet_state_dict_to_sd(v2, unet_sd)
+    sd = {"model.diffusion_model." + k: v for k, v in sd.items()}
+    restored = model_util.convert_ldm_unet_checkpoint(v2, sd, unet_config)
+    ok = compare_keys(name + " (load)", unet_sd.keys(), restored.keys()) and ok
+    return ok
+
+
+def check_vae():
+    vae_config = model_util.create_vae_diffusers_config()
+    with init_empty_weights():
+        vae = AutoencoderKL(**vae_config)
+    vae_sd = vae.state_dict()
+
+    ok = report("VAE", model_util.get_vae_key_conversion_map().check_round_trip(vae_sd.keys()), len(vae_sd))
+
+    sd = model_util.convert_vae_state_dict(vae_sd)
+    sd = {"first_stage_model." + k: v for k, v in sd.items()}
+    restored = model_util.convert_ldm_vae_checkpoint(sd, vae_config)
+    ok = compare_keys("VAE (load)", vae_sd.keys(), restored.keys()) and ok
+    return ok
+
+
+def check_controlnet():
+    with init_empty_weights():
+        controlnet = ControlNetModel(cross_attention_dim=model_util.UNET_PARAMS_CONTEXT_DIM)
+    keys = list(controlnet.state_dict().keys())
+    return report("ControlNet", model_util.get_controlnet_key_conversion_map().check_round_trip(keys), len(keys))
+
+
+def check_sdxl_unet():
+    with init_empty_weights():
+        unet = sdxl_original_unet.SdxlUNet2DConditionModel()
+        diffusers_unet = DiffusersUNet2DConditionModel(**sdxl_model_util.DIFFUSERS_SDXL_UNET_CONFIG)
+    sd_keys = list(unet.state_dict().keys())
+    keys = list(diffusers_unet.state_dict().keys())
+
+    key_map = sdxl_model_util.get_unet_key_conversion_map()
+    ok = report("SDXL U-Net", key_map.check_round_trip(keys), len(keys))
+    ok = compare_keys("SDXL U-Net (SD keys)", sd_keys, [key_map.to_target(k) for k in keys]) and ok
+    return ok
+
+
+def check(args):
+    results = []
+    if "sd1" in args.archs:
+        results.append(check_sd_unet(False))
+    if "sd2" in args.archs:
+        results.append(check_sd_unet(True))
+    if "vae" in args.archs:
+        results.append(check_vae())
+    if "controlnet" in args.archs:
+        results.append(check_controlnet())
+    if "sdxl" in args.archs:
+        results.append(check_sdxl_unet())
+
+    if not all(results):
+        raise SystemExit("key conversion is not lossless / キー変換で元に戻らないキーがあります")
+    print("all key conversions are lossless / すべてのキー変換は往復で元に戻ります")
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--archs",
+        type=str,
+        nargs="*",
+        default=["sd1", "sd2", "vae", "controlnet", "sdxl"],
+        choices=["sd1", "sd2", "vae", "controlnet", "sdxl"],
+        help="architectures to check / 確認するモデル",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+
+    args = parser.parse_args()
+    check(args)
@@ -0,0 +1,104 @@
+# SD1/SD2のcheckpointの読み込み時間とピークメモリ（RSS）を、従来の方法（全体を読み込み、乱数で初期化したモデルにload_state_dict）と比較する
+# report load time and peak RSS of model_util.load_models_from_stable_diffusion_checkpoint (lazy file access, meta device,
+# no random init) and the legacy path (load_file, random init and load_state_dict). each run uses a fresh process
+
+import argparse
+import multiprocessing
+import sys
+import time
+
+
+def get_peak_rss_mb():
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024**2 if sys.platform == "darwin" else peak / 1024  # bytes on macOS, KB on Linux
+    except ImportError:
+        import psutil
+
+        return psutil.Process().memory_info().peak_wset / 1024**2  # Windows
+
+
+def load_legacy(v2, ckpt_path, device):
+    # 以前の model_util.load_models_from_stable_diffusion_checkpoint と同じ処理
+    from transformers import CLIPTextModel
+    from diffusers import AutoencoderKL
+    from library import model_util
+    from library.original_unet import UNet2DConditionModel
+
+    # whole state dict in memory, same as load_file
+    _, state_dict = model_util.load_checkpoint_with_text_encoder_conversion(ckpt_path)
+    state_dict = dict(state_dict.items())
+
+    unet_config = model_util.create_unet_diffusers_config(v2)
+    converted_unet_checkpoint = model_util.convert_ldm_unet_checkpoint(v2, state_dict, unet_config)
+    unet = UNet2DConditionModel(**unet_config).to(device)
+    unet.load_state_dict(converted_unet_checkpoint)
+
+    vae_config = model_util.create_vae_diffusers_config()
+    converted_vae_checkpoint = model_util.convert_ldm_vae_checkpoint(state_dict, vae_config)
+    vae = AutoencoderKL(**vae_config).to(device)
+    vae.load_state_dict(converted_vae_checkpoint)
+
+    if v2:
+        converted_text_encoder_checkpoint = model_util.convert_ldm_clip_checkpoint_v2(state_dict, 77)
+    else:
+        converted_text_encoder_checkpoint = model_util.convert_ldm_clip_checkpoint_v1(state_dict)
+    text_model = CLIPTextModel._from_config(model_util.create_text_encoder_config(v2))
+    text_model.load_state_dict(converted_text_encoder_checkpoint)
+    return text_model, vae, unet
+
+
+def run(mode, v2, ckpt_path, device, queue):
+    from library import model_util
+
+    start = time.perf_counter()
+    if mode == "legacy":
+        models = load_legacy(v2, ckpt_path, device)
+    else:
+        models = model_util.load_models_from_stable_diffusion_checkpoint(v2, ckpt_path, device)
+    elapsed = time.perf_counter() - start
+
+    num_params = sum(p.numel() for model in models for p in model.parameters())
+    queue.put((mode, elapsed, get_peak_rss_mb(), num_params))
+
+
+def benchmark(args):
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for mode in args.modes:
+        for _ in range(args.repeats):
+            queue = context.Queue()
+            process = context.Process(target=run, args=(mode, args.v2, args.ckpt, args.device, queue))
+            process.start()
+            results.append(queue.get())
+            process.join()
+
+    print(f"{'mode':<10}{'time (s)':>10}{'peak RSS (MB)':>16}{'params (M)':>12}")
+    for mode, elapsed, peak_rss, num_params in results:
+        print(f"{mode:<10}{elapsed:>10.2f}{peak_rss:>16.0f}{num_params / 1e6:>12.1f}")
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt", type=str, required=True, help="SD1/SD2 checkpoint (ckpt or safetensors) / 読み込むモデル")
+    parser.add_argument("--v2", action="store_true", help="load Stable Diffusion v2.x model / Stable Diffusion 2.xのモデルを読み込む")
+    parser.add_argument("--device", type=str, default="cpu", help="device to load U-Net and VAE / U-NetとVAEを読み込むデバイス")
+    parser.add_argument(
+        "--modes",
+        type=str,
+        nargs="*",
+        default=["legacy", "meta"],
+        choices=["legacy", "meta"],
+        help="loading methods to compare / 比較する読み込み方法",
+    )
+    parser.add_argument("--repeats", type=int, default=1, help="number of runs for each mode / それぞれの方法の実行回数")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+
+    args = parser.parse_args()
+    benchmark(args)
@@ -0,0 +1,143 @@
+# --scale_weight_norms の LoRANetwork.apply_max_norm_regularization の1ステップあたりの時間を、以前の実装と比較する
+# benchmark per-step overhead of LoRANetwork.apply_max_norm_regularization (Gram matrices, batched by shape, one sync)
+# against the legacy implementation (state_dict, materialized up @ down and a sync for each module).
+# the base models are created on the meta device, only the LoRA modules have weights
+
+import argparse
+import time
+
+import torch
+from accelerate import init_empty_weights
+from transformers import CLIPTextConfig, CLIPTextModel
+
+from library import model_util, sdxl_original_unet
+from library.original_unet import UNet2DConditionModel
+from networks import lora
+
+
+def legacy_apply_max_norm_regularization(network, max_norm_value, device):
+    # 以前の LoRANetwork.apply_max_norm_regularization と同じ処理
+    downkeys = []
+    upkeys = []
+    alphakeys = []
+    norms = []
+    keys_scaled = 0
+
+    state_dict = network.state_dict()
+    for key in state_dict.keys():
+        if "lora_down" in key and "weight" in key:
+            downkeys.append(key)
+            upkeys.append(key.replace("lora_down", "lora_up"))
+            alphakeys.append(key.replace("lora_down.weight", "alpha"))
+
+    for i in range(len(downkeys)):
+        down = state_dict[downkeys[i]].to(device)
+        up = state_dict[upkeys[i]].to(device)
+        alpha = state_dict[alphakeys[i]].to(device)
+        dim = down.shape[0]
+        scale = alpha / dim
+
+        if up.shape[2:] == (1, 1) and down.shape[2:] == (1, 1):
+            updown = (up.squeeze(2).squeeze(2) @ down.squeeze(2).squeeze(2)).unsqueeze(2).unsqueeze(3)
+        elif up.shape[2:] == (3, 3) or down.shape[2:] == (3, 3):
+            updown = torch.nn.functional.conv2d(down.permute(1, 0, 2, 3), up).permute(1, 0, 2, 3)
+        else:
+            updown = up @ down
+
+        updown *= scale
+
+        norm = updown.norm().clamp(min=max_norm_value / 2)
+        desired = torch.clamp(norm, max=max_norm_value)
+        ratio = desired.cpu() / norm.cpu()
+        sqrt_ratio = ratio**0.5
+        if ratio != 1:
+            keys_scaled += 1
+            state_dict[upkeys[i]] *= sqrt_ratio
+            state_dict[downkeys[i]] *= sqrt_ratio
+        scalednorm = updown.norm() * ratio
+        norms.append(scalednorm.item())
+
+    return keys_scaled, sum(norms) / len(norms), max(norms)
+
+
+def create_network(args, device):
+    with init_empty_weights():
+        if args.sdxl:
+            unet = sdxl_original_unet.SdxlUNet2DConditionModel()
+            # only the Linear layers matter, so the Text Encoder 2 is CLIPTextModel with the size of OpenCLIP bigG
+            text_encoder2_config = CLIPTextConfig(
+                hidden_size=1280, intermediate_size=5120, num_hidden_layers=32, num_attention_heads=20, hidden_act="gelu"
+            )
+            text_encoder = [
+                CLIPTextModel._from_config(model_util.create_text_encoder_config(False)),
+                CLIPTextModel._from_config(text_encoder2_config),
+            ]
+        else:
+            unet = UNet2DConditionModel(**model_util.create_unet_diffusers_config(args.v2))
+            text_encoder = CLIPTextModel._from_config(model_util.create_text_encoder_config(args.v2))
+
+    network_args = {} if args.conv_dim is None else {"conv_dim": str(args.conv_dim), "conv_alpha": str(args.conv_dim)}
+    network = lora.create_network(1.0, args.network_dim, args.network_alpha, None, text_encoder, unet, **network_args)
+    network.apply_to(text_encoder, unet, True, True)  # LoRA modules are registered to the network here
+
+    # lora_up is initialized with zeros, so both weights of each module are random
+    generator = torch.Generator().manual_seed(args.seed)
+    for lora_module in network.text_encoder_loras + network.unet_loras:
+        for weight in [lora_module.lora_down.weight, lora_module.lora_up.weight]:
+            weight.data = torch.randn(weight.shape, generator=generator) * args.init_std
+    return network.to(device, dtype=args.dtype)
+
+
+def benchmark(args):
+    device = torch.device(args.device) if args.device else torch.device("cpu")
+    args.dtype = {"float": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}[args.precision]
+    network = create_network(args, device)
+    org_state_dict = {k: v.clone() for k, v in network.state_dict().items()}
+    num_modules = len(network.text_encoder_loras) + len(network.unet_loras)
+    print(f"device: {device}, modules: {num_modules}, dim: {args.network_dim}, conv_dim: {args.conv_dim}, {args.precision}")
+
+    methods = [("legacy", legacy_apply_max_norm_regularization), ("batched", type(network).apply_max_norm_regularization)]
+    print(f"{'method':<10}{'ms/step':>10}{'scaled':>8}{'mean norm':>12}{'max norm':>12}")
+    for name, func in methods:
+        network.load_state_dict(org_state_dict)
+        for _ in range(args.warmup):
+            func(network, args.max_norm, device)
+        network.load_state_dict(org_state_dict)
+
+        # the first step scales the modules, the later steps measure the steady state (nothing to scale)
+        result = func(network, args.max_norm, device)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            func(network, args.max_norm, device)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = (time.perf_counter() - start) / args.steps
+
+        keys_scaled, mean_norm, max_norm = result
+        print(f"{name:<10}{elapsed * 1000:>10.2f}{keys_scaled:>8}{mean_norm:>12.5f}{max_norm:>12.5f}")
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--v2", action="store_true", help="Stable Diffusion 2.x model / Stable Diffusion 2.xのモデル")
+    parser.add_argument("--sdxl", action="store_true", help="SDXL model / SDXLのモデル")
+    parser.add_argument("--network_dim", type=int, default=32, help="network dim / networkのrank")
+    parser.add_argument("--network_alpha", type=float, default=16, help="network alpha / networkのalpha")
+    parser.add_argument("--conv_dim", type=int, default=None, help="dim of 3x3 conv (LoCon) / 3x3 convのrank")
+    parser.add_argument("--max_norm", type=float, default=1.0, help="value of --scale_weight_norms / --scale_weight_normsの値")
+    parser.add_argument("--init_std", type=float, default=0.05, help="std of random weights / 重みの乱数の標準偏差")
+    parser.add_argument("--precision", type=str, default="float", choices=["float", "fp16", "bf16"], help="dtype of network")
+    parser.add_argument("--steps", type=int, default=20, help="number of measured steps / 計測するステップ数")
+    parser.add_argument("--warmup", type=int, default=2, help="number of warmup steps / ウォームアップのステップ数")
+    parser.add_argument("--device", type=str, default=None, help="device to use, cuda for GPU / 計算を行うデバイス、cuda でGPUを使う")
+    parser.add_argument("--seed", type=int, default=42, help="random seed / 乱数シード")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+
+    args = parser.parse_args()
+    benchmark(args)
@@ -8,9 +8,9 @@
 
 import argparse
 import torch
-from safetensors.torch import load_file, save_file, safe_open
+from safetensors.torch import load_file, safe_open
 from tqdm import tqdm
-from library import train_util, model_util
+from library import model_util, safetensors_utils
 import numpy as np
 
 MIN_SV = 1e-6
@@ -38,7 +38,7 @@ def save_to_file(file_name, model, state_dict, dtype, metadata):
         state_dict[key] = state_dict[key].to(dtype)
 
   if model_util.is_safetensors(file_name):
-    save_file(model, file_name, metadata)
+    safetensors_utils.save_file(model, file_name, metadata, add_hashes=True)  # hashes are calculated while writing
   else:
     torch.save(model, file_name)
 
@@ -307,10 +307,6 @@ def resize(args):
     metadata["ss_network_dim"] = 'Dynamic'
     metadata["ss_network_alpha"] = 'Dynamic'
 
-  model_hash, legacy_hash = train_util.precalculate_safetensors_hashes(state_dict, metadata)
-  metadata["sshs_model_hash"] = model_hash
-  metadata["sshs_legacy_hash"] = legacy_hash
-
   print(f"saving model to: {args.save_to}")
   save_to_file(args.save_to, state_dict, state_dict, save_dtype, metadata)
 
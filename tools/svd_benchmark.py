@@ -0,0 +1,86 @@
+# library/svd_util.py の exact / randomized SVD の速度と、Frobenius normの保持率を比較する
+# benchmark wall time and Frobenius norm retention of exact and randomized SVD for LoRA-sized matrices
+
+import argparse
+import time
+
+import torch
+
+from library import svd_util
+
+
+# (out_dim, in_dim) of typical SDXL modules: attention, feed forward and flattened 3x3 conv
+SDXL_SHAPES = [(640, 640), (1280, 1280), (1280, 2048), (5120, 1280), (1280, 5120), (640, 640 * 9), (1280, 1280 * 9)]
+
+
+def make_matrix(shape, kind, lora_rank, generator, device):
+    out_dim, in_dim = shape
+    if kind == "lora":
+        # merged LoRA (resize_lora, svd_merge_lora): rank is at most lora_rank
+        up = torch.randn(out_dim, lora_rank, generator=generator) * 0.1
+        down = torch.randn(lora_rank, in_dim, generator=generator) * 0.1
+        return (up @ down).to(device)
+
+    # diff of fine-tuned model (extract_lora_from_models): full rank with decaying spectrum
+    k = min(out_dim, in_dim)
+    u, _ = torch.linalg.qr(torch.randn(out_dim, k, generator=generator))
+    v, _ = torch.linalg.qr(torch.randn(in_dim, k, generator=generator))
+    s = 1.0 / (1.0 + torch.arange(k, dtype=torch.float32)) ** 0.75
+    return ((u * s) @ v.T).to(device)
+
+
+def retention(mat, S):
+    return float(torch.sqrt(torch.sum(S.pow(2)) / torch.sum(mat.pow(2))))
+
+
+def benchmark(args):
+    device = torch.device(args.device) if args.device else torch.device("cpu")
+    generator = torch.Generator().manual_seed(args.seed)
+
+    print(f"device: {device}, rank: {args.rank}, oversample: {args.oversample}, niter: {args.niter}")
+    for kind in ["lora", "diff"]:
+        total_exact = total_randomized = 0.0
+        print(f"\n[{kind}] " + ("merged LoRA weights" if kind == "lora" else "full rank weights (model diff)"))
+        print(f"{'shape':>14} {'exact (s)':>10} {'random (s)':>11} {'speedup':>8} {'fro exact':>10} {'fro random':>11} {'error':>8}")
+        for shape in SDXL_SHAPES:
+            mat = make_matrix(shape, kind, args.lora_rank, generator, device)
+            rank_bound = args.lora_rank if kind == "lora" else None
+            method = "auto" if kind == "lora" else "randomized"
+
+            start = time.perf_counter()
+            _, S_exact, _, _ = svd_util.truncated_svd(mat, args.rank, "exact")
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            exact_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            _, S_random, _, error = svd_util.truncated_svd(mat, args.rank, method, rank_bound, args.oversample, args.niter)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            randomized_time = time.perf_counter() - start
+
+            total_exact += exact_time
+            total_randomized += randomized_time
+            print(
+                f"{str(shape):>14} {exact_time:>10.3f} {randomized_time:>11.3f} {exact_time / randomized_time:>7.1f}x"
+                + f" {retention(mat, S_exact):>10.4%} {retention(mat, S_random):>11.4%} {error:>8.4f}"
+            )
+        print(f"{'total':>14} {total_exact:>10.3f} {total_randomized:>11.3f} {total_exact / total_randomized:>7.1f}x")
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rank", type=int, default=32, help="rank to extract / 抽出するrank")
+    parser.add_argument("--lora_rank", type=int, default=64, help="rank of merged LoRA weights / マージするLoRAのrank")
+    parser.add_argument("--oversample", type=int, default=svd_util.DEFAULT_OVERSAMPLE, help="oversampling for randomized SVD")
+    parser.add_argument("--niter", type=int, default=svd_util.DEFAULT_NITER, help="power iterations for randomized SVD")
+    parser.add_argument("--device", type=str, default=None, help="device to use, cuda for GPU / 計算を行うデバイス、cuda でGPUを使う")
+    parser.add_argument("--seed", type=int, default=42, help="random seed / 乱数シード")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = setup_parser()
+
+    args = parser.parse_args()
+    benchmark(args)
@@ -26,6 +26,7 @@ from library.config_util import (
     BlueprintGenerator,
 )
 import library.huggingface_util as huggingface_util
+import library.checkpoint_writer as checkpoint_writer
 import library.custom_train_functions as custom_train_functions
 from library.custom_train_functions import (
     apply_snr_weight,
@@ -85,7 +86,24 @@ class NetworkTrainer:
         return logs
 
     def assert_extra_args(self, args, train_dataset_group):
-        pass
+        if args.cache_text_encoder_outputs_to_disk and not args.cache_text_encoder_outputs:
+            args.cache_text_encoder_outputs = True
+            print(
+                "cache_text_encoder_outputs is enabled because cache_text_encoder_outputs_to_disk is enabled / "
+                + "cache_text_encoder_outputs_to_diskが有効になっているためcache_text_encoder_outputsが有効になりました"
+            )
+
+        if args.cache_text_encoder_outputs:
+            assert (
+                train_dataset_group.is_text_encoder_output_cacheable()
+            ), "when caching Text Encoder output, either caption_dropout_rate, shuffle_caption, token_warmup_step or caption_tag_dropout_rate cannot be used / Text Encoderの出力をキャッシュするときはcaption_dropout_rate, shuffle_caption, token_warmup_step, caption_tag_dropout_rateは使えません"
+            assert (
+                not args.weighted_captions
+            ), "weighted_captions cannot be used with caching Text Encoder outputs / Text Encoderの出力をキャッシュするときはweighted_captionsは使えません"
+
+        assert (
+            args.network_train_unet_only or not args.cache_text_encoder_outputs
+        ), "network for Text Encoder cannot be trained with caching Text Encoder outputs / Text Encoderの出力をキャッシュしながらText Encoderのネットワークを学習することはできません"
 
     def load_target_model(self, args, weight_dtype, accelerator):
         text_encoder, vae, unet, _ = train_util.load_target_model(args, weight_dtype, accelerator)
@@ -96,15 +114,53 @@ class NetworkTrainer:
         return tokenizer
 
     def is_text_encoder_outputs_cached(self, args):
-        return False
+        return args.cache_text_encoder_outputs
 
     def cache_text_encoder_outputs_if_needed(
-        self, args, accelerator, unet, vae, tokenizers, text_encoders, data_loader, weight_dtype
+        self, args, accelerator, unet, vae, tokenizers, text_encoders, dataset: train_util.DatasetGroup, weight_dtype
     ):
-        for t_enc in text_encoders:
-            t_enc.to(accelerator.device)
+        if args.cache_text_encoder_outputs:
+            if not args.lowram:
+                # メモリ消費を減らす
+                print("move vae and unet to cpu to save memory")
+                org_vae_device = vae.device
+                org_unet_device = unet.device
+                vae.to("cpu")
+                unet.to("cpu")
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+
+            dataset.cache_text_encoder_outputs(
+                tokenizers,
+                text_encoders,
+                accelerator.device,
+                weight_dtype,
+                args.cache_text_encoder_outputs_to_disk,
+                accelerator.is_main_process,
+                v2=args.v2,
+                clip_skip=args.clip_skip,
+                storage_dtype=args.cache_storage_dtype,
+                compress=args.cache_compress,
+                model_identity=train_util.get_text_encoder_model_identity(args),
+            )
+
+            text_encoders[0].to("cpu", dtype=torch.float32)  # Text Encoder doesn't work with fp16 on CPU
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+            if not args.lowram:
+                print("move vae and unet back to original device")
+                vae.to(org_vae_device)
+                unet.to(org_unet_device)
+        else:
+            # Text Encoderから毎回出力を取得するので、GPUに乗せておく
+            for t_enc in text_encoders:
+                t_enc.to(accelerator.device)
 
     def get_text_cond(self, args, accelerator, batch, tokenizers, text_encoders, weight_dtype):
+        if "text_encoder_outputs1_list" in batch and batch["text_encoder_outputs1_list"] is not None:
+            return batch["text_encoder_outputs1_list"].to(accelerator.device).to(weight_dtype)
+
         input_ids = batch["input_ids"].to(accelerator.device)
         encoder_hidden_states = train_util.get_hidden_states(args, input_ids, tokenizers[0], text_encoders[0], weight_dtype)
         return encoder_hidden_states
@@ -113,8 +169,10 @@ class NetworkTrainer:
         noise_pred = unet(noisy_latents, timesteps, text_conds).sample
         return noise_pred
 
-    def sample_images(self, accelerator, args, epoch, global_step, device, vae, tokenizer, text_encoder, unet):
-        train_util.sample_images(accelerator, args, epoch, global_step, device, vae, tokenizer, text_encoder, unet)
+    def sample_images(self, accelerator, args, epoch, global_step, device, vae, tokenizer, text_encoder, unet, network=None):
+        train_util.sample_images(
+            accelerator, args, epoch, global_step, device, vae, tokenizer, text_encoder, unet, network=network
+        )
 
     def train(self, args):
         session_id = random.randint(0, 2**32)
@@ -199,6 +257,11 @@ class NetworkTrainer:
                 train_dataset_group.is_latent_cacheable()
             ), "when caching latents, either color_aug or random_crop cannot be used / latentをキャッシュするときはcolor_augとrandom_cropは使えません"
 
+        if args.image_ram_cache_size > 0 and not cache_latents:
+            train_dataset_group.enable_image_cache(args.image_ram_cache_size)
+        if args.gpu_augmentation:
+            train_dataset_group.set_gpu_augmentation(True)
+
         self.assert_extra_args(args, train_dataset_group)
 
         # acceleratorを準備する
@@ -249,7 +312,16 @@ class NetworkTrainer:
             vae.requires_grad_(False)
             vae.eval()
             with torch.no_grad():
-                train_dataset_group.cache_latents(vae, args.vae_batch_size, args.cache_latents_to_disk, accelerator.is_main_process)
+                train_dataset_group.cache_latents(
+                    vae,
+                    args.vae_batch_size,
+                    args.cache_latents_to_disk,
+                    accelerator.is_main_process,
+                    latents_cache_dir=args.latents_cache_dir,
+                    num_workers=args.cache_latents_workers,
+                    storage_dtype=args.cache_storage_dtype,
+                    compress=args.cache_compress,
+                )
             vae.to("cpu")
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
@@ -695,6 +767,15 @@ class NetworkTrainer:
             on_step_start = lambda *args, **kwargs: None
 
         # function for saving/removing
+        writer = train_util.get_checkpoint_writer(args) if is_main_process else None
+        if writer is not None and not checkpoint_writer.has_builtin_save_weights(accelerator.unwrap_model(network)):
+            # 独自のsave_weightsを持つnetworkは、同じファイルを保存するため同期的に保存する
+            print(
+                "network module has its own save_weights, checkpoints are saved synchronously"
+                + " / network moduleが独自のsave_weightsを持つため、チェックポイントは同期的に保存されます"
+            )
+            writer = None
+
         def save_model(ckpt_name, unwrapped_nw, steps, epoch_no, force_sync_upload=False):
             os.makedirs(args.output_dir, exist_ok=True)
             ckpt_file = os.path.join(args.output_dir, ckpt_name)
@@ -708,15 +789,35 @@ class NetworkTrainer:
             sai_metadata = train_util.get_sai_model_spec(None, args, self.is_sdxl, True, False)
             metadata_to_save.update(sai_metadata)
 
-            unwrapped_nw.save_weights(ckpt_file, save_dtype, metadata_to_save)
-            if args.huggingface_repo_id is not None:
-                huggingface_util.upload(args, ckpt_file, "/" + ckpt_name, force_sync_upload=force_sync_upload)
+            if writer is None:
+                unwrapped_nw.save_weights(ckpt_file, save_dtype, metadata_to_save)
+                if args.huggingface_repo_id is not None:
+                    huggingface_util.upload(args, ckpt_file, "/" + ckpt_name, force_sync_upload=force_sync_upload)
+                return
+
+            # copy the weights and the metadata, and write them in background (hashes are calculated there)
+            state_dict = checkpoint_writer.snapshot_state_dict(unwrapped_nw.state_dict(), save_dtype)
+            metadata_to_save = dict(metadata_to_save)
+
+            def save_in_background():
+                checkpoint_writer.save_state_dict(ckpt_file, state_dict, metadata_to_save)
+                if args.huggingface_repo_id is not None:
+                    huggingface_util.upload(args, ckpt_file, "/" + ckpt_name, force_sync_upload=force_sync_upload)
+
+            writer.submit(save_in_background)
 
         def remove_model(old_ckpt_name):
             old_ckpt_file = os.path.join(args.output_dir, old_ckpt_name)
-            if os.path.exists(old_ckpt_file):
-                accelerator.print(f"removing old checkpoint: {old_ckpt_file}")
-                os.remove(old_ckpt_file)
+
+            def remove():
+                if os.path.exists(old_ckpt_file):
+                    accelerator.print(f"removing old checkpoint: {old_ckpt_file}")
+                    os.remove(old_ckpt_file)
+
+            if writer is None:
+                remove()
+            else:
+                writer.submit(remove)  # after the pending saves
 
         # training loop
         for epoch in range(num_train_epochs):
@@ -737,7 +838,7 @@ class NetworkTrainer:
                             latents = batch["latents"].to(accelerator.device)
                         else:
                             # latentに変換
-                            latents = vae.encode(batch["images"].to(dtype=vae_dtype)).latent_dist.sample()
+                            latents = vae.encode(train_util.augment_batch_images(batch).to(dtype=vae_dtype)).latent_dist.sample()
 
                             # NaNが含まれていれば警告を表示し0に置き換える
                             if torch.any(torch.isnan(latents)):
@@ -817,7 +918,18 @@ class NetworkTrainer:
                     progress_bar.update(1)
                     global_step += 1
 
-                    self.sample_images(accelerator, args, None, global_step, accelerator.device, vae, tokenizer, text_encoder, unet)
+                    self.sample_images(
+                        accelerator,
+                        args,
+                        None,
+                        global_step,
+                        accelerator.device,
+                        vae,
+                        tokenizer,
+                        text_encoder,
+                        unet,
+                        network=accelerator.unwrap_model(network),
+                    )
 
                     # 指定ステップごとにモデルを保存
                     if args.save_every_n_steps is not None and global_step % args.save_every_n_steps == 0:
@@ -876,7 +988,18 @@ class NetworkTrainer:
                     if args.save_state:
                         train_util.save_and_remove_state_on_epoch_end(args, accelerator, epoch + 1)
 
-            self.sample_images(accelerator, args, epoch + 1, global_step, accelerator.device, vae, tokenizer, text_encoder, unet)
+            self.sample_images(
+                accelerator,
+                args,
+                epoch + 1,
+                global_step,
+                accelerator.device,
+                vae,
+                tokenizer,
+                text_encoder,
+                unet,
+                network=accelerator.unwrap_model(network),
+            )
 
             # end of epoch
 
@@ -894,6 +1017,7 @@ class NetworkTrainer:
         if is_main_process:
             ckpt_name = train_util.get_last_ckpt_name(args, "." + args.save_model_as)
             save_model(ckpt_name, network, global_step, num_train_epochs, force_sync_upload=True)
+            train_util.flush_checkpoint_writer()
 
             print("model saved.")
 
@@ -944,6 +1068,14 @@ def setup_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--network_train_text_encoder_only", action="store_true", help="only training Text Encoder part / Text Encoder関連部分のみ学習する"
     )
+    parser.add_argument(
+        "--cache_text_encoder_outputs", action="store_true", help="cache text encoder outputs / text encoderの出力をキャッシュする"
+    )
+    parser.add_argument(
+        "--cache_text_encoder_outputs_to_disk",
+        action="store_true",
+        help="cache text encoder outputs to disk / text encoderの出力をディスクにキャッシュする",
+    )
     parser.add_argument(
         "--training_comment", type=str, default=None, help="arbitrary comment string stored in metadata / メタデータに記録する任意のコメント文字列"
     )
@@ -110,8 +110,19 @@ class TextualInversionTrainer:
         return noise_pred
 
     def sample_images(self, accelerator, args, epoch, global_step, device, vae, tokenizer, text_encoder, unet, prompt_replacement):
+        # the worker process loads the base Text Encoder without the new tokens, so samples are generated here
         train_util.sample_images(
-            accelerator, args, epoch, global_step, device, vae, tokenizer, text_encoder, unet, prompt_replacement
+            accelerator,
+            args,
+            epoch,
+            global_step,
+            device,
+            vae,
+            tokenizer,
+            text_encoder,
+            unet,
+            prompt_replacement,
+            allow_background=False,
         )
 
     def save_weights(self, file, updated_embs, save_dtype, metadata):
@@ -344,6 +355,11 @@ class TextualInversionTrainer:
                 train_dataset_group.is_latent_cacheable()
             ), "when caching latents, either color_aug or random_crop cannot be used / latentをキャッシュするときはcolor_augとrandom_cropは使えません"
 
+        if args.image_ram_cache_size > 0 and not cache_latents:
+            train_dataset_group.enable_image_cache(args.image_ram_cache_size)
+        if args.gpu_augmentation:
+            train_dataset_group.set_gpu_augmentation(True)
+
         # モデルに xformers とか memory efficient attention を組み込む
         train_util.replace_unet_modules(unet, args.mem_eff_attn, args.xformers, args.sdpa)
         if torch.__version__ >= "2.0.0":  # PyTorch 2.0.0 以上対応のxformersなら以下が使える
@@ -355,7 +371,16 @@ class TextualInversionTrainer:
             vae.requires_grad_(False)
             vae.eval()
             with torch.no_grad():
-                train_dataset_group.cache_latents(vae, args.vae_batch_size, args.cache_latents_to_disk, accelerator.is_main_process)
+                train_dataset_group.cache_latents(
+                    vae,
+                    args.vae_batch_size,
+                    args.cache_latents_to_disk,
+                    accelerator.is_main_process,
+                    latents_cache_dir=args.latents_cache_dir,
+                    num_workers=args.cache_latents_workers,
+                    storage_dtype=args.cache_storage_dtype,
+                    compress=args.cache_compress,
+                )
             vae.to("cpu")
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
@@ -539,7 +564,7 @@ class TextualInversionTrainer:
                             latents = batch["latents"].to(accelerator.device)
                         else:
                             # latentに変換
-                            latents = vae.encode(batch["images"].to(dtype=vae_dtype)).latent_dist.sample()
+                            latents = vae.encode(train_util.augment_batch_images(batch).to(dtype=vae_dtype)).latent_dist.sample()
                         latents = latents * self.vae_scale_factor
 
                     # Get the text embedding for conditioning